@@ -4,6 +4,8 @@ import sqlite3
 import os
 from datetime import datetime
 
+from migrations import run_migrations
+
 DB_NAME = "bot.db"
 
 def get_db():
@@ -316,8 +318,7 @@ def init_db():
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_role ON users (role)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_gender ON users (gender)')
     
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_duty_date ON duty_schedule (date)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_duty_group_year ON duty_schedule (group_name, enrollment_year)')
+    # Составные индексы duty_schedule создаёт миграция 9 (migrations.py)
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_duty_gender ON duty_schedule (gender)')
     
     # Индексы для опроса (попарное голосование)
@@ -401,6 +402,11 @@ def init_db():
             cursor.execute('INSERT OR IGNORE INTO achievements (id, title, description, icon_url, sort_order) VALUES (?, ?, ?, ?, ?)', row)
 
     conn.commit()
+
+    # === Версионные миграции (таблицы, которые раньше создавались в обработчиках server.py) ===
+    applied = run_migrations(conn)
+    if applied:
+        print(f"✅ Применены миграции: {applied}")
     conn.close()
     print("✅ База данных инициализирована с новой структурой")
     
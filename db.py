@@ -1,93 +1,269 @@
 # db.py — единый слой доступа к БД: SQLite или PostgreSQL
 # Переменные окружения для PostgreSQL: DATABASE_URL или POSTGRES_HOST + POSTGRES_DB + POSTGRES_USER + POSTGRES_PASSWORD
 
+import asyncio
+import itertools
 import os
+import random
 import re
+import threading
+import time
+import weakref
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache, partial
 
 USE_POSTGRES = bool(os.getenv("DATABASE_URL") or os.getenv("POSTGRES_HOST"))
 
 if USE_POSTGRES:
     try:
         import psycopg2
-        from psycopg2.extras import RealDictCursor
+        import psycopg2.extensions
+        from psycopg2.extras import RealDictCursor, execute_batch, execute_values
+        from psycopg2.pool import ThreadedConnectionPool
         DBIntegrityError = psycopg2.IntegrityError
     except ImportError:
         raise RuntimeError("Для PostgreSQL установите: pip install psycopg2-binary")
 
-    def _get_pg_conn():
+    # Пул соединений PostgreSQL (ThreadedConnectionPool). PG_POOL_MAX=0 — без пула, connect на каждый запрос.
+    PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "1"))
+    PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "10"))
+    # Сколько ждать свободное соединение, если все PG_POOL_MAX заняты
+    PG_POOL_TIMEOUT = float(os.getenv("PG_POOL_TIMEOUT", "10"))
+    # Соединение, простоявшее в пуле дольше этого, перед выдачей проверяется SELECT 1
+    PG_POOL_PING_IDLE_SEC = float(os.getenv("PG_POOL_PING_IDLE_SEC", "30"))
+
+    def _pg_connect_params():
         url = os.getenv("DATABASE_URL")
         if url:
-            return psycopg2.connect(url, cursor_factory=RealDictCursor)
-        host = os.getenv("POSTGRES_HOST", "localhost")
-        port = os.getenv("POSTGRES_PORT", "5432")
-        dbname = os.getenv("POSTGRES_DB", "vitech")
-        user = os.getenv("POSTGRES_USER", "postgres")
-        password = os.getenv("POSTGRES_PASSWORD", "")
-        return psycopg2.connect(
-            host=host, port=port, dbname=dbname, user=user, password=password,
-            cursor_factory=RealDictCursor
-        )
+            return {"dsn": url, "cursor_factory": RealDictCursor}
+        return {
+            "host": os.getenv("POSTGRES_HOST", "localhost"),
+            "port": os.getenv("POSTGRES_PORT", "5432"),
+            "dbname": os.getenv("POSTGRES_DB", "vitech"),
+            "user": os.getenv("POSTGRES_USER", "postgres"),
+            "password": os.getenv("POSTGRES_PASSWORD", ""),
+            "cursor_factory": RealDictCursor,
+        }
+
+    def _get_pg_conn():
+        return psycopg2.connect(**_pg_connect_params())
+
+    _pg_pool = None
+    _pg_pool_lock = threading.Lock()
+    _pg_pool_slots = threading.BoundedSemaphore(max(PG_POOL_MAX, 1))
+
+    def _get_pg_pool():
+        global _pg_pool
+        if _pg_pool is None:
+            with _pg_pool_lock:
+                if _pg_pool is None:
+                    _pg_pool = ThreadedConnectionPool(
+                        min(PG_POOL_MIN, PG_POOL_MAX), PG_POOL_MAX, **_pg_connect_params()
+                    )
+        return _pg_pool
+
+    def _pg_conn_is_healthy(raw):
+        if raw.closed:
+            return False
+        if raw.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if time.monotonic() - getattr(raw, "_returned_at", 0) < PG_POOL_PING_IDLE_SEC:
+            return True
+        try:
+            with raw.cursor() as cur:
+                cur.execute("SELECT 1")
+            raw.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _checkout_pg_conn():
+        if not _pg_pool_slots.acquire(timeout=PG_POOL_TIMEOUT):
+            raise RuntimeError(f"Нет свободных соединений с PostgreSQL (PG_POOL_MAX={PG_POOL_MAX})")
+        try:
+            pool = _get_pg_pool()
+            # Битые соединения (рестарт сервера БД, обрыв сети) выбрасываем и берём следующее
+            for _ in range(PG_POOL_MAX + 1):
+                raw = pool.getconn()
+                if _pg_conn_is_healthy(raw):
+                    return raw
+                pool.putconn(raw, close=True)
+            raise RuntimeError("Не удалось получить рабочее соединение с PostgreSQL")
+        except Exception:
+            _pg_pool_slots.release()
+            raise
+
+    def _return_pg_conn(raw):
+        try:
+            if not raw.closed and raw.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                raw.rollback()
+            raw._returned_at = time.monotonic()
+            _get_pg_pool().putconn(raw, close=bool(raw.closed))
+        except psycopg2.Error:
+            _get_pg_pool().putconn(raw, close=True)
+        finally:
+            _pg_pool_slots.release()
+
+    def _return_leaked_pg_conn(raw):
+        print("[WARN] Соединение PostgreSQL не закрыто явно — возвращено в пул сборщиком мусора")
+        _return_pg_conn(raw)
+
+    class PooledPgConnection:
+        """Соединение из пула: всё проксируется в psycopg2, close() возвращает соединение в пул.
+        Незакрытое соединение возвращается в пул (и освобождает слот) при сборке мусора обёртки."""
+        _is_pg = True
+
+        def __init__(self, raw):
+            self._raw = raw
+            self._finalizer = weakref.finalize(self, _return_leaked_pg_conn, raw)
+            self._finalizer.atexit = False
+
+        def __getattr__(self, name):
+            raw = self.__dict__.get("_raw")
+            if raw is None:
+                raise psycopg2.InterfaceError("connection already closed")
+            return getattr(raw, name)
+
+        def close(self):
+            # Повторный close() (явный + в finally) — безопасен
+            raw, self._raw = self._raw, None
+            if raw is not None and self._finalizer.detach():
+                _return_pg_conn(raw)
+
+    # Размер пачки, которой именованный (серверный) курсор подтягивает строки при stream=True
+    PG_STREAM_ITERSIZE = int(os.getenv("PG_STREAM_ITERSIZE", "2000"))
+    _pg_stream_ids = itertools.count(1)
 
     class PgCursorWrapper:
-        def __init__(self, conn, cursor, lastrowid=None, first_row=None, rest_rows=None):
+        """Курсор с интерфейсом sqlite3: строки читаются из psycopg2 по требованию (fetchone/fetchall/итерация)."""
+
+        def __init__(self, conn, cursor, lastrowid=None, rows=None, stream=False):
             self._conn = conn
             self._cursor = cursor
             self._lastrowid = lastrowid
-            self._first_row = first_row
-            self._rest = rest_rows or []
+            # Готовые строки (эмуляция PRAGMA) — отдаём их вместо чтения из курсора
+            self._rows = list(rows) if rows is not None else None
+            self._stream = stream
 
         @property
         def lastrowid(self):
             return self._lastrowid
 
+        @property
+        def rowcount(self):
+            return self._cursor.rowcount if self._cursor is not None else -1
+
+        def _readable(self):
+            # У именованного курсора description появляется только после первого fetch;
+            # у INSERT/UPDATE/DELETE без RETURNING результата нет — fetch* в psycopg2 бросил бы ProgrammingError
+            if self._cursor is None or self._cursor.closed:
+                return False
+            return self._stream or self._cursor.description is not None
+
+        def _finish(self):
+            if self._stream and not self._cursor.closed:
+                self._cursor.close()
+
         def fetchone(self):
-            if self._first_row is not None:
-                r, self._first_row = self._first_row, None
-                return r
-            return self._cursor.fetchone() if self._cursor else None
+            if self._rows is not None:
+                return self._rows.pop(0) if self._rows else None
+            if not self._readable():
+                return None
+            row = self._cursor.fetchone()
+            if row is None:
+                self._finish()
+            return row
 
         def fetchall(self):
-            if self._first_row is not None:
-                out = [self._first_row] + self._rest + (self._cursor.fetchall() if self._cursor else [])
-                self._first_row = None
-                self._rest = []
-                return out
-            if self._rest:
-                out = self._rest
-                self._rest = []
+            if self._rows is not None:
+                out, self._rows = self._rows, []
                 return out
-            return self._cursor.fetchall() if self._cursor else []
+            if not self._readable():
+                return []
+            out = self._cursor.fetchall()
+            self._finish()
+            return out
+
+        def __iter__(self):
+            if self._rows is not None:
+                rows, self._rows = self._rows, []
+                yield from rows
+                return
+            if not self._readable():
+                return
+            yield from self._cursor
+            self._finish()
 
     def get_db():
-        conn = _get_pg_conn()
-        conn._is_pg = True
-        return conn
+        if PG_POOL_MAX <= 0:
+            conn = _get_pg_conn()
+            conn._is_pg = True
+            return conn
+        return PooledPgConnection(_checkout_pg_conn())
 
-    def _pg_execute(conn, sql, params=None):
-        params = params or ()
+    # Перевод SQL из диалекта SQLite (как написано в server.py) в PostgreSQL.
+    # Запросы в коде — литералы, их немного; перевод кэшируется по тексту запроса.
+    PgStatement = namedtuple("PgStatement", "text is_insert returning_table pragma_table")
+    PG_SQL_CACHE_SIZE = int(os.getenv("PG_SQL_CACHE_SIZE", "1024"))
+
+    _PRAGMA_TABLE_INFO_RE = re.compile(r"PRAGMA\s+table_info\s*\(\s*(\w+)\s*\)", re.I)
+    _INSERT_RE = re.compile(r"\s*INSERT\s+INTO\s+(\w+)", re.I)
+
+    @lru_cache(maxsize=PG_SQL_CACHE_SIZE)
+    def _translate_sql(sql):
         # Эмуляция PRAGMA table_info для совместимости с server.py
-        m = re.match(r"PRAGMA\s+table_info\s*\(\s*(\w+)\s*\)", sql.strip(), re.I)
+        m = _PRAGMA_TABLE_INFO_RE.match(sql.strip())
         if m:
-            table = m.group(1)
+            return PgStatement(None, False, None, m.group(1).lower())
+        m = _INSERT_RE.match(sql)
+        is_insert = m is not None
+        # lastrowid для INSERT — через RETURNING id (если в таблице есть id, см. _pg_execute)
+        returning_table = m.group(1).lower() if is_insert and "RETURNING" not in sql.upper() else None
+        return PgStatement(sql.replace("?", "%s"), is_insert, returning_table, None)
+
+    def _pg_execute(conn, sql, params=None, stream=False):
+        params = params or ()
+        stmt = _translate_sql(sql)
+        if stmt.pragma_table:
+            rows = [{"name": c} for c in table_columns(conn, stmt.pragma_table)]
+            return PgCursorWrapper(conn, conn.cursor(), rows=rows)
+        if stmt.returning_table and "id" in table_columns(conn, stmt.returning_table):
             cur = conn.cursor()
-            cur.execute(
-                "SELECT column_name FROM information_schema.columns WHERE table_name = %s ORDER BY ordinal_position",
-                (table.lower(),)
-            )
-            rows = [{"name": r["column_name"]} for r in cur.fetchall()]
-            return PgCursorWrapper(conn, cur, first_row=None, rest_rows=rows)
-        raw = sql.replace("?", "%s")
-        cur = conn.cursor()
-        is_insert = re.match(r"\s*INSERT\s+INTO", sql, re.I) is not None
-        if is_insert and "RETURNING" not in sql.upper():
-            cur.execute(raw + " RETURNING id", params)
+            cur.execute(stmt.text + " RETURNING id", params)
             row = cur.fetchone()
             lid = row["id"] if row else None
-            return PgCursorWrapper(conn, cur, lastrowid=lid, first_row=None, rest_rows=[])
-        cur.execute(raw, params)
-        first = cur.fetchone()
-        rest = cur.fetchall() if cur.description else []
-        return PgCursorWrapper(conn, cur, first_row=first, rest_rows=rest)
+            return PgCursorWrapper(conn, cur, lastrowid=lid, rows=[])
+        if stream and not stmt.is_insert:
+            # Серверный курсор: строки приходят пачками по PG_STREAM_ITERSIZE, память не растёт с размером выборки
+            cur = conn.cursor(name=f"stream_{next(_pg_stream_ids)}")
+            cur.itersize = PG_STREAM_ITERSIZE
+            cur.execute(stmt.text, params)
+            return PgCursorWrapper(conn, cur, stream=True)
+        cur = conn.cursor()
+        cur.execute(stmt.text, params)
+        return PgCursorWrapper(conn, cur)
+
+    # Пакетная запись: INSERT ... VALUES (?, ...) уходит через execute_values (многострочный VALUES),
+    # остальное (UPDATE/DELETE, VALUES с вызовами функций) — через execute_batch. Строк в одном запросе — PG_BATCH_PAGE_SIZE.
+    PG_BATCH_PAGE_SIZE = int(os.getenv("PG_BATCH_PAGE_SIZE", "500"))
+    _VALUES_TUPLE_RE = re.compile(r"\bVALUES\s*(\([^()]*\))", re.I)
+
+    def _pg_execute_many(conn, sql, rows):
+        rows = [tuple(r) for r in rows]
+        cur = conn.cursor()
+        if not rows:
+            return PgCursorWrapper(conn, cur, rows=[])
+        text = sql.replace("?", "%s")
+        m = _VALUES_TUPLE_RE.search(text) if _INSERT_RE.match(text) else None
+        if m:
+            template = m.group(1)
+            text = text[:m.start(1)] + "%s" + text[m.end(1):]
+            execute_values(cur, text, rows, template=template, page_size=PG_BATCH_PAGE_SIZE)
+        else:
+            execute_batch(cur, text, rows, page_size=PG_BATCH_PAGE_SIZE)
+        return PgCursorWrapper(conn, cur, rows=[])
 
 else:
     import sqlite3
@@ -95,27 +271,321 @@ else:
 
     DB_PATH = os.path.join(os.path.dirname(__file__), "bot.db")
 
+    # Пул соединений SQLite: у каждого потока свой список простаивающих соединений (не больше SQLITE_POOL_SIZE).
+    # Соединение открывается один раз с PRAGMA (WAL, synchronous, busy_timeout, кэш страниц, mmap) и переиспользуется.
+    SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", "4"))
+    SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+    SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "20000"))
+    SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+    _sqlite_local = threading.local()
+
+    def _sqlite_idle_pool():
+        pool = getattr(_sqlite_local, "idle", None)
+        if pool is None:
+            pool = _sqlite_local.idle = []
+        return pool
+
+    def _open_sqlite_conn():
+        conn = sqlite3.connect(DB_PATH, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        return conn
+
+    def _release_sqlite_conn(raw):
+        """Вернуть соединение в пул потока; незакоммиченное откатываем, как это делал бы close()."""
+        try:
+            if raw.in_transaction:
+                raw.rollback()
+        except sqlite3.Error:
+            raw.close()
+            return
+        pool = _sqlite_idle_pool()
+        if len(pool) < SQLITE_POOL_SIZE:
+            pool.append(raw)
+        else:
+            raw.close()
+
+    class PooledSqliteConnection:
+        """Обёртка над sqlite3.Connection из пула: всё проксируется, close() возвращает соединение в пул."""
+        _is_pg = False
+
+        def __init__(self, raw):
+            self._raw = raw
+
+        def __getattr__(self, name):
+            raw = self.__dict__.get("_raw")
+            if raw is None:
+                raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+            return getattr(raw, name)
+
+        def close(self):
+            # Повторный close() (явный + в finally) — безопасен
+            raw, self._raw = self._raw, None
+            if raw is not None:
+                _release_sqlite_conn(raw)
+
     def get_db():
         if not os.path.exists(DB_PATH):
             return None
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        # sqlite3.Connection не допускает произвольные атрибуты — execute() использует getattr(conn, "_is_pg", False), и без атрибута вернёт False
-        return conn
+        pool = _sqlite_idle_pool()
+        raw = pool.pop() if pool else _open_sqlite_conn()
+        return PooledSqliteConnection(raw)
 
-    def _pg_execute(conn, sql, params=None):
+    def _pg_execute(conn, sql, params=None, stream=False):
         return conn.execute(sql, params or ())
 
 
-def execute(conn, sql, params=None):
-    """Выполнить запрос; возвращает курсор с fetchone/fetchall/lastrowid (для INSERT)."""
+@contextmanager
+def connection():
+    """Соединение из get_db() на время блока with; по выходе возвращается в пул (или закрывается)."""
+    conn = get_db()
+    try:
+        yield conn
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+# === Транзакции записи ===
+# Бот и сервер пишут в один bot.db: транзакция сразу берёт блокировку записи (BEGIN IMMEDIATE),
+# а при «database is locked» повторяет попытку с экспоненциальной паузой (SQLITE_BUSY_RETRIES раз).
+# Каждая попытка сама ждёт до busy_timeout соединения, поэтому повторов немного.
+SQLITE_BUSY_RETRIES = int(os.getenv("SQLITE_BUSY_RETRIES", "3"))
+SQLITE_BUSY_BACKOFF_SEC = float(os.getenv("SQLITE_BUSY_BACKOFF_SEC", "0.05"))
+
+
+def _is_busy_error(e):
+    msg = str(e).lower()
+    return "database is locked" in msg or "database is busy" in msg
+
+
+def _retry_busy(fn):
+    delay = SQLITE_BUSY_BACKOFF_SEC
+    for attempt in range(SQLITE_BUSY_RETRIES + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == SQLITE_BUSY_RETRIES or not _is_busy_error(e):
+                raise
+            time.sleep(delay * (1 + random.random()))
+            delay *= 2
+
+
+@contextmanager
+def transaction(conn):
+    """Все записи внутри блока with — одна транзакция с одним commit (вместо commit на каждую строку);
+    при исключении — rollback. В SQLite транзакция начинается с BEGIN IMMEDIATE, занятая БД ждёт с повторами.
+    Подходит и для соединений database.get_db() бота. Если на соединении уже есть незакоммиченные изменения,
+    они фиксируются вместе с блоком."""
+    if not getattr(conn, "_is_pg", False) and not conn.in_transaction:
+        _retry_busy(lambda: conn.execute("BEGIN IMMEDIATE"))
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    try:
+        _retry_busy(conn.commit)
+    except BaseException:
+        # commit так и не прошёл — транзакция не должна остаться открытой и держать блокировку записи
+        conn.rollback()
+        raise
+
+
+# === Статистика запросов (включается DB_QUERY_STATS=1) ===
+# По каждому запросу (нормализованный текст SQL): число вызовов, суммарное время, p50/p99, сколько строк прочитано.
+# Запросы дольше DB_SLOW_QUERY_MS пишутся в лог; при DB_SLOW_QUERY_EXPLAIN=1 — вместе с планом (EXPLAIN QUERY PLAN / EXPLAIN).
+DB_QUERY_STATS = os.getenv("DB_QUERY_STATS", "0") == "1"
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "200"))
+DB_SLOW_QUERY_EXPLAIN = os.getenv("DB_SLOW_QUERY_EXPLAIN", "0") == "1"
+# Для перцентилей храним последние N замеров каждого запроса
+DB_QUERY_SAMPLES = int(os.getenv("DB_QUERY_SAMPLES", "500"))
+
+_query_stats = {}
+_query_stats_lock = threading.Lock()
+_SQL_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_SQL_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_SQL_SPACE_RE = re.compile(r"\s+")
+
+
+def _normalize_sql(sql):
+    # Литералы из f-строк (id, годы, строки) схлопываются в ?, чтобы один запрос не плодил записи
+    sql = _SQL_STRING_RE.sub("?", sql)
+    sql = _SQL_NUMBER_RE.sub("?", sql)
+    return _SQL_SPACE_RE.sub(" ", sql).strip()
+
+
+class _QueryStat:
+    __slots__ = ("count", "total_ms", "max_ms", "rows", "samples")
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows = 0
+        self.samples = deque(maxlen=DB_QUERY_SAMPLES)
+
+
+def _stat_for(sql):
+    key = _normalize_sql(sql)
+    with _query_stats_lock:
+        stat = _query_stats.get(key)
+        if stat is None:
+            stat = _query_stats[key] = _QueryStat()
+    return stat
+
+
+def _record_query(stat, elapsed_ms, rows=0):
+    with _query_stats_lock:
+        stat.count += 1
+        stat.total_ms += elapsed_ms
+        stat.max_ms = max(stat.max_ms, elapsed_ms)
+        stat.rows += rows
+        stat.samples.append(elapsed_ms)
+
+
+def _add_rows(stat, n):
+    with _query_stats_lock:
+        stat.rows += n
+
+
+def _sql_verb(sql):
+    parts = sql.split(None, 1)
+    return parts[0].upper() if parts else ""
+
+
+def _is_read(sql):
+    return _sql_verb(sql) in ("SELECT", "WITH", "PRAGMA")
+
+
+def _explain(conn, sql, params):
+    if _sql_verb(sql) not in ("SELECT", "WITH"):
+        return None
+    try:
+        if getattr(conn, "_is_pg", False):
+            cur = conn.cursor()
+            cur.execute("EXPLAIN " + sql.replace("?", "%s"), params or ())
+            return "\n".join(list(r.values())[0] for r in cur.fetchall())
+        rows = conn.execute("EXPLAIN QUERY PLAN " + sql, params or ()).fetchall()
+        return "\n".join(str(r[-1]) for r in rows)
+    except Exception as e:
+        return f"(EXPLAIN не выполнен: {e})"
+
+
+def _log_slow_query(conn, sql, params, elapsed_ms):
+    print(f"[SLOW SQL] {elapsed_ms:.1f} мс: {_normalize_sql(sql)[:500]}")
+    if DB_SLOW_QUERY_EXPLAIN:
+        plan = _explain(conn, sql, params)
+        if plan:
+            print(f"[SLOW SQL] план:\n{plan}")
+
+
+class _TracedCursor:
+    """Обёртка курсора: считает прочитанные строки в статистику запроса."""
+
+    def __init__(self, cursor, stat):
+        self._cursor = cursor
+        self._stat = stat
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            _add_rows(self._stat, 1)
+        return row
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        _add_rows(self._stat, len(rows))
+        return rows
+
+    def __iter__(self):
+        for row in self._cursor:
+            _add_rows(self._stat, 1)
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def _traced(run, conn, sql, params):
+    stat = _stat_for(sql)
+    t0 = time.perf_counter()
+    cur = run()
+    elapsed_ms = (time.perf_counter() - t0) * 1000
+    # Для выборок строки считает _TracedCursor по мере чтения, для записи — rowcount
+    rowcount = -1 if _is_read(sql) else getattr(cur, "rowcount", -1)
+    _record_query(stat, elapsed_ms, rowcount if rowcount and rowcount > 0 else 0)
+    if elapsed_ms >= DB_SLOW_QUERY_MS:
+        _log_slow_query(conn, sql, params, elapsed_ms)
+    return _TracedCursor(cur, stat)
+
+
+def query_stats(limit=50, order_by="total_ms"):
+    """Снимок статистики запросов, отсортированный по total_ms | count | p99_ms | rows (по убыванию)."""
+    with _query_stats_lock:
+        items = [(sql, st.count, st.total_ms, st.max_ms, st.rows, sorted(st.samples)) for sql, st in _query_stats.items()]
+    out = []
+    for sql, count, total_ms, max_ms, rows, samples in items:
+        def pct(p):
+            return round(samples[min(len(samples) - 1, int(len(samples) * p))], 2) if samples else 0.0
+        out.append({
+            "sql": sql,
+            "count": count,
+            "total_ms": round(total_ms, 2),
+            "avg_ms": round(total_ms / count, 2) if count else 0.0,
+            "p50_ms": pct(0.5),
+            "p99_ms": pct(0.99),
+            "max_ms": round(max_ms, 2),
+            "rows": rows,
+        })
+    if order_by not in ("total_ms", "count", "p99_ms", "rows"):
+        order_by = "total_ms"
+    out.sort(key=lambda r: r[order_by], reverse=True)
+    return out[:limit]
+
+
+def reset_query_stats():
+    with _query_stats_lock:
+        _query_stats.clear()
+
+
+def execute(conn, sql, params=None, stream=False):
+    """Выполнить запрос; возвращает курсор с fetchone/fetchall/lastrowid (для INSERT) и итерацией по строкам.
+    stream=True — для больших выборок, которые читаются один раз циклом: в PostgreSQL идёт через серверный курсор
+    (SQLite-курсор и так читает строки лениво)."""
     if getattr(conn, "_is_pg", False):
-        return _pg_execute(conn, sql, params)
-    return conn.execute(sql, params or ())
+        run = partial(_pg_execute, conn, sql, params, stream=stream)
+    else:
+        run = partial(conn.execute, sql, params or ())
+    if not DB_QUERY_STATS:
+        return run()
+    return _traced(run, conn, sql, params)
 
 
-def table_columns(conn, table):
-    """Список имён колонок таблицы (для совместимости с PRAGMA table_info)."""
+def execute_many(conn, sql, rows):
+    """Выполнить один запрос для множества наборов параметров за один проход:
+    sqlite3.executemany в SQLite, execute_values/execute_batch в PostgreSQL (вместо запроса на каждую строку)."""
+    if getattr(conn, "_is_pg", False):
+        run = partial(_pg_execute_many, conn, sql, rows)
+    else:
+        run = partial(conn.executemany, sql, rows)
+    if not DB_QUERY_STATS:
+        return run()
+    return _traced(run, conn, sql, None)
+
+
+# Кэш схемы: колонки таблиц читаются из каталога один раз на процесс.
+# Сбрасывается после миграций (invalidate_schema_cache); пустой ответ (таблицы ещё нет) не кэшируется.
+_schema_cache = {}
+_schema_cache_lock = threading.Lock()
+
+
+def _load_table_columns(conn, table):
     if getattr(conn, "_is_pg", False):
         cur = conn.cursor()
         cur.execute("""
@@ -125,3 +595,47 @@ def table_columns(conn, table):
         return [r["column_name"] for r in cur.fetchall()]
     cur = conn.execute("PRAGMA table_info(" + table + ")")
     return [row["name"] for row in cur.fetchall()]
+
+
+def table_columns(conn, table):
+    """Список имён колонок таблицы (для совместимости с PRAGMA table_info). Результат кэшируется на процесс."""
+    table = table.lower()
+    cols = _schema_cache.get(table)
+    if cols is None:
+        cols = tuple(_load_table_columns(conn, table))
+        if cols:
+            with _schema_cache_lock:
+                _schema_cache[table] = cols
+    return list(cols)
+
+
+def invalidate_schema_cache(table=None):
+    """Сбросить кэш колонок (после CREATE/ALTER TABLE). Без аргумента — для всех таблиц."""
+    with _schema_cache_lock:
+        if table is None:
+            _schema_cache.clear()
+        else:
+            _schema_cache.pop(table.lower(), None)
+
+
+# === Асинхронный доступ для FastAPI ===
+# sqlite3/psycopg2 блокируют поток; в async-обработчиках запросы уходят в отдельный пул потоков БД,
+# чтобы медленный запрос не останавливал event loop uvicorn. У каждого потока пула — свои соединения (get_db).
+DB_THREADS = int(os.getenv("DB_THREADS", "8"))
+_db_executor = None
+_db_executor_lock = threading.Lock()
+
+
+def _get_db_executor():
+    global _db_executor
+    if _db_executor is None:
+        with _db_executor_lock:
+            if _db_executor is None:
+                _db_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="db")
+    return _db_executor
+
+
+async def run_db(fn, *args, **kwargs):
+    """Выполнить блокирующую функцию fn(*args, **kwargs) в пуле потоков БД и дождаться результата."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_db_executor(), partial(fn, *args, **kwargs))
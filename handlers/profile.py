@@ -4,6 +4,7 @@ from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ContextTypes, CallbackQueryHandler, MessageHandler, filters, ConversationHandler
 from database import get_db, update_user_last_active
 from utils.course_calculator import get_course_info
+from utils.fio import refresh_user_fio_aliases
 from datetime import datetime, timedelta
 import logging
 
@@ -196,6 +197,9 @@ async def edit_fio_save(update: Update, context: ContextTypes.DEFAULT_TYPE):
             (new_fio, user_id)
         )
 
+        # Алиасы для поиска в графике (полное ФИО и инициалы)
+        refresh_user_fio_aliases(conn, user_id)
+
         conn.commit()
         logger.info(f"✅ ФИО обновлено: {user_id} → {new_fio}")
     except Exception as e:
@@ -12,6 +12,7 @@ from telegram.ext import (
 from database import get_db, update_user_last_active
 from utils.welcome_message import get_welcome_message
 from utils.course_calculator import get_course_info
+from utils.fio import refresh_user_fio_aliases
 from datetime import datetime, date
 import logging
 
@@ -459,6 +460,7 @@ async def confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE):
             VALUES (?, ?, ?)
         ''', (user_id, fio, group))
 
+        refresh_user_fio_aliases(conn, user_id)
         conn.commit()
         update_user_last_active(user_id)
 
@@ -46,8 +46,8 @@ async def create_duty_reminders(context: ContextTypes.DEFAULT_TYPE, schedule_dat
                 logger.error(f"❌ Неверный формат даты в наряде {duty}: {e}")
                 continue
 
-            # Ищем chat_id
-            chat_id = find_chat_id_by_fio(fio)
+            # Ищем chat_id: user_id сопоставлен при загрузке графика, иначе — поиск по ФИО
+            chat_id = duty.get('user_id') or find_chat_id_by_fio(fio)
             if not chat_id:
                 logger.warning(f"❌ Не найден chat_id для: {fio}")
                 continue
@@ -137,8 +137,12 @@ def find_chat_id_by_fio(fio: str) -> int:
         last_name = parts[0]  # Берём фамилию
 
         cursor = conn.cursor()
-        cursor.execute("SELECT telegram_id FROM users WHERE fio LIKE ?", (f"{last_name}%",))
+        # Точное совпадение по алиасам (полное ФИО или инициалы), иначе — по фамилии
+        cursor.execute("SELECT telegram_id FROM fio_aliases WHERE alias = ? LIMIT 1", (fio.strip(),))
         row = cursor.fetchone()
+        if not row:
+            cursor.execute("SELECT telegram_id FROM users WHERE fio LIKE ?", (f"{last_name}%",))
+            row = cursor.fetchone()
 
         if row:
             logger.debug(f"🔍 Найден: {fio} → chat_id: {row[0]}")
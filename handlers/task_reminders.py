@@ -1,6 +1,7 @@
 from telegram.ext import ContextTypes
 from datetime import datetime, timedelta
 from database import get_db
+from db import transaction
 import logging
 
 logger = logging.getLogger(__name__)
@@ -55,6 +56,12 @@ async def check_task_reminders(context: ContextTypes.DEFAULT_TYPE):
                 user_id = task['user_id']
                 task_text = task['text']
 
+                # Ту же задачу может напомнить и сервер: отправленную им за время прохода пропускаем
+                cursor.execute("SELECT reminded FROM tasks WHERE id = ?", (task_id,))
+                current = cursor.fetchone()
+                if not current or current['reminded']:
+                    continue
+
                 msg = f"⏰ <b>Время выполнить задачу!</b>\n\n{task_text}"
 
                 await context.bot.send_message(
@@ -64,9 +71,9 @@ async def check_task_reminders(context: ContextTypes.DEFAULT_TYPE):
                 )
                 logger.info(f"✅ Напоминание отправлено: задача {task_id} → {user_id}")
 
-                # Отмечаем как напомянутое
-                cursor.execute("UPDATE tasks SET reminded = 1 WHERE id = ?", (task_id,))
-                conn.commit()
+                # Отмечаем сразу после отправки, короткой транзакцией — второй процесс видит отметку до конца прохода
+                with transaction(conn):
+                    conn.execute("UPDATE tasks SET reminded = 1 WHERE id = ?", (task_id,))
 
             except Exception as e:
                 if "bot was blocked" in str(e).lower():
@@ -100,6 +107,7 @@ async def restore_task_reminders(context: ContextTypes.DEFAULT_TYPE):
         now = datetime.now()
         restored_count = 0
         skipped_count = 0
+        expired = []
 
         for task in pending_tasks:
             try:
@@ -110,8 +118,7 @@ async def restore_task_reminders(context: ContextTypes.DEFAULT_TYPE):
 
                 # 🔒 Если дедлайн уже прошёл — не ставим job, просто отмечаем
                 if deadline < now:
-                    cursor.execute("UPDATE tasks SET reminded = 1 WHERE id = ?", (task['id'],))
-                    conn.commit()
+                    expired.append((task['id'],))
                     skipped_count += 1
                     logger.info(f"⏭️ Пропущено (просрочено): задача {task['id']}")
                     continue
@@ -132,6 +139,10 @@ async def restore_task_reminders(context: ContextTypes.DEFAULT_TYPE):
             except Exception as e:
                 logger.warning(f"⚠️ Не удалось восстановить напоминание для задачи {task['id']}: {e}")
 
+        if expired:
+            with transaction(conn):
+                conn.executemany("UPDATE tasks SET reminded = 1 WHERE id = ?", expired)
+
         logger.info(f"🔄 Восстановлено {restored_count} напоминаний")
         if skipped_count:
             logger.info(f"⏭️ Пропущено {skipped_count} (просрочены)")
@@ -150,6 +161,7 @@ async def send_delayed_task_reminder(context: ContextTypes.DEFAULT_TYPE):
     task_text = job_data['task_text']
     task_id = job_data['task_id']
 
+    conn = None
     try:
         # 🔍 Проверим, не было ли уже напоминания (на всякий случай)
         conn = get_db()
@@ -159,7 +171,6 @@ async def send_delayed_task_reminder(context: ContextTypes.DEFAULT_TYPE):
         if row and row['reminded']:
             logger.info(f"ℹ️ Напоминание уже отправлено ранее: задача {task_id}")
             return
-        conn.close()
 
         await context.bot.send_message(
             chat_id=user_id,
@@ -168,14 +179,15 @@ async def send_delayed_task_reminder(context: ContextTypes.DEFAULT_TYPE):
         )
         logger.info(f"✅ Отправлено отложенное напоминание: задача {task_id}")
 
-        # ✅ Отмечаем как напомянутое
-        conn = get_db()
-        conn.execute("UPDATE tasks SET reminded = 1 WHERE id = ?", (task_id,))
-        conn.commit()
-        conn.close()
+        # ✅ Отмечаем как напомянутое (BEGIN IMMEDIATE + повтор, если БД занята сервером)
+        with transaction(conn):
+            conn.execute("UPDATE tasks SET reminded = 1 WHERE id = ?", (task_id,))
 
     except Exception as e:
         if "bot was blocked" in str(e).lower():
             logger.warning(f"🚫 Пользователь {user_id} заблокировал бота")
         else:
             logger.error(f"❌ Ошибка при отправке отложенного напоминания {task_id}: {e}")
+    finally:
+        if conn:
+            conn.close()
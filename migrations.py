@@ -0,0 +1,482 @@
+# migrations.py — версионные миграции схемы (SQLite и PostgreSQL).
+# Запускаются один раз при старте: database.init_db() (бот и server.py на SQLite) и startup_init_db (PostgreSQL).
+# Обработчики запросов таблицы не создают — только читают и пишут данные.
+# Новая миграция = новая запись в конце MIGRATIONS со следующим номером; применённые миграции не редактируются.
+# sqlite/pg — один SQL-оператор или список (элемент списка может быть функцией от курсора);
+# after(conn) — необязательный шаг на Python (заполнение данных).
+# Миграция должна переживать повторный запуск: бот и сервер стартуют одновременно, процесс может упасть
+# до записи версии — отсюда IF NOT EXISTS, ON CONFLICT DO NOTHING и _sqlite_add_column.
+
+from collections import namedtuple
+
+Migration = namedtuple("Migration", "version name sqlite pg after", defaults=(None,))
+
+
+def _sqlite_add_column(table, column, decl):
+    """ALTER TABLE ... ADD COLUMN для SQLite (там нет IF NOT EXISTS): пропускается, если колонка уже есть."""
+    def add(cur):
+        cur.execute(f"PRAGMA table_info({table})")
+        if column not in {row[1] for row in cur.fetchall()}:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    return add
+
+
+def _sqlite_lower_roles(table):
+    """Привести role к нижнему регистру на Python: lower() в SQLite не переводит кириллицу.
+    Строка, у которой после приведения появился бы дубль по ключу, удаляется."""
+    def lower(cur):
+        cur.execute(f"SELECT DISTINCT role FROM {table} WHERE role IS NOT NULL")
+        for role in [row[0] for row in cur.fetchall()]:
+            if role != role.lower():
+                cur.execute(f"UPDATE OR IGNORE {table} SET role = ? WHERE role = ?", (role.lower(), role))
+                cur.execute(f"DELETE FROM {table} WHERE role = ?", (role,))
+    return lower
+
+
+def _backfill_assignment_stats(conn):
+    from utils.distribution import rebuild_assignment_stats
+    rebuild_assignment_stats(conn)
+
+
+def _backfill_user_points(conn):
+    from utils.points import rebuild_user_points
+    rebuild_user_points(conn)
+
+
+def _backfill_leaderboards(conn):
+    from utils.points import rebuild_leaderboards
+    rebuild_leaderboards(conn)
+
+
+def _rebuild_points(conn):
+    from utils.points import rebuild_leaderboards, rebuild_user_points
+    rebuild_user_points(conn)
+    rebuild_leaderboards(conn)
+
+
+def _backfill_fio_aliases(conn):
+    from utils.fio import sync_fio_aliases
+    cur = conn.cursor()
+    cur.execute("SELECT telegram_id, fio, enrollment_year FROM users WHERE fio IS NOT NULL")
+    for row in cur.fetchall():
+        sync_fio_aliases(conn, row["telegram_id"], row["fio"], row["enrollment_year"])
+
+
+# Заполнение duty_schedule.user_id по fio_aliases: сначала совпадение в том же курсе, затем любое
+_LINK_DUTY_SCHEDULE_SQL = """
+    UPDATE duty_schedule SET user_id = COALESCE(
+        (SELECT a.telegram_id FROM fio_aliases a
+         WHERE a.alias = duty_schedule.fio AND a.enrollment_year = duty_schedule.enrollment_year LIMIT 1),
+        (SELECT a.telegram_id FROM fio_aliases a WHERE a.alias = duty_schedule.fio LIMIT 1)
+    )
+    WHERE user_id IS NULL
+"""
+
+
+# Одинаковы для SQLite и PostgreSQL
+_DUTY_SCHEDULE_INDEXES = [
+            # наряд на дату: участники, распределение, day-detail, by-date (покрывающий: group_name, fio)
+            "CREATE INDEX IF NOT EXISTS idx_duty_date_role_year ON duty_schedule (date, role, enrollment_year, group_name, fio)",
+            # месяцы курса (available-months, удаление месяца, контекст правки)
+            "CREATE INDEX IF NOT EXISTS idx_duty_year_date ON duty_schedule (enrollment_year, date)",
+            # загрузка/перезапись графика группы за месяц
+            "CREATE INDEX IF NOT EXISTS idx_duty_group_year_date ON duty_schedule (group_name, enrollment_year, date)",
+            # наряды курсанта по ФИО (достижения, правка графика)
+            "CREATE INDEX IF NOT EXISTS idx_duty_fio_year_date ON duty_schedule (fio, enrollment_year, date)",
+            # префиксы новых индексов — больше не нужны
+            "DROP INDEX IF EXISTS idx_duty_date",
+            "DROP INDEX IF EXISTS idx_duty_group_year",
+            "ANALYZE duty_schedule",
+        ]
+
+
+# Одинаковы для SQLite и PostgreSQL
+_SCHEDULE_VERSIONS = """
+    CREATE TABLE IF NOT EXISTS schedule_versions (
+        enrollment_year INTEGER NOT NULL,
+        ym TEXT NOT NULL,
+        version INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (enrollment_year, ym)
+    )
+"""
+
+# Строка версии на каждый месяц каталога: иначе bump_course_schedule_versions (UPDATE по курсу) не затронет
+# месяцы, загруженные до миграции и с тех пор не правленные, и снимки с версией 0 не устареют
+_SCHEDULE_VERSIONS_BACKFILL = """
+    INSERT INTO schedule_versions (enrollment_year, ym, version)
+    SELECT DISTINCT enrollment_year, ym, 1 FROM schedule_months WHERE 1 = 1  -- WHERE: иначе SQLite читает ON как условие JOIN
+    ON CONFLICT (enrollment_year, ym) DO NOTHING
+"""
+
+
+# Одинаковы для SQLite и PostgreSQL
+_DISTRIBUTION_RUNS = """
+    CREATE TABLE IF NOT EXISTS distribution_runs (
+        date TEXT NOT NULL,
+        role TEXT NOT NULL,
+        enrollment_year INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        started_at TEXT NOT NULL,
+        PRIMARY KEY (date, role, enrollment_year)
+    )
+"""
+
+
+# Одинаковы для SQLite и PostgreSQL; period_ym — YYYY-MM или 'all' (итог за всё время)
+_USER_POINTS = [
+    """
+    CREATE TABLE IF NOT EXISTS user_points (
+        telegram_id BIGINT NOT NULL,
+        enrollment_year INTEGER NOT NULL,
+        period_ym TEXT NOT NULL,
+        points DOUBLE PRECISION NOT NULL DEFAULT 0,
+        duty_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (telegram_id, period_ym)
+    )
+    """,
+    # топ курса/института за период и место пользователя — счёт по (period_ym, enrollment_year, points)
+    "CREATE INDEX IF NOT EXISTS idx_user_points_period ON user_points (period_ym, enrollment_year, points)",
+]
+
+
+# Одинаковы для SQLite и PostgreSQL; scope — course (scope_key = enrollment_year) или institute (scope_key = 0)
+_LEADERBOARDS = [
+    """
+    CREATE TABLE IF NOT EXISTS leaderboards (
+        scope TEXT NOT NULL,
+        scope_key INTEGER NOT NULL,
+        period_ym TEXT NOT NULL,
+        rank INTEGER NOT NULL,
+        telegram_id BIGINT NOT NULL,
+        points DOUBLE PRECISION NOT NULL,
+        PRIMARY KEY (scope, scope_key, period_ym, rank)
+    )
+    """,
+    # место на начало дня: изменение за день и тренд — одно чтение по (telegram_id, scope, period_ym, snapshot_date)
+    """
+    CREATE TABLE IF NOT EXISTS rank_snapshots (
+        telegram_id BIGINT NOT NULL,
+        scope TEXT NOT NULL,
+        period_ym TEXT NOT NULL,
+        snapshot_date TEXT NOT NULL,
+        rank INTEGER NOT NULL,
+        points DOUBLE PRECISION NOT NULL,
+        PRIMARY KEY (telegram_id, scope, period_ym, snapshot_date)
+    )
+    """,
+]
+
+
+# Одинаковы для SQLite и PostgreSQL; last_objects и per_object_counts — JSON
+_ASSIGNMENT_STATS = """
+    CREATE TABLE IF NOT EXISTS assignment_stats (
+        fio TEXT NOT NULL,
+        enrollment_year INTEGER NOT NULL,
+        last_objects TEXT NOT NULL DEFAULT '[]',
+        heavy_streak INTEGER NOT NULL DEFAULT 0,
+        per_object_counts TEXT NOT NULL DEFAULT '{}',
+        updated_at TEXT,
+        PRIMARY KEY (fio, enrollment_year)
+    )
+"""
+
+
+MIGRATIONS = [
+    Migration(1, "duty_confirmations",
+        """
+        CREATE TABLE IF NOT EXISTS duty_confirmations (
+            telegram_id INTEGER,
+            date TEXT,
+            role TEXT,
+            status TEXT NOT NULL,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (telegram_id, date, role)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS duty_confirmations (
+            telegram_id BIGINT,
+            date TEXT,
+            role TEXT,
+            status TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (telegram_id, date, role)
+        )
+        """),
+    Migration(2, "user_test_roles",
+        """
+        CREATE TABLE IF NOT EXISTS user_test_roles (
+            telegram_id INTEGER PRIMARY KEY,
+            role TEXT NOT NULL,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_test_roles (
+            telegram_id BIGINT PRIMARY KEY,
+            role TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """),
+    Migration(3, "plans_notes",
+        """
+        CREATE TABLE IF NOT EXISTS plans_notes (
+            user_id INTEGER PRIMARY KEY,
+            content TEXT,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS plans_notes (
+            user_id BIGINT PRIMARY KEY,
+            content TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """),
+    Migration(4, "plans_cards",
+        """
+        CREATE TABLE IF NOT EXISTS plans_cards (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            category TEXT NOT NULL DEFAULT 'study',
+            title TEXT NOT NULL DEFAULT '',
+            content TEXT,
+            sort_order INTEGER DEFAULT 0,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS plans_cards (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            category TEXT NOT NULL DEFAULT 'study',
+            title TEXT NOT NULL DEFAULT '',
+            content TEXT,
+            sort_order INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """),
+    Migration(5, "forum_threads",
+        """
+        CREATE TABLE IF NOT EXISTS forum_threads (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            category TEXT NOT NULL,
+            title TEXT NOT NULL,
+            content TEXT,
+            author_telegram_id INTEGER,
+            anonymous INTEGER DEFAULT 0,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS forum_threads (
+            id SERIAL PRIMARY KEY,
+            category TEXT NOT NULL,
+            title TEXT NOT NULL,
+            content TEXT,
+            author_telegram_id BIGINT,
+            anonymous INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """),
+    Migration(6, "forum_comments",
+        """
+        CREATE TABLE IF NOT EXISTS forum_comments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            thread_id INTEGER NOT NULL,
+            author_telegram_id INTEGER,
+            content TEXT NOT NULL,
+            anonymous INTEGER DEFAULT 0,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS forum_comments (
+            id SERIAL PRIMARY KEY,
+            thread_id INTEGER NOT NULL,
+            author_telegram_id BIGINT,
+            content TEXT NOT NULL,
+            anonymous INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """),
+    Migration(7, "fio_aliases",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS fio_aliases (
+                alias TEXT NOT NULL,
+                telegram_id INTEGER NOT NULL,
+                enrollment_year INTEGER,
+                PRIMARY KEY (alias, telegram_id)
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_fio_aliases_alias_year ON fio_aliases (alias, enrollment_year)",
+            "CREATE INDEX IF NOT EXISTS idx_fio_aliases_telegram_id ON fio_aliases (telegram_id)",
+        ],
+        [
+            """
+            CREATE TABLE IF NOT EXISTS fio_aliases (
+                alias TEXT NOT NULL,
+                telegram_id BIGINT NOT NULL,
+                enrollment_year INTEGER,
+                PRIMARY KEY (alias, telegram_id)
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_fio_aliases_alias_year ON fio_aliases (alias, enrollment_year)",
+            "CREATE INDEX IF NOT EXISTS idx_fio_aliases_telegram_id ON fio_aliases (telegram_id)",
+        ],
+        _backfill_fio_aliases),
+    # Строки графика привязываются к пользователю при загрузке; user_id = NULL — ФИО не сопоставлено
+    Migration(8, "duty_schedule_user_id",
+        [
+            _sqlite_add_column("duty_schedule", "user_id", "INTEGER"),
+            "CREATE INDEX IF NOT EXISTS idx_duty_user_date ON duty_schedule (user_id, date)",
+            _LINK_DUTY_SCHEDULE_SQL,
+        ],
+        [
+            "ALTER TABLE duty_schedule ADD COLUMN IF NOT EXISTS user_id BIGINT",
+            "CREATE INDEX IF NOT EXISTS idx_duty_user_date ON duty_schedule (user_id, date)",
+            _LINK_DUTY_SCHEDULE_SQL,
+        ]),
+    Migration(9, "duty_schedule_indexes", _DUTY_SCHEDULE_INDEXES, _DUTY_SCHEDULE_INDEXES),
+    # Каталог загруженных месяцев: (курс, месяц, группа) → число строк графика
+    Migration(10, "schedule_months",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS schedule_months (
+                enrollment_year INTEGER NOT NULL,
+                ym TEXT NOT NULL,
+                group_name TEXT NOT NULL,
+                row_count INTEGER NOT NULL DEFAULT 0,
+                updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (enrollment_year, ym, group_name)
+            )
+            """,
+            """
+            INSERT INTO schedule_months (enrollment_year, ym, group_name, row_count)
+            SELECT enrollment_year, substr(date, 1, 7), group_name, COUNT(*)
+            FROM duty_schedule
+            GROUP BY enrollment_year, substr(date, 1, 7), group_name
+            ON CONFLICT DO NOTHING
+            """,
+        ],
+        [
+            """
+            CREATE TABLE IF NOT EXISTS schedule_months (
+                enrollment_year INTEGER NOT NULL,
+                ym TEXT NOT NULL,
+                group_name TEXT NOT NULL,
+                row_count INTEGER NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (enrollment_year, ym, group_name)
+            )
+            """,
+            """
+            INSERT INTO schedule_months (enrollment_year, ym, group_name, row_count)
+            SELECT enrollment_year, to_char(date::date, 'YYYY-MM'), group_name, COUNT(*)
+            FROM duty_schedule
+            GROUP BY enrollment_year, to_char(date::date, 'YYYY-MM'), group_name
+            ON CONFLICT DO NOTHING
+            """,
+        ]),
+    # Версия графика курса за месяц — ключ актуальности снимков utils/schedule_snapshot.py
+    Migration(11, "schedule_versions",
+        [_SCHEDULE_VERSIONS, _SCHEDULE_VERSIONS_BACKFILL], [_SCHEDULE_VERSIONS, _SCHEDULE_VERSIONS_BACKFILL]),
+    # Предварительный план распределения на месяц (provisional = 1) фиксируется в 15:30 дня наряда
+    Migration(12, "assignments_provisional",
+        [
+            _sqlite_add_column("duty_shift_assignments", "provisional", "INTEGER NOT NULL DEFAULT 0"),
+            _sqlite_add_column("duty_canteen_assignments", "provisional", "INTEGER NOT NULL DEFAULT 0"),
+        ],
+        [
+            "ALTER TABLE duty_shift_assignments ADD COLUMN IF NOT EXISTS provisional INTEGER NOT NULL DEFAULT 0",
+            "ALTER TABLE duty_canteen_assignments ADD COLUMN IF NOT EXISTS provisional INTEGER NOT NULL DEFAULT 0",
+        ]),
+    # Запуски распределения по запросу: одна строка на (дата, роль, курс) — защита от параллельного расчёта
+    Migration(13, "distribution_runs", _DISTRIBUTION_RUNS, _DISTRIBUTION_RUNS),
+    # Агрегат истории столовой для приоритета распределения; сырая история уходит в архив
+    Migration(14, "assignment_stats",
+        [
+            _ASSIGNMENT_STATS,
+            "CREATE TABLE IF NOT EXISTS duty_assignment_history_archive AS SELECT * FROM duty_assignment_history WHERE 1 = 0",
+        ],
+        [
+            # В schema_postgres.sql таблицы истории не было — движку распределения она нужна
+            """
+            CREATE TABLE IF NOT EXISTS duty_assignment_history (
+                id SERIAL PRIMARY KEY,
+                fio TEXT NOT NULL,
+                date TEXT NOT NULL,
+                role TEXT NOT NULL,
+                sub_object TEXT,
+                shift INTEGER,
+                enrollment_year INTEGER NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_assign_history_fio ON duty_assignment_history (fio, role)",
+            _ASSIGNMENT_STATS,
+            "CREATE TABLE IF NOT EXISTS duty_assignment_history_archive AS SELECT * FROM duty_assignment_history WHERE 1 = 0",
+        ],
+        _backfill_assignment_stats),
+    # Леджер очков рейтинга по месяцам и за всё время — обновляется при правке графика (utils/points.py)
+    Migration(15, "user_points", _USER_POINTS, _USER_POINTS, _backfill_user_points),
+    # Материализованные топы по курсу и институту за месяц и за всё время; ежедневные снимки мест
+    Migration(16, "leaderboards", _LEADERBOARDS, _LEADERBOARDS, _backfill_leaderboards),
+    # Версии для месяцев, которые были в каталоге, когда миграция 11 уже применилась без заполнения
+    Migration(17, "schedule_versions_backfill", _SCHEDULE_VERSIONS_BACKFILL, _SCHEDULE_VERSIONS_BACKFILL),
+    # Роли в графике и подтверждениях — в нижнем регистре, как их пишет загрузка: очки считаются по одному ключу
+    Migration(18, "duty_roles_lowercase",
+        [_sqlite_lower_roles("duty_schedule"), _sqlite_lower_roles("duty_confirmations")],
+        [
+            "UPDATE duty_schedule SET role = lower(role) WHERE role <> lower(role)",
+            """
+            DELETE FROM duty_confirmations c
+            WHERE c.role <> lower(c.role)
+              AND EXISTS (SELECT 1 FROM duty_confirmations d
+                          WHERE d.telegram_id = c.telegram_id AND d.date = c.date AND d.role = lower(c.role))
+            """,
+            "UPDATE duty_confirmations SET role = lower(role) WHERE role <> lower(role)",
+        ],
+        _rebuild_points),
+]
+
+
+def run_migrations(conn):
+    """Применяет ещё не применённые миграции по порядку; номер каждой записывается в schema_migrations.
+    conn — sqlite3-соединение или соединение из db.get_db(). Возвращает список применённых версий."""
+    is_pg = getattr(conn, "_is_pg", False)
+    ph = "%s" if is_pg else "?"
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.commit()
+    cur.execute("SELECT version FROM schema_migrations")
+    done = {row["version"] for row in cur.fetchall()}
+    applied = []
+    for m in MIGRATIONS:
+        if m.version in done:
+            continue
+        sql = m.pg if is_pg else m.sqlite
+        for stmt in (sql if isinstance(sql, (list, tuple)) else [sql]):
+            if callable(stmt):
+                stmt(cur)
+            else:
+                cur.execute(stmt)
+        if m.after:
+            m.after(conn)
+        # Бот и сервер могут стартовать одновременно — повторная запись версии не ошибка
+        cur.execute(
+            f"INSERT INTO schema_migrations (version, name) VALUES ({ph}, {ph}) ON CONFLICT (version) DO NOTHING",
+            (m.version, m.name)
+        )
+        conn.commit()
+        applied.append(m.version)
+    return applied
@@ -102,8 +102,11 @@ CREATE TABLE IF NOT EXISTS duty_schedule (
     gender TEXT DEFAULT 'male',
     UNIQUE(fio, date, enrollment_year)
 );
-CREATE INDEX IF NOT EXISTS idx_duty_date ON duty_schedule (date);
-CREATE INDEX IF NOT EXISTS idx_duty_group_year ON duty_schedule (group_name, enrollment_year);
+-- Составные индексы под запросы server.py (те же, что в миграции 9 migrations.py)
+CREATE INDEX IF NOT EXISTS idx_duty_date_role_year ON duty_schedule (date, role, enrollment_year, group_name, fio);
+CREATE INDEX IF NOT EXISTS idx_duty_year_date ON duty_schedule (enrollment_year, date);
+CREATE INDEX IF NOT EXISTS idx_duty_group_year_date ON duty_schedule (group_name, enrollment_year, date);
+CREATE INDEX IF NOT EXISTS idx_duty_fio_year_date ON duty_schedule (fio, enrollment_year, date);
 
 CREATE TABLE IF NOT EXISTS duty_shift_assignments (
     id SERIAL PRIMARY KEY,
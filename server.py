@@ -1,5 +1,6 @@
 # server.py — FastAPI сервер для Mini App (финальная версия, с исправлением группы и опросником)
 
+import hashlib
 import traceback
 
 from fastapi import FastAPI, HTTPException, UploadFile, File, Form
@@ -19,13 +20,26 @@ import time
 import urllib.request
 import json
 
-from db import get_db, execute, DBIntegrityError
+from db import get_db, connection, transaction, execute, execute_many, run_db, table_columns, DBIntegrityError
 
 # Admin ID для автоматической роли при регистрации
 ADMIN_TELEGRAM_ID = int(os.getenv("ADMIN_ID", "1027070834"))
 
 # Импортируем функцию расчёта курса
 from utils.course_calculator import get_current_course
+from utils.fio import refresh_user_fio_aliases, resolve_fio_user_ids
+from utils import duty_queries
+from utils.schedule_snapshot import get_month_snapshot, bump_schedule_version, with_telegram_ids
+from utils.points import (
+    refresh_course_month_points, rebuild_user_points, rebuild_leaderboards, snapshot_ranks,
+    ALL_PERIOD, SCOPE_COURSE, SCOPE_INSTITUTE, RANK_HISTORY_DAYS,
+)
+from utils.achievements import evaluate_achievements, achievement_ownership
+from utils.distribution import (
+    distribute_shifts_for_date, distribute_canteen_for_date, distribute_pending_for_date, ensure_distributed,
+    past_freeze_time, plan_month, plan_upcoming, replan_date, archive_assignment_history, rebuild_assignment_stats,
+    ASSIGNMENT_HISTORY_DAYS,
+)
 # apex_parser импортируем лениво в _get_apex_parser(), чтобы сервер стартовал даже без APEX_USER/PASS
 
 app = FastAPI()
@@ -69,7 +83,8 @@ class ForceCORSHeadersMiddleware(BaseHTTPMiddleware):
                 "Access-Control-Allow-Origin": origin,
                 "Access-Control-Allow-Credentials": "true",
                 "Access-Control-Allow-Methods": "GET, POST, PATCH, PUT, DELETE, OPTIONS",
-                "Access-Control-Allow-Headers": "Content-Type, Authorization, Accept",
+                "Access-Control-Allow-Headers": "Content-Type, Authorization, Accept, If-None-Match",
+                "Access-Control-Expose-Headers": "ETag",
                 "Access-Control-Max-Age": "86400",
             }
 
@@ -160,9 +175,28 @@ async def debug_info():
     return info
 
 
+@app.get("/api/debug/queries")
+async def debug_queries(telegram_id: int, limit: int = 50, order_by: str = "total_ms", reset: int = 0):
+    """
+    Статистика SQL-запросов (только админ): вызовы, время total/p50/p99, строки.
+    Собирается при DB_QUERY_STATS=1; order_by: total_ms | count | p99_ms | rows; reset=1 — обнулить после выдачи.
+    """
+    if _user_role_from_db(telegram_id) != "admin":
+        raise HTTPException(status_code=403, detail="Доступ только для админа")
+    import db as db_module
+    result = {
+        "enabled": db_module.DB_QUERY_STATS,
+        "slow_query_ms": db_module.DB_SLOW_QUERY_MS,
+        "queries": db_module.query_stats(limit=limit, order_by=order_by),
+    }
+    if reset == 1:
+        db_module.reset_query_stats()
+    return result
+
+
 @app.on_event("startup")
 async def startup_init_db():
-    """При старте сервера создаём таблицы и объекты для опроса (только для SQLite)."""
+    """При старте сервера применяем миграции схемы; для SQLite ещё создаём таблицы и объекты для опроса."""
     try:
         import db as db_module
         if not getattr(db_module, "USE_POSTGRES", False):
@@ -171,9 +205,19 @@ async def startup_init_db():
             database.init_db()
             database.init_survey_objects()
             database.ensure_female_survey_objects()
+        else:
+            # Для SQLite миграции выполняет database.init_db()
+            from migrations import run_migrations
+            with connection() as conn:
+                run_migrations(conn)
+        # Миграции могли добавить таблицы и колонки — кэш схемы строится заново
+        db_module.invalidate_schema_cache()
     except Exception as e:
         print(f"[WARN] Инициализация БД при старте: {e}")
 
+    # План распределения по сменам и объектам на месяц вперёд и его фиксация в 15:30
+    threading.Thread(target=_duty_planner_loop, daemon=True).start()
+
     # Запуск фонового планировщика напоминаний о задачах (не зависит от процесса бота)
     if BOT_TOKEN:
         thread = threading.Thread(target=_task_reminders_loop, daemon=True)
@@ -204,25 +248,6 @@ def get_full_role(role_code: str) -> str:
     return ROLE_NAMES.get(role_code.lower(), role_code.upper())
 
 
-def _fio_match_variants(full_fio: str) -> list:
-    """Строит варианты ФИО для сопоставления: полное и в виде инициалов (Граков В.А.)."""
-    if not full_fio or not full_fio.strip():
-        return []
-    parts = [p.strip() for p in full_fio.strip().split() if p.strip()]
-    if not parts:
-        return []
-    variants = [full_fio.strip()]
-    if len(parts) >= 3:
-        surname, name, patronymic = parts[0], parts[1], parts[2]
-        variants.append(f"{surname} {name[0]}.{patronymic[0]}.")
-        variants.append(f"{surname} {name[0]}.{patronymic[0]}")
-        variants.append(f"{surname} {name[0]} {patronymic[0]}")
-        variants.append(f"{surname} {name[0]}. {patronymic[0]}.")
-    elif len(parts) == 2:
-        variants.append(f"{parts[0]} {parts[1][0]}.")
-    return list(dict.fromkeys(variants))
-
-
 def _get_duty_points_map(conn) -> dict:
     """Роль (код) -> очки по опросу. Основные наряды: Курс, ГБР, Столовая, ЗУБ."""
     role_to_name = {'к': 'Курс', 'гбр': 'ГБР', 'с': 'Столовая', 'зуб': 'ЗУБ'}
@@ -251,6 +276,46 @@ def _create_schedule_notification(conn, group_name: str, enrollment_year: int, t
         print(f"[WARN] _create_schedule_notification: {e}")
 
 
+def _refresh_schedule_months(conn, enrollment_year: int, ym: str):
+    """Пересчитать каталог schedule_months курса за месяц YYYY-MM после изменения duty_schedule
+    , поднять версию графика (сбрасывает снимки месяца), пересчитать очки курса в user_points
+    и проверить достижения тех, чьи очки или места изменились. Коммит — на вызывающем."""
+    y, m = int(ym[:4]), int(ym[5:7])
+    month_end = f"{y + 1}-01-01" if m == 12 else f"{y}-{m + 1:02d}-01"
+    execute(conn, "DELETE FROM schedule_months WHERE enrollment_year = ? AND ym = ?", (enrollment_year, ym))
+    execute(conn, duty_queries.REFRESH_MONTH_CATALOG, (ym, enrollment_year, ym + "-01", month_end))
+    bump_schedule_version(conn, enrollment_year, ym)
+    changed = refresh_course_month_points(conn, enrollment_year, ym)
+    if changed:
+        evaluate_achievements(conn, changed)
+
+
+def _replan_after_edit(conn, enrollment_year: int, date: str):
+    """Правка графика на дату: пересчитать предварительный план распределения (ошибка не срывает правку)."""
+    try:
+        replan_date(conn, enrollment_year, date)
+    except Exception as e:
+        print(f"[WARN] Пересчёт плана распределения на {date}: {e}")
+
+
+def _iso_month(date: str):
+    """YYYY-MM для даты YYYY-MM-DD, иначе None."""
+    try:
+        return datetime.strptime(date, "%Y-%m-%d").strftime("%Y-%m")
+    except (TypeError, ValueError):
+        return None
+
+
+def _etag_response(request: Request, payload):
+    """JSON-ответ с сильным ETag (хэш тела); при совпадении с If-None-Match — 304 без тела."""
+    body = json.dumps(payload, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+    etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag in [t.strip() for t in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
 def _send_telegram_message(chat_id: int, text: str) -> bool:
     """Отправляет сообщение в Telegram через Bot API. Возвращает True при успехе."""
     if not BOT_TOKEN:
@@ -286,11 +351,16 @@ def _run_task_reminders_once():
         for row in rows:
             task_id = row["id"]
             user_id = row["user_id"]
+            # Ту же задачу может напомнить и бот: отправленную им за время прохода пропускаем
+            current = execute(conn, "SELECT reminded FROM tasks WHERE id = ?", (task_id,)).fetchone()
+            if not current or current["reminded"]:
+                continue
             text = (row["text"] or "").strip()
             msg = f"⏰ <b>Время выполнить задачу!</b>\n\n{text}"
             if _send_telegram_message(user_id, msg):
-                execute(conn,"UPDATE tasks SET reminded = 1 WHERE id = ?", (task_id,))
-                conn.commit()
+                # Отметка сразу после отправки, короткой транзакцией — второй процесс видит её до конца прохода
+                with transaction(conn):
+                    execute(conn, "UPDATE tasks SET reminded = 1 WHERE id = ?", (task_id,))
                 print(f"[REMINDER] Задача {task_id} → {user_id}")
     except Exception as e:
         print(f"[REMINDER] Ошибка: {e}")
@@ -298,6 +368,52 @@ def _run_task_reminders_once():
         conn.close()
 
 
+def _run_duty_planner_once(state: dict):
+    """Один проход планировщика распределения: раз в день — план на текущий и следующий месяц, архив старой истории
+    и снимок мест рейтинга на начало дня, с 15:30 — фиксация плана на сегодня и распределение нарядов,
+    которых в плане нет."""
+    now = datetime.now()
+    today = now.strftime("%Y-%m-%d")
+    conn = get_db()
+    if not conn:
+        return
+    try:
+        if state.get("planned") != today:
+            for ey, ym, count in plan_upcoming(conn, now):
+                print(f"[PLANNER] План {ym} (курс {ey}): {count} назначений")
+            archived = archive_assignment_history(
+                conn, (now - timedelta(days=ASSIGNMENT_HISTORY_DAYS)).strftime("%Y-%m-%d"))
+            if archived:
+                print(f"[PLANNER] В архив истории назначений: {archived}")
+            state["planned"] = today
+        if state.get("ranked") != today:
+            # Сверка топов со статусами пользователей, достижения и снимок мест за текущий месяц и за всё время
+            with transaction(conn):
+                rebuild_leaderboards(conn, [now.strftime("%Y-%m")])
+                unlocked = evaluate_achievements(conn)
+                written = snapshot_ranks(conn, today, [now.strftime("%Y-%m"), ALL_PERIOD],
+                                         (now - timedelta(days=RANK_HISTORY_DAYS)).strftime("%Y-%m-%d"))
+            print(f"[PLANNER] Снимок мест рейтинга: {written}, новых достижений: {unlocked}")
+            state["ranked"] = today
+        if state.get("frozen") != today and past_freeze_time(today, now):
+            for ey, role, count in distribute_pending_for_date(conn, today):
+                print(f"[PLANNER] Распределение {role} на {today} (курс {ey}): {count} назначений")
+            state["frozen"] = today
+    finally:
+        conn.close()
+
+
+def _duty_planner_loop():
+    """Фоновый цикл планировщика распределения (раз в минуту)."""
+    state = {}
+    while True:
+        try:
+            _run_duty_planner_once(state)
+        except Exception as e:
+            print(f"[PLANNER] Цикл: {e}")
+        time.sleep(60)
+
+
 def _task_reminders_loop():
     """Фоновый цикл: каждые 30 сек проверяет дедлайны задач и отправляет напоминания."""
     while True:
@@ -344,8 +460,7 @@ async def register_user(data: dict):
         raise HTTPException(status_code=500, detail="База данных не найдена")
 
     try:
-        cursor = execute(conn, "PRAGMA table_info(users)")
-        cols = [r["name"] for r in cursor.fetchall()]
+        cols = table_columns(conn, "users")
         name_col = "fio" if "fio" in cols else "full_name"
         group_col = "group_name" if "group_name" in cols else ("group_num" if "group_num" in cols else None)
         faculty_col = "faculty" if "faculty" in cols else None
@@ -384,6 +499,7 @@ async def register_user(data: dict):
                 values.append(role_val)
             execute(conn, f"INSERT INTO users ({', '.join(insert_cols)}) VALUES ({', '.join(placeholders)})", values)
 
+        refresh_user_fio_aliases(conn, telegram_id)
         conn.commit()
         return {"status": "ok", "message": "Пользователь зарегистрирован"}
     except Exception as e:
@@ -402,8 +518,7 @@ async def get_user(telegram_id: int):
 
     try:
         # --- Узнаём, какие колонки есть в таблице users ---
-        cursor = execute(conn,"PRAGMA table_info(users)")
-        columns = [row['name'] for row in cursor.fetchall()]
+        columns = table_columns(conn, "users")
         print(f"[INFO] Колонки в users: {columns}")
 
         # --- Определяем имя поля с ФИО ---
@@ -428,8 +543,7 @@ async def get_user(telegram_id: int):
         else:
             select_parts.append("'' as group_name")
         try:
-            cursor = execute(conn,"PRAGMA table_info(users)")
-            cols = [r['name'] for r in cursor.fetchall()]
+            cols = table_columns(conn, "users")
             if 'role' in cols:
                 select_parts.append("role")
         except Exception:
@@ -482,8 +596,7 @@ async def update_user(data: dict):
     if not conn:
         raise HTTPException(status_code=500, detail="База данных не найдена")
     try:
-        cursor = execute(conn,"PRAGMA table_info(users)")
-        cols = [r["name"] for r in cursor.fetchall()]
+        cols = table_columns(conn, "users")
         updates = []
         params = []
         if fio is not None and str(fio).strip():
@@ -509,6 +622,7 @@ async def update_user(data: dict):
             f"UPDATE users SET {', '.join(updates)}, updated_at = CURRENT_TIMESTAMP WHERE telegram_id = ?",
             params
         )
+        refresh_user_fio_aliases(conn, telegram_id)
         conn.commit()
         return {"status": "ok"}
     except Exception as e:
@@ -527,7 +641,6 @@ async def get_profile_duty_stats(telegram_id: int):
     try:
         user = execute(conn,"SELECT fio FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
         if not user:
-            conn.close()
             return {"times_sick": 0, "times_replaced": 0}
         fio = (user["fio"] or "").strip()
         times_sick_replace = execute(conn,
@@ -542,11 +655,12 @@ async def get_profile_duty_stats(telegram_id: int):
             "SELECT COUNT(*) FROM duty_replacements WHERE fio_replacement = ?",
             (fio,)
         ).fetchone()[0]
-        conn.close()
         return {"times_sick": times_sick_replace + times_sick_self, "times_replaced": times_replaced}
     except Exception as e:
         print(f"[ERROR] duty-stats: {e}")
         raise HTTPException(status_code=500, detail="Ошибка загрузки статистики")
+    finally:
+        conn.close()
 
 
 @app.post("/api/sick-leave/report")
@@ -567,11 +681,12 @@ async def report_sick_leave(data: dict):
             (telegram_id, report_date)
         )
         conn.commit()
-        conn.close()
         return {"status": "ok", "message": "Больничный учтён"}
     except Exception as e:
         print(f"[ERROR] sick-leave report: {e}")
         raise HTTPException(status_code=500, detail="Ошибка сохранения")
+    finally:
+        conn.close()
 
 
 def _user_role_for_forum(telegram_id: int):
@@ -580,13 +695,6 @@ def _user_role_for_forum(telegram_id: int):
     if not conn:
         return None
     try:
-        execute(conn, """
-            CREATE TABLE IF NOT EXISTS user_test_roles (
-                telegram_id INTEGER PRIMARY KEY,
-                role TEXT NOT NULL,
-                updated_at TEXT DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
         row = execute(conn, "SELECT role FROM user_test_roles WHERE telegram_id = ?", (telegram_id,)).fetchone()
         if row and row["role"]:
             return row["role"]
@@ -598,11 +706,10 @@ def _user_role_for_forum(telegram_id: int):
 
 def _user_role_from_db(telegram_id: int):
     """Роль из БД (admin, assistant, sergeant, user)."""
-    conn = get_db()
-    if not conn:
-        return None
-    row = execute(conn,"SELECT role FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
-    conn.close()
+    with connection() as conn:
+        if not conn:
+            return None
+        row = execute(conn,"SELECT role FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
     return row["role"] if row else None
 
 
@@ -621,14 +728,13 @@ async def list_users(
     if not conn:
         raise HTTPException(status_code=500, detail="База данных не найдена")
     try:
-        name_col = "fio" if "fio" in [r["name"] for r in execute(conn,"PRAGMA table_info(users)").fetchall()] else "full_name"
+        name_col = "fio" if "fio" in table_columns(conn, "users") else "full_name"
         if role == "assistant":
             row = execute(conn,
                 "SELECT enrollment_year, group_name FROM users WHERE telegram_id = ?",
                 (actor_telegram_id,)
             ).fetchone()
             if not row:
-                conn.close()
                 return {"users": []}
             ayear, agroup = row["enrollment_year"], row["group_name"]
             query = f"""
@@ -668,11 +774,12 @@ async def list_users(
             }
             for r in rows
         ]
-        conn.close()
         return {"users": users}
     except Exception as e:
         print(f"[ERROR] list_users: {e}")
         raise HTTPException(status_code=500, detail="Ошибка списка пользователей")
+    finally:
+        conn.close()
 
 
 @app.post("/api/users/set-role")
@@ -687,72 +794,84 @@ async def set_user_role(data: dict):
     conn = get_db()
     if not conn:
         raise HTTPException(status_code=500, detail="База данных не найдена")
-    if actor_role == "admin":
-        pass  # может назначать без ограничений
-    elif actor_role == "assistant":
-        a_row = execute(conn,"SELECT enrollment_year FROM users WHERE telegram_id = ?", (actor_id,)).fetchone()
-        t_row = execute(conn,"SELECT enrollment_year, group_name FROM users WHERE telegram_id = ?", (target_id,)).fetchone()
-        if not a_row or not t_row or a_row["enrollment_year"] != t_row["enrollment_year"]:
-            conn.close()
-            raise HTTPException(status_code=403, detail="Можно менять только пользователей своего курса")
-        if new_role == "assistant":
-            cnt = execute(conn,
-                "SELECT COUNT(*) FROM users WHERE enrollment_year = ? AND role = 'assistant'",
-                (t_row["enrollment_year"],)
-            ).fetchone()[0]
-            if cnt >= 6:
-                conn.close()
-                raise HTTPException(status_code=403, detail="На курсе уже 6 помощников (лимит)")
-        elif new_role == "sergeant":
-            grp = t_row["group_name"] or ""
-            cnt = execute(conn,
-                "SELECT COUNT(*) FROM users WHERE group_name = ? AND role = 'sergeant'",
-                (grp,)
-            ).fetchone()[0]
-            if cnt >= 4:
-                conn.close()
-                raise HTTPException(status_code=403, detail="В группе уже 4 сержанта (лимит)")
-    else:
-        conn.close()
-        raise HTTPException(status_code=403, detail="Недостаточно прав")
     try:
-        execute(conn,"UPDATE users SET role = ?, updated_at = CURRENT_TIMESTAMP WHERE telegram_id = ?", (new_role, target_id))
-        conn.commit()
+        if actor_role == "admin":
+            pass  # может назначать без ограничений
+        elif actor_role == "assistant":
+            a_row = execute(conn,"SELECT enrollment_year FROM users WHERE telegram_id = ?", (actor_id,)).fetchone()
+            t_row = execute(conn,"SELECT enrollment_year, group_name FROM users WHERE telegram_id = ?", (target_id,)).fetchone()
+            if not a_row or not t_row or a_row["enrollment_year"] != t_row["enrollment_year"]:
+                raise HTTPException(status_code=403, detail="Можно менять только пользователей своего курса")
+            if new_role == "assistant":
+                cnt = execute(conn,
+                    "SELECT COUNT(*) FROM users WHERE enrollment_year = ? AND role = 'assistant'",
+                    (t_row["enrollment_year"],)
+                ).fetchone()[0]
+                if cnt >= 6:
+                    raise HTTPException(status_code=403, detail="На курсе уже 6 помощников (лимит)")
+            elif new_role == "sergeant":
+                grp = t_row["group_name"] or ""
+                cnt = execute(conn,
+                    "SELECT COUNT(*) FROM users WHERE group_name = ? AND role = 'sergeant'",
+                    (grp,)
+                ).fetchone()[0]
+                if cnt >= 4:
+                    raise HTTPException(status_code=403, detail="В группе уже 4 сержанта (лимит)")
+        else:
+            raise HTTPException(status_code=403, detail="Недостаточно прав")
+        try:
+            execute(conn,"UPDATE users SET role = ?, updated_at = CURRENT_TIMESTAMP WHERE telegram_id = ?", (new_role, target_id))
+            conn.commit()
+            return {"status": "ok", "role": new_role}
+        except Exception as e:
+            print(f"[ERROR] set_user_role: {e}")
+            raise HTTPException(status_code=500, detail="Ошибка назначения роли")
+    finally:
         conn.close()
-        return {"status": "ok", "role": new_role}
-    except Exception as e:
-        print(f"[ERROR] set_user_role: {e}")
-        raise HTTPException(status_code=500, detail="Ошибка назначения роли")
 
 
 # ============================================
 # 2. НАРЯДЫ ПОЛЬЗОВАТЕЛЯ
 # ============================================
-@app.get("/api/duties")
-async def get_duties(telegram_id: int, month: str = None, year: int = None):
-    """
-    Получает наряды пользователя.
-    Если указаны month и year - возвращает наряды за конкретный месяц.
-    Иначе возвращает все наряды и ближайший.
-    """
+def _month_duty_rows(conn, telegram_id: int, month_start: str, month_end: str):
+    """Наряды пользователя за месяц из снимков графика — в том же виде, что и строки запроса по всем месяцам
+    (наряд × участник). Из БД читаются только курсы его строк графика и его подтверждения."""
+    ym = month_start[:7]
+    years = execute(conn, duty_queries.USER_MONTH_YEARS, (telegram_id, month_start, month_end)).fetchall()
+    if not years:
+        return []
+    confirmations = {
+        (r["date"], r["role"]): r["status"]
+        for r in execute(conn, """
+            SELECT date, role, status FROM duty_confirmations
+            WHERE telegram_id = ? AND date >= ? AND date < ?
+        """, (telegram_id, month_start, month_end)).fetchall()
+    }
+    mine = []
+    for y in years:
+        snap = get_month_snapshot(conn, y["enrollment_year"], ym)
+        mine += [(d, snap) for d in snap.by_person.get(telegram_id, [])]
+    mine.sort(key=lambda item: item[0])
+    rows = []
+    for (date, role, fio, group_name), snap in mine:
+        for p in snap.by_date[date][role]:
+            rows.append({
+                "my_fio": fio, "date": date, "role": role, "group_name": group_name,
+                "enrollment_year": snap.enrollment_year,
+                "partner_fio": p["fio"], "partner_group": p["group"],
+                "confirmation_status": confirmations.get((date, role)),
+            })
+    return rows
+
+
+def _get_duties(telegram_id: int, month: str = None, year: int = None):
     conn = get_db()
     if not conn:
         return {"error": "База данных не найдена"}
 
     try:
-        execute(conn, """
-            CREATE TABLE IF NOT EXISTS duty_confirmations (
-                telegram_id INTEGER,
-                date TEXT,
-                role TEXT,
-                status TEXT NOT NULL,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                PRIMARY KEY (telegram_id, date, role)
-            )
-        """)
         # --- Определяем, как называется колонка с ФИО в users (fio или full_name) ---
-        cursor = execute(conn, "PRAGMA table_info(users)")
-        columns = [row["name"] for row in cursor.fetchall()]
+        columns = table_columns(conn, "users")
         if "fio" in columns:
             name_col = "fio"
         elif "full_name" in columns:
@@ -774,17 +893,16 @@ async def get_duties(telegram_id: int, month: str = None, year: int = None):
         conn.close()
         return {"error": "Пользователь не найден"}
 
-    # ФИО из users — в Excel (duty_schedule) должно быть то же написание
-    user_fio = user["fio"]
+    # ФИО в Excel (duty_schedule) сопоставляется с пользователем через fio_aliases (полное ФИО и инициалы)
 
     try:
         # Проверяем, какая таблица используется
         # Сначала пробуем duty_schedule (новая структура)
         try:
-            cursor = execute(conn,"PRAGMA table_info(duty_schedule)")
-            schedule_columns = [row['name'] for row in cursor.fetchall()]
+            schedule_columns = table_columns(conn, "duty_schedule")
             if schedule_columns:
                 # Используем duty_schedule
+                month_start = month_end = None
                 if month is not None and year is not None:
                     # Фильтр по месяцу (month/year могут прийти строками из query)
                     try:
@@ -798,82 +916,47 @@ async def get_duties(telegram_id: int, month: str = None, year: int = None):
                             month_end = f"{y + 1}-01-01"
                         else:
                             month_end = f"{y}-{m + 1:02d}-01"
-                    else:
-                        month_start = month_end = None
-                    if month_start and month_end:
-                        fio_variants = _fio_match_variants(user_fio) or [user_fio or ""]
-                        placeholders = ",".join(["?"] * len(fio_variants))
-                        query = f"""
-                            SELECT date, role, group_name, enrollment_year
-                            FROM duty_schedule
-                            WHERE fio IN ({placeholders}) AND date >= ? AND date < ?
-                            ORDER BY date
-                        """
-                        rows = execute(conn,query, (*fio_variants, month_start, month_end)).fetchall()
-                    else:
-                        fio_variants = _fio_match_variants(user_fio) or [user_fio or ""]
-                        placeholders = ",".join(["?"] * len(fio_variants))
-                        rows = execute(conn,
-                            f"SELECT date, role, group_name, enrollment_year FROM duty_schedule WHERE fio IN ({placeholders}) ORDER BY date",
-                            tuple(fio_variants),
-                        ).fetchall()
+                if month_start and month_end:
+                    rows = _month_duty_rows(conn, telegram_id, month_start, month_end)
                 else:
-                    fio_variants = _fio_match_variants(user_fio) or [user_fio or ""]
-                    placeholders = ",".join(["?"] * len(fio_variants))
-                    query = f"""
-                        SELECT date, role, group_name, enrollment_year
-                        FROM duty_schedule
-                        WHERE fio IN ({placeholders})
-                        ORDER BY date
-                    """
-                    rows = execute(conn,query, tuple(fio_variants)).fetchall()
-                
+                    # Один проход: наряды пользователя + все участники того же наряда + статус подтверждения.
+                    # Строки одного наряда идут подряд — собираем их в памяти.
+                    rows = execute(conn, duty_queries.USER_DUTIES_WITH_PARTNERS, (telegram_id, telegram_id)).fetchall()
+
                 duties_list = []
                 points_map = _get_duty_points_map(conn)
+                now = datetime.now()
+                today_str = now.strftime("%Y-%m-%d")
+                cutoff = now.replace(hour=15, minute=30, second=0, microsecond=0)
+                current_key = None
                 for row in rows:
-                    # Получаем участников наряда на эту дату
-                    partners_query = """
-                        SELECT fio, group_name
-                        FROM duty_schedule
-                        WHERE date = ? AND role = ? AND enrollment_year = ?
-                        ORDER BY group_name, fio
-                    """
-                    partners = execute(conn,partners_query, (row['date'], row['role'], row['enrollment_year'])).fetchall()
-                    role_lower = (row['role'] or '').strip().lower()
-                    points = points_map.get(role_lower, 10)
-                    conf = None
-                    try:
-                        cc = execute(conn, "SELECT status FROM duty_confirmations WHERE telegram_id = ? AND date = ? AND role = ?",
-                            (telegram_id, row['date'], row['role'])).fetchone()
-                        if cc:
-                            conf = cc["status"]
-                    except Exception:
-                        pass
-                    today_str = datetime.now().strftime("%Y-%m-%d")
-                    now = datetime.now()
-                    cutoff = now.replace(hour=15, minute=30, second=0, microsecond=0) if now.date() == datetime.strptime(row['date'], "%Y-%m-%d").date() else None
-                    can_confirm = (row['date'] == today_str and (not cutoff or now < cutoff) and conf is None)
-                    duties_list.append({
-                        "date": row['date'],
-                        "role": row['role'],
-                        "role_full": get_full_role(row['role']),
-                        "group": row['group_name'],
-                        "partners": [{"fio": p['fio'], "group": p['group_name']} for p in partners],
-                        "points": points,
-                        "confirmation_status": conf,
-                        "can_confirm": can_confirm,
-                    })
-                
+                    key = (row['my_fio'], row['date'], row['role'], row['enrollment_year'])
+                    if key != current_key:
+                        current_key = key
+                        role_lower = (row['role'] or '').strip().lower()
+                        conf = row['confirmation_status']
+                        can_confirm = (row['date'] == today_str and now < cutoff and conf is None)
+                        duties_list.append({
+                            "date": row['date'],
+                            "role": row['role'],
+                            "role_full": get_full_role(row['role']),
+                            "group": row['group_name'],
+                            "partners": [],
+                            "points": points_map.get(role_lower, 10),
+                            "confirmation_status": conf,
+                            "can_confirm": can_confirm,
+                        })
+                    duties_list[-1]["partners"].append({"fio": row['partner_fio'], "group": row['partner_group']})
+
                 conn.close()
-                
+
                 # Ближайший наряд (если не указан месяц)
                 if not month:
-                    today = datetime.now().strftime("%Y-%m-%d")
-                    upcoming = [d for d in duties_list if d['date'] >= today]
+                    upcoming = [d for d in duties_list if d['date'] >= today_str]
                     next_duty = upcoming[0] if upcoming else None
                 else:
                     next_duty = None
-                
+
                 return {
                     "duties": duties_list,
                     "next_duty": next_duty,
@@ -884,8 +967,7 @@ async def get_duties(telegram_id: int, month: str = None, year: int = None):
 
         # Если duty_schedule не работает, пробуем duties (старая структура)
         try:
-            cursor = execute(conn,"PRAGMA table_info(duties)")
-            columns = [row['name'] for row in cursor.fetchall()]
+            columns = table_columns(conn, "duties")
         except Exception:
             conn.close()
             return {
@@ -959,12 +1041,20 @@ async def get_duties(telegram_id: int, month: str = None, year: int = None):
     }
 
 
-@app.get("/api/duties/by-date")
-async def get_duties_by_date(date: str, telegram_id: int = 0):
+@app.get("/api/duties")
+async def get_duties(request: Request, telegram_id: int, month: str = None, year: int = None):
     """
-    Возвращает всех участников наряда на конкретную дату.
-    Если telegram_id передан — фильтрует по курсу (enrollment_year) пользователя.
+    Получает наряды пользователя.
+    Если указаны month и year - возвращает наряды за конкретный месяц (из снимка графика курса).
+    Иначе возвращает все наряды и ближайший.
     """
+    result = await run_db(_get_duties, telegram_id, month, year)
+    if "error" in result:
+        return result
+    return _etag_response(request, result)
+
+
+def _get_duties_by_date(date: str, telegram_id: int = 0):
     conn = get_db()
     if not conn:
         return {"error": "База данных не найдена"}
@@ -976,32 +1066,23 @@ async def get_duties_by_date(date: str, telegram_id: int = 0):
             if user:
                 ey = user["enrollment_year"]
 
-        if ey:
-            query = """
-                SELECT fio, role, group_name, enrollment_year, gender
-                FROM duty_schedule
-                WHERE date = ? AND enrollment_year = ?
-                ORDER BY role, group_name, fio
-            """
-            rows = execute(conn,query, (date, ey)).fetchall()
+        if ey and _iso_month(date):
+            snap_roles = get_month_snapshot(conn, ey, _iso_month(date)).by_date.get(date, {})
+            people = iter(with_telegram_ids(conn, [p for role_people in snap_roles.values() for p in role_people]))
+            by_role = {role: [next(people) for _ in role_people] for role, role_people in snap_roles.items()}
+            return {
+                "date": date,
+                "by_role": by_role,
+                "total": sum(len(people) for people in by_role.values())
+            }
         else:
-            query = """
-                SELECT fio, role, group_name, enrollment_year, gender
-                FROM duty_schedule
-                WHERE date = ?
-                ORDER BY role, group_name, fio
-            """
-            rows = execute(conn,query, (date,)).fetchall()
-        fio_to_tg = {}
-        for r in execute(conn, "SELECT fio, telegram_id FROM users WHERE status = 'активен'").fetchall():
-            for v in (_fio_match_variants(r["fio"]) if r["fio"] else []) or [r["fio"]]:
-                fio_to_tg[v] = r["telegram_id"]
+            rows = execute(conn, duty_queries.DUTIES_ON_DATE, (date,)).fetchall()
         by_role = {}
         for row in rows:
             role = row['role']
             if role not in by_role:
                 by_role[role] = []
-            tid = fio_to_tg.get(row['fio'])
+            tid = row['telegram_id']
             by_role[role].append({
                 "fio": row['fio'],
                 "group": row['group_name'],
@@ -1022,6 +1103,18 @@ async def get_duties_by_date(date: str, telegram_id: int = 0):
         if conn:
             conn.close()
 
+
+@app.get("/api/duties/by-date")
+async def get_duties_by_date(request: Request, date: str, telegram_id: int = 0):
+    """
+    Возвращает всех участников наряда на конкретную дату.
+    Если telegram_id передан — фильтрует по курсу (enrollment_year) пользователя.
+    """
+    result = await run_db(_get_duties_by_date, date, telegram_id)
+    if "error" in result:
+        return result
+    return _etag_response(request, result)
+
 @app.get("/api/duties/available-months")
 async def get_available_months(telegram_id: int):
     """Возвращает список месяцев (YYYY-MM), для которых есть загруженные графики в рамках курса пользователя."""
@@ -1036,8 +1129,7 @@ async def get_available_months(telegram_id: int):
             return {"months": []}
         ey = user["enrollment_year"]
         rows = execute(conn, """
-            SELECT DISTINCT substr(date, 1, 7) as ym
-            FROM duty_schedule
+            SELECT DISTINCT ym FROM schedule_months
             WHERE enrollment_year = ?
             ORDER BY ym
         """, (ey,)).fetchall()
@@ -1107,9 +1199,7 @@ async def get_schedule_uploads(telegram_id: int):
         conn.close()
 
 
-@app.get("/api/duties/day-detail")
-async def get_duty_day_detail(date: str, role: str, telegram_id: int):
-    """Подробная информация о конкретном наряде (роль) на конкретную дату: все участники того же курса."""
+def _get_duty_day_detail(date: str, role: str, telegram_id: int):
     conn = get_db()
     if not conn:
         return {"error": "БД не найдена"}
@@ -1120,78 +1210,50 @@ async def get_duty_day_detail(date: str, role: str, telegram_id: int):
         if not user:
             return {"error": "Пользователь не найден"}
         ey = user["enrollment_year"]
-        rows = execute(conn, """
-            SELECT ds.fio, ds.group_name, ds.gender, u.telegram_id
-            FROM duty_schedule ds
-            LEFT JOIN users u ON u.fio = ds.fio AND u.status = 'активен'
-            WHERE ds.date = ? AND ds.role = ? AND ds.enrollment_year = ?
-            ORDER BY ds.group_name, ds.fio
-        """, (date, role, ey)).fetchall()
-        # Подставляем telegram_id по инициалам, если точное ФИО не совпало
-        fio_to_telegram = {}
-        for r in execute(conn,
-            "SELECT fio, telegram_id FROM users WHERE enrollment_year = ? AND status = 'активен'", (ey,)
-        ).fetchall():
-            for v in _fio_match_variants(r["fio"]) or [r["fio"]]:
-                fio_to_telegram[v] = r["telegram_id"]
-        participants = []
-        for r in rows:
-            tid = r["telegram_id"] if r["telegram_id"] is not None else fio_to_telegram.get(r["fio"])
-            participants.append({
-                "fio": r["fio"], "group": r["group_name"], "gender": r["gender"], "telegram_id": tid
-            })
+        by_date = get_month_snapshot(conn, ey, _iso_month(date)).by_date if _iso_month(date) else {}
+        participants = [
+            {"fio": p["fio"], "group": p["group"], "gender": p["gender"], "telegram_id": p["telegram_id"]}
+            for p in with_telegram_ids(conn, by_date.get(date, {}).get(role, []))
+        ]
         
         shift_data = []
         canteen_data = []
 
-        # Автораспределение за 3 часа до наряда: если назначений ещё нет.
-        try:
-            duty_start = datetime.strptime(date, "%Y-%m-%d").replace(hour=18, minute=30, second=0, microsecond=0)
-            auto_time = duty_start - timedelta(hours=3)  # 15:30 того же дня
-            now = datetime.now()
-        except Exception:
-            duty_start = None
-            auto_time = None
-            now = datetime.now()
+        # Назначения видны с 15:30 дня наряда (до этого — только ручное распределение, без предварительного плана).
+        # Обычно к этому времени план на месяц уже построен и зафиксирован; если нет — распределяем сейчас.
+        final = 1 if past_freeze_time(date) else 0
 
         if role in ("к", "гбр"):
             try:
-                s_rows = execute(conn, """
+                shifts_sql = """
                     SELECT fio, shift FROM duty_shift_assignments
-                    WHERE date = ? AND role = ? AND enrollment_year = ?
+                    WHERE date = ? AND role = ? AND enrollment_year = ? AND (provisional = 0 OR ? = 1)
                     ORDER BY shift, fio
-                """, (date, role, ey)).fetchall()
-                if not s_rows and auto_time and now >= auto_time:
-                    # Автоматически распределяем смены, если ещё не распределены
+                """
+                s_rows = execute(conn, shifts_sql, (date, role, ey, final)).fetchall()
+                if not s_rows and final:
                     try:
-                        distribute_shifts_for_date(date, role, ey, conn)
+                        ensure_distributed(conn, date, role, ey)
                     except Exception:
                         pass
-                    s_rows = execute(conn, """
-                        SELECT fio, shift FROM duty_shift_assignments
-                        WHERE date = ? AND role = ? AND enrollment_year = ?
-                        ORDER BY shift, fio
-                    """, (date, role, ey)).fetchall()
+                    s_rows = execute(conn, shifts_sql, (date, role, ey, final)).fetchall()
                 shift_data = [{"fio": r["fio"], "shift": r["shift"]} for r in s_rows]
             except Exception:
                 pass
         elif role == "с":
             try:
-                c_rows = execute(conn, """
+                canteen_sql = """
                     SELECT fio, object_name FROM duty_canteen_assignments
-                    WHERE date = ? AND enrollment_year = ?
+                    WHERE date = ? AND enrollment_year = ? AND (provisional = 0 OR ? = 1)
                     ORDER BY object_name, fio
-                """, (date, ey)).fetchall()
-                if not c_rows and auto_time and now >= auto_time:
+                """
+                c_rows = execute(conn, canteen_sql, (date, ey, final)).fetchall()
+                if not c_rows and final:
                     try:
-                        distribute_canteen_for_date(date, ey, conn)
+                        ensure_distributed(conn, date, "с", ey)
                     except Exception:
                         pass
-                    c_rows = execute(conn, """
-                        SELECT fio, object_name FROM duty_canteen_assignments
-                        WHERE date = ? AND enrollment_year = ?
-                        ORDER BY object_name, fio
-                    """, (date, ey)).fetchall()
+                    c_rows = execute(conn, canteen_sql, (date, ey, final)).fetchall()
                 canteen_data = [{"fio": r["fio"], "object": r["object_name"]} for r in c_rows]
             except Exception:
                 pass
@@ -1212,139 +1274,20 @@ async def get_duty_day_detail(date: str, role: str, telegram_id: int):
         conn.close()
 
 
+@app.get("/api/duties/day-detail")
+async def get_duty_day_detail(request: Request, date: str, role: str, telegram_id: int):
+    """Подробная информация о конкретном наряде (роль) на конкретную дату: все участники того же курса."""
+    result = await run_db(_get_duty_day_detail, date, role, telegram_id)
+    if "error" in result:
+        return result
+    return _etag_response(request, result)
+
+
 # ============================================
 # 2.5. РАСПРЕДЕЛЕНИЕ ПО СМЕНАМ И ОБЪЕКТАМ
 # ============================================
 
-CANTEEN_OBJECTS = ["ГЦ", "овощи", "тарелки", "железо", "стаканы", "лента"]
-
-def distribute_shifts_for_date(date_str: str, role: str, ey: int, conn):
-    """Распределяет людей по сменам для Курс/ГБР. Возвращает список назначений."""
-    rows = execute(conn, """
-        SELECT fio, group_name FROM duty_schedule
-        WHERE date = ? AND role = ? AND enrollment_year = ?
-        ORDER BY fio
-    """, (date_str, role, ey)).fetchall()
-    people = [r["fio"] for r in rows]
-    if not people:
-        return []
-    
-    random.shuffle(people)
-    assignments = []
-    
-    if role == "к":
-        # Фиксированный дежурный по курсу (shift=0) + до 3 дневальных (shift=1..3)
-        if len(people) == 1:
-            assignments.append({"fio": people[0], "shift": 0})
-        else:
-            # Первый — дежурный по курсу
-            assignments.append({"fio": people[0], "shift": 0})
-            day_count = min(3, len(people) - 1)
-            for i in range(day_count):
-                assignments.append({"fio": people[1 + i], "shift": i + 1})
-            # Остальные, если есть, остаются без смены (shift=0)
-            for fio in people[1 + day_count:]:
-                assignments.append({"fio": fio, "shift": 0})
-    elif role == "гбр":
-        for i, fio in enumerate(people):
-            shift = (i // 2) + 1
-            assignments.append({"fio": fio, "shift": shift})
-    else:
-        for i, fio in enumerate(people):
-            shift = (i % 3) + 1
-            assignments.append({"fio": fio, "shift": shift})
-    
-    execute(conn,"DELETE FROM duty_shift_assignments WHERE date = ? AND role = ? AND enrollment_year = ?",
-                 (date_str, role, ey))
-    for a in assignments:
-        execute(conn, """
-            INSERT OR REPLACE INTO duty_shift_assignments (date, role, fio, shift, enrollment_year)
-            VALUES (?, ?, ?, ?, ?)
-        """, (date_str, role, a["fio"], a["shift"], ey))
-        execute(conn, """
-            INSERT INTO duty_assignment_history (fio, date, role, shift, enrollment_year)
-            VALUES (?, ?, ?, ?, ?)
-        """, (a["fio"], date_str, role, a["shift"], ey))
-    conn.commit()
-    return assignments
-
-
-def distribute_canteen_for_date(date_str: str, ey: int, conn):
-    """Распределяет людей по объектам столовой с учётом рейтинга и истории."""
-    rows = execute(conn, """
-        SELECT fio, group_name FROM duty_schedule
-        WHERE date = ? AND role = 'с' AND enrollment_year = ?
-        ORDER BY fio
-    """, (date_str, ey)).fetchall()
-    people = [r["fio"] for r in rows]
-    if not people:
-        return []
-
-    scores = {}
-    for fio in people:
-        user_row = execute(conn,"SELECT global_score FROM users WHERE fio = ? AND enrollment_year = ?",
-                                (fio, ey)).fetchone()
-        gs = user_row["global_score"] if user_row and user_row["global_score"] else 0
-        
-        hist = execute(conn, """
-            SELECT sub_object FROM duty_assignment_history
-            WHERE fio = ? AND role = 'с' AND enrollment_year = ?
-            ORDER BY date DESC LIMIT 5
-        """, (fio, ey)).fetchall()
-        history = [h["sub_object"] for h in hist if h["sub_object"]]
-        
-        streak_penalty = 0
-        if len(history) >= 2:
-            weights_map = {}
-            try:
-                w_rows = execute(conn, """
-                    SELECT do.name, ow.weight FROM duty_objects do
-                    JOIN object_weights ow ON do.id = ow.object_id
-                """).fetchall()
-                weights_map = {r["name"]: r["weight"] for r in w_rows}
-            except Exception:
-                pass
-            
-            heavy = [o for o in CANTEEN_OBJECTS if weights_map.get(o, 10) >= 12]
-            if history[0] in heavy and len(history) > 1 and history[1] in heavy:
-                streak_penalty = 5
-        
-        scores[fio] = 0.5 * gs + streak_penalty
-    
-    sorted_people = sorted(people, key=lambda f: scores.get(f, 0))
-    
-    weights_map = {}
-    try:
-        w_rows = execute(conn, """
-            SELECT do.name, ow.weight FROM duty_objects do
-            JOIN object_weights ow ON do.id = ow.object_id
-        """).fetchall()
-        weights_map = {r["name"]: r["weight"] for r in w_rows}
-    except Exception:
-        pass
-    
-    objects_sorted = sorted(CANTEEN_OBJECTS, key=lambda o: weights_map.get(o, 10), reverse=True)
-    
-    assignments = []
-    obj_idx = 0
-    for fio in sorted_people:
-        obj = objects_sorted[obj_idx % len(objects_sorted)]
-        obj_idx += 1
-        assignments.append({"fio": fio, "object": obj})
-    
-    execute(conn,"DELETE FROM duty_canteen_assignments WHERE date = ? AND enrollment_year = ?",
-                 (date_str, ey))
-    for a in assignments:
-        execute(conn, """
-            INSERT OR REPLACE INTO duty_canteen_assignments (date, fio, object_name, enrollment_year)
-            VALUES (?, ?, ?, ?)
-        """, (date_str, a["fio"], a["object"], ey))
-        execute(conn, """
-            INSERT INTO duty_assignment_history (fio, date, role, sub_object, enrollment_year)
-            VALUES (?, ?, 'с', ?, ?)
-        """, (a["fio"], date_str, a["object"], ey))
-    conn.commit()
-    return assignments
+# Движок распределения — utils/distribution.py (общий с ботом)
 
 
 @app.post("/api/duties/confirm")
@@ -1369,16 +1312,6 @@ async def confirm_duty(data: dict):
     if not conn:
         raise HTTPException(500, detail="БД не найдена")
     try:
-        execute(conn, """
-            CREATE TABLE IF NOT EXISTS duty_confirmations (
-                telegram_id INTEGER,
-                date TEXT,
-                role TEXT,
-                status TEXT NOT NULL,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                PRIMARY KEY (telegram_id, date, role)
-            )
-        """)
         execute(conn, """
             INSERT OR REPLACE INTO duty_confirmations (telegram_id, date, role, status) VALUES (?, ?, ?, ?)
         """, (telegram_id, date_str, role, status))
@@ -1421,6 +1354,39 @@ async def distribute_duty(date: str = Form(...), role: str = Form(...), telegram
         conn.close()
 
 
+def _plan_duty_month(month: str, telegram_id: int):
+    conn = get_db()
+    if not conn:
+        raise HTTPException(500, detail="БД не найдена")
+    try:
+        user = execute(conn,"SELECT enrollment_year, role as user_role FROM users WHERE telegram_id = ?",
+                            (telegram_id,)).fetchone()
+        if not user:
+            raise HTTPException(404, detail="Пользователь не найден")
+        if user["user_role"] not in ("admin", "assistant"):
+            raise HTTPException(403, detail="Недостаточно прав")
+        count = plan_month(conn, user["enrollment_year"], month)
+        return {"status": "ok", "month": month, "count": count}
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"[ERROR] plan-month: {e}")
+        raise HTTPException(500, detail=str(e))
+    finally:
+        conn.close()
+
+
+@app.post("/api/duties/plan-month")
+async def plan_duty_month(month: str = Form(...), telegram_id: int = Form(...)):
+    """Предварительное распределение курса на весь месяц YYYY-MM (для админов и помощников).
+    План фиксируется в 15:30 дня наряда; зафиксированные и прошедшие даты не меняются."""
+    try:
+        datetime.strptime(month, "%Y-%m")
+    except ValueError:
+        raise HTTPException(400, detail="Месяц в формате YYYY-MM")
+    return await run_db(_plan_duty_month, month, telegram_id)
+
+
 @app.get("/api/duties/shifts")
 async def get_duty_shifts(date: str, role: str, telegram_id: int):
     """Получить распределение по сменам на дату."""
@@ -1434,9 +1400,9 @@ async def get_duty_shifts(date: str, role: str, telegram_id: int):
         ey = user["enrollment_year"]
         rows = execute(conn, """
             SELECT fio, shift FROM duty_shift_assignments
-            WHERE date = ? AND role = ? AND enrollment_year = ?
+            WHERE date = ? AND role = ? AND enrollment_year = ? AND (provisional = 0 OR ? = 1)
             ORDER BY shift, fio
-        """, (date, role, ey)).fetchall()
+        """, (date, role, ey, 1 if past_freeze_time(date) else 0)).fetchall()
         return {"date": date, "role": role, "assignments": [{"fio": r["fio"], "shift": r["shift"]} for r in rows]}
     except Exception as e:
         return {"assignments": [], "error": str(e)}
@@ -1457,9 +1423,9 @@ async def get_canteen_assignments(date: str, telegram_id: int):
         ey = user["enrollment_year"]
         rows = execute(conn, """
             SELECT fio, object_name FROM duty_canteen_assignments
-            WHERE date = ? AND enrollment_year = ?
+            WHERE date = ? AND enrollment_year = ? AND (provisional = 0 OR ? = 1)
             ORDER BY object_name, fio
-        """, (date, ey)).fetchall()
+        """, (date, ey, 1 if past_freeze_time(date) else 0)).fetchall()
         return {"date": date, "assignments": [{"fio": r["fio"], "object": r["object_name"]} for r in rows]}
     except Exception as e:
         return {"assignments": [], "error": str(e)}
@@ -1479,8 +1445,7 @@ async def get_tasks(user_id: int):
 
     try:
         # Проверим, есть ли таблица tasks
-        cursor = execute(conn,"PRAGMA table_info(tasks)")
-        columns = [row['name'] for row in cursor.fetchall()]
+        columns = table_columns(conn, "tasks")
         if not columns:
             print("[ERROR] Таблица tasks не найдена")
             return {"error": "Таблица задач не найдена"}
@@ -1665,13 +1630,6 @@ async def get_plans_note(user_id: int):
     if not conn:
         raise HTTPException(status_code=500, detail="База данных не найдена")
     try:
-        execute(conn, """
-            CREATE TABLE IF NOT EXISTS plans_notes (
-                user_id INTEGER PRIMARY KEY,
-                content TEXT,
-                updated_at TEXT DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
         row = execute(conn, "SELECT content FROM plans_notes WHERE user_id = ?", (user_id,)).fetchone()
         return {"content": row["content"] if row and row["content"] is not None else ""}
     except Exception as e:
@@ -1696,13 +1654,6 @@ async def save_plans_note(data: dict):
     if not conn:
         raise HTTPException(status_code=500, detail="База данных не найдена")
     try:
-        execute(conn, """
-            CREATE TABLE IF NOT EXISTS plans_notes (
-                user_id INTEGER PRIMARY KEY,
-                content TEXT,
-                updated_at TEXT DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
         execute(conn, """
             INSERT INTO plans_notes (user_id, content, updated_at)
             VALUES (?, ?, CURRENT_TIMESTAMP)
@@ -1725,18 +1676,6 @@ async def get_plans_cards(user_id: int):
     if not conn:
         raise HTTPException(status_code=500, detail="База данных не найдена")
     try:
-        execute(conn, """
-            CREATE TABLE IF NOT EXISTS plans_cards (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                category TEXT NOT NULL DEFAULT 'study',
-                title TEXT NOT NULL DEFAULT '',
-                content TEXT,
-                sort_order INTEGER DEFAULT 0,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                updated_at TEXT DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
         rows = execute(conn,
             "SELECT id, category, title, content, sort_order, created_at FROM plans_cards WHERE user_id = ? ORDER BY sort_order, id",
             (user_id,)
@@ -1762,18 +1701,6 @@ async def create_plans_card(data: dict):
     if not conn:
         raise HTTPException(status_code=500, detail="База данных не найдена")
     try:
-        execute(conn, """
-            CREATE TABLE IF NOT EXISTS plans_cards (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                category TEXT NOT NULL DEFAULT 'study',
-                title TEXT NOT NULL DEFAULT '',
-                content TEXT,
-                sort_order INTEGER DEFAULT 0,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                updated_at TEXT DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
         max_order = execute(conn, "SELECT COALESCE(MAX(sort_order), 0) + 1 as o FROM plans_cards WHERE user_id = ? AND category = ?", (user_id, category)).fetchone()
         order = max_order["o"] if max_order else 1
         execute(conn, """
@@ -1847,17 +1774,6 @@ async def get_forum_threads(category: str, telegram_id: int):
     if not conn:
         raise HTTPException(status_code=500, detail="База данных не найдена")
     try:
-        execute(conn, """
-            CREATE TABLE IF NOT EXISTS forum_threads (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                category TEXT NOT NULL,
-                title TEXT NOT NULL,
-                content TEXT,
-                author_telegram_id INTEGER,
-                anonymous INTEGER DEFAULT 0,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
         rows = execute(conn, """
             SELECT t.id, t.title, t.content, t.author_telegram_id, t.anonymous, t.created_at,
                    u.fio as author_fio
@@ -1904,17 +1820,6 @@ async def create_forum_thread(data: dict):
     if not conn:
         raise HTTPException(status_code=500, detail="База данных не найдена")
     try:
-        execute(conn, """
-            CREATE TABLE IF NOT EXISTS forum_threads (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                category TEXT NOT NULL,
-                title TEXT NOT NULL,
-                content TEXT,
-                author_telegram_id INTEGER,
-                anonymous INTEGER DEFAULT 0,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
         execute(conn, """
             INSERT INTO forum_threads (category, title, content, author_telegram_id, anonymous)
             VALUES (?, ?, ?, ?, ?)
@@ -1936,16 +1841,6 @@ async def get_forum_thread(thread_id: int, telegram_id: int):
     if not conn:
         raise HTTPException(status_code=500, detail="База данных не найдена")
     try:
-        execute(conn, """
-            CREATE TABLE IF NOT EXISTS forum_comments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                thread_id INTEGER NOT NULL,
-                author_telegram_id INTEGER,
-                content TEXT NOT NULL,
-                anonymous INTEGER DEFAULT 0,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
         t = execute(conn, """
             SELECT t.id, t.title, t.content, t.author_telegram_id, t.anonymous, t.created_at,
                    u.fio as author_fio
@@ -1996,16 +1891,6 @@ async def add_forum_comment(data: dict):
     if not conn:
         raise HTTPException(status_code=500, detail="База данных не найдена")
     try:
-        execute(conn, """
-            CREATE TABLE IF NOT EXISTS forum_comments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                thread_id INTEGER NOT NULL,
-                author_telegram_id INTEGER,
-                content TEXT NOT NULL,
-                anonymous INTEGER DEFAULT 0,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
         execute(conn, """
             INSERT INTO forum_comments (thread_id, author_telegram_id, content, anonymous)
             VALUES (?, ?, ?, ?)
@@ -2101,21 +1986,10 @@ async def check_schedule_month(group: str, enrollment_year: int, month: str):
     if not conn:
         raise HTTPException(status_code=500, detail="База данных не найдена")
     try:
-        start = month + "-01"
-        try:
-            dt = datetime.strptime(month, "%Y-%m")
-            if dt.month == 12:
-                end = f"{dt.year + 1}-01-01"
-            else:
-                end = f"{dt.year}-{dt.month + 1:02d}-01"
-        except Exception:
-            end = start
         row = execute(conn, """
-            SELECT 1 FROM duty_schedule
-            WHERE group_name = ? AND enrollment_year = ?
-            AND date >= ? AND date < ?
-            LIMIT 1
-        """, (group, enrollment_year, start, end)).fetchone()
+            SELECT 1 FROM schedule_months
+            WHERE enrollment_year = ? AND ym = ? AND group_name = ?
+        """, (enrollment_year, month, group)).fetchone()
         return {"has_data": row is not None, "month": month, "group": group}
     finally:
         conn.close()
@@ -2262,18 +2136,15 @@ async def upload_schedule(
     """Загрузка графика из .xlsx. Доступно сержанту (своя группа), помощнику/админу."""
     if not file.filename or not file.filename.lower().endswith(".xlsx"):
         raise HTTPException(status_code=400, detail="Нужен файл .xlsx")
-    conn = get_db()
-    if not conn:
-        raise HTTPException(status_code=500, detail="База данных не найдена")
-    try:
+    with connection() as conn:
+        if not conn:
+            raise HTTPException(status_code=500, detail="База данных не найдена")
         user = execute(conn,
             "SELECT role, group_name, enrollment_year FROM users WHERE telegram_id = ?",
             (telegram_id,)
         ).fetchone()
         if not user or user["role"] not in ("sergeant", "assistant", "admin"):
             raise HTTPException(status_code=403, detail="Нет прав на загрузку графика")
-    finally:
-        conn.close()
 
     content = await file.read()
     if not content:
@@ -2308,7 +2179,6 @@ async def upload_schedule(
             ).fetchone()
             enrollment_year = row["enrollment_year"] if row else user["enrollment_year"]
         elif user["role"] == "sergeant" and group != user["group_name"]:
-            conn.close()
             raise HTTPException(
                 status_code=403,
                 detail=f"Сержант может загружать график только своей группы. Ваша группа: {user['group_name']}"
@@ -2316,7 +2186,6 @@ async def upload_schedule(
 
         dates = {d["date"] for d in schedule_data}
         if not dates:
-            conn.close()
             return {"status": "ok", "message": "Нет записей", "count": 0}
         month_start = min(dates)
         month_ym = month_start[:7]
@@ -2332,13 +2201,10 @@ async def upload_schedule(
 
         if overwrite != 1:
             existing = execute(conn, """
-                SELECT 1 FROM duty_schedule
-                WHERE group_name = ? AND enrollment_year = ?
-                AND date >= ? AND date < ?
-                LIMIT 1
-            """, (group, enrollment_year, month_ym + "-01", month_end_next)).fetchone()
+                SELECT 1 FROM schedule_months
+                WHERE enrollment_year = ? AND ym = ? AND group_name = ?
+            """, (enrollment_year, month_ym, group)).fetchone()
             if existing:
-                conn.close()
                 month_names_ru = ["январь", "февраль", "март", "апрель", "май", "июнь", "июль", "август", "сентябрь", "октябрь", "ноябрь", "декабрь"]
                 try:
                     m = int(month_ym.split("-")[1])
@@ -2350,24 +2216,29 @@ async def upload_schedule(
                     detail=f"График за {month_name} {month_ym[:4]} уже существует. Заменить?"
                 )
 
-        execute(conn,
-            """DELETE FROM duty_schedule
-               WHERE group_name = ? AND enrollment_year = ?
-               AND date >= ? AND date < ?""",
-            (group, enrollment_year, month_ym + "-01", month_end_next)
-        )
+        execute(conn, duty_queries.DELETE_GROUP_MONTH, (group, enrollment_year, month_ym + "-01", month_end_next))
         execute(conn, """
             INSERT OR REPLACE INTO schedule_uploads (ym, group_name, enrollment_year, uploaded_by_telegram_id, uploaded_at)
             VALUES (?, ?, ?, ?, datetime('now'))
         """, (month_ym, group, enrollment_year, telegram_id))
-        for d in schedule_data:
-            execute(conn,
-                """INSERT OR REPLACE INTO duty_schedule (fio, date, role, group_name, enrollment_year, gender)
-                   VALUES (?, ?, ?, ?, ?, ?)""",
-                (d["fio"], d["date"], d["role"], d["group"], enrollment_year, d.get("gender", "male"))
-            )
+        # ФИО → user_id с учётом курса; несопоставленные строки сохраняются с user_id = NULL
+        resolved = resolve_fio_user_ids(conn, [d["fio"] for d in schedule_data], enrollment_year)
+        execute_many(conn,
+            """INSERT OR REPLACE INTO duty_schedule (fio, date, role, group_name, enrollment_year, gender, user_id)
+               VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            [(d["fio"], d["date"], d["role"], d["group"], enrollment_year, d.get("gender", "male"),
+              resolved[d["fio"]]["user_id"] if d["fio"] in resolved else None)
+             for d in schedule_data]
+        )
+        unresolved = sorted({d["fio"] for d in schedule_data if d["fio"] not in resolved})
+        for ym in sorted({d["date"][:7] for d in schedule_data}):
+            _refresh_schedule_months(conn, enrollment_year, ym)
         conn.commit()
-        conn.close()
+        for ym in sorted({d["date"][:7] for d in schedule_data}):
+            try:
+                plan_month(conn, enrollment_year, ym)
+            except Exception as e:
+                print(f"[WARN] План распределения {ym} (курс {enrollment_year}): {e}")
         month_names_ru = ["январь", "февраль", "март", "апрель", "май", "июнь", "июль", "август", "сентябрь", "октябрь", "ноябрь", "декабрь"]
         try:
             m = int(month_ym.split("-")[1])
@@ -2382,12 +2253,15 @@ async def upload_schedule(
             "count": len(schedule_data),
             "month_label": f"{month_name} {year_str}",
             "month_ym": month_ym,
+            "unresolved_fio": unresolved,
         }
     except HTTPException:
         raise
     except Exception as e:
         print(f"[ERROR] Сохранение графика: {e}")
         raise HTTPException(status_code=500, detail="Ошибка сохранения графика")
+    finally:
+        conn.close()
 
 
 @app.delete("/api/schedule/month")
@@ -2415,23 +2289,20 @@ async def delete_schedule_month(ym: str, telegram_id: int):
         except Exception:
             raise HTTPException(status_code=400, detail="Неверный месяц")
         if user["role"] == "sergeant":
-            execute(conn, """
-                DELETE FROM duty_schedule
-                WHERE enrollment_year = ? AND group_name = ? AND date >= ? AND date < ?
-            """, (user["enrollment_year"], user["group_name"] or "", month_start, month_end))
+            execute(conn, duty_queries.DELETE_GROUP_MONTH,
+                    (user["group_name"] or "", user["enrollment_year"], month_start, month_end))
         else:
-            execute(conn, """
-                DELETE FROM duty_schedule
-                WHERE enrollment_year = ? AND date >= ? AND date < ?
-            """, (user["enrollment_year"], month_start, month_end))
+            execute(conn, duty_queries.DELETE_COURSE_MONTH, (user["enrollment_year"], month_start, month_end))
+        _refresh_schedule_months(conn, user["enrollment_year"], ym)
         conn.commit()
-        conn.close()
         return {"status": "ok", "message": f"График за {ym} удалён"}
     except HTTPException:
         raise
     except Exception as e:
         print(f"[ERROR] delete schedule month: {e}")
         raise HTTPException(status_code=500, detail="Ошибка удаления")
+    finally:
+        conn.close()
 
 
 # ============================================
@@ -2454,34 +2325,24 @@ async def get_duty_edit_context(ym: str, telegram_id: int):
             "SELECT role, group_name, enrollment_year FROM users WHERE telegram_id = ?", (telegram_id,)
         ).fetchone()
         if not user or user["role"] not in ("sergeant", "assistant", "admin"):
-            conn.close()
             raise HTTPException(status_code=403, detail="Нет прав на правку графика")
         month_start = ym + "-01"
         try:
             y, m = int(ym[:4]), int(ym[5:7])
             month_end = f"{y + 1}-01-01" if m == 12 else f"{y}-{m + 1:02d}-01"
         except Exception:
-            conn.close()
             raise HTTPException(status_code=400, detail="Неверный месяц")
         ey = user["enrollment_year"]
         grp = user["group_name"] or ""
         if user["role"] == "sergeant":
-            schedule_rows = execute(conn, """
-                SELECT DISTINCT fio, group_name FROM duty_schedule
-                WHERE enrollment_year = ? AND group_name = ? AND date >= ? AND date < ?
-                ORDER BY group_name, fio
-            """, (ey, grp, month_start, month_end)).fetchall()
+            schedule_rows = execute(conn, duty_queries.GROUP_MONTH_CADETS, (ey, grp, month_start, month_end)).fetchall()
             users_rows = execute(conn, """
                 SELECT fio, group_name, telegram_id FROM users
                 WHERE enrollment_year = ? AND group_name = ? AND status = 'активен'
                 ORDER BY fio
             """, (ey, grp)).fetchall()
         else:
-            schedule_rows = execute(conn, """
-                SELECT DISTINCT fio, group_name FROM duty_schedule
-                WHERE enrollment_year = ? AND date >= ? AND date < ?
-                ORDER BY group_name, fio
-            """, (ey, month_start, month_end)).fetchall()
+            schedule_rows = execute(conn, duty_queries.COURSE_MONTH_CADETS, (ey, month_start, month_end)).fetchall()
             users_rows = execute(conn, """
                 SELECT fio, group_name, telegram_id FROM users
                 WHERE enrollment_year = ? AND status = 'активен'
@@ -2490,13 +2351,14 @@ async def get_duty_edit_context(ym: str, telegram_id: int):
         cadets_in_schedule = [{"fio": r["fio"], "group_name": r["group_name"]} for r in schedule_rows]
         group_users = [{"fio": r["fio"], "group_name": r["group_name"], "telegram_id": r["telegram_id"]} for r in users_rows]
         roles = [{"code": k, "name": get_full_role(k)} for k in list(ROLE_NAMES.keys())]
-        conn.close()
         return {"ym": ym, "cadets_in_schedule": cadets_in_schedule, "group_users": group_users, "reasons": DUTY_REMOVAL_REASONS, "roles": roles}
     except HTTPException:
         raise
     except Exception as e:
         print(f"[ERROR] edit-context: {e}")
         raise HTTPException(status_code=500, detail="Ошибка загрузки контекста")
+    finally:
+        conn.close()
 
 
 @app.get("/api/duties/role-by-fio-date")
@@ -2512,14 +2374,9 @@ async def get_role_by_fio_date(telegram_id: int, fio: str, date: str):
             "SELECT role, group_name, enrollment_year FROM users WHERE telegram_id = ?", (telegram_id,)
         ).fetchone()
         if not user or user["role"] not in ("sergeant", "assistant", "admin"):
-            conn.close()
             raise HTTPException(status_code=403, detail="Нет прав")
         ey = user["enrollment_year"]
-        row = execute(conn, """
-            SELECT role FROM duty_schedule
-            WHERE date = ? AND enrollment_year = ? AND fio = ?
-        """, (date, ey, fio.strip())).fetchone()
-        conn.close()
+        row = execute(conn, duty_queries.CADET_DUTY_ON_DATE, (date, ey, fio.strip())).fetchone()
         if not row:
             raise HTTPException(status_code=404, detail="Нет наряда на эту дату у этого курсанта")
         return {"role": row["role"]}
@@ -2528,6 +2385,8 @@ async def get_role_by_fio_date(telegram_id: int, fio: str, date: str):
     except Exception as e:
         print(f"[ERROR] role-by-fio-date: {e}")
         raise HTTPException(status_code=500, detail="Ошибка")
+    finally:
+        conn.close()
 
 
 @app.post("/api/duties/remove-and-replace")
@@ -2551,23 +2410,17 @@ async def duty_remove_and_replace(data: dict):
             "SELECT role, group_name, enrollment_year FROM users WHERE telegram_id = ?", (telegram_id,)
         ).fetchone()
         if not user or user["role"] not in ("sergeant", "assistant", "admin"):
-            conn.close()
             raise HTTPException(status_code=403, detail="Нет прав")
         ey = user["enrollment_year"]
-        row = execute(conn, """
-            SELECT id, group_name FROM duty_schedule
-            WHERE date = ? AND role = ? AND enrollment_year = ? AND fio = ?
-        """, (date, role, ey, fio_removed)).fetchone()
+        row = execute(conn, duty_queries.DUTY_ROW, (date, role, ey, fio_removed)).fetchone()
         if not row:
-            conn.close()
             raise HTTPException(status_code=404, detail="Запись не найдена в графике на эту дату")
         grp = row["group_name"]
         if user["role"] == "sergeant" and grp != (user["group_name"] or ""):
-            conn.close()
             raise HTTPException(status_code=403, detail="Можно править только свою группу")
-        execute(conn, """
-            UPDATE duty_schedule SET fio = ? WHERE date = ? AND role = ? AND enrollment_year = ? AND fio = ?
-        """, (fio_replacement, date, role, ey, fio_removed))
+        replacement = resolve_fio_user_ids(conn, [fio_replacement], ey).get(fio_replacement)
+        execute(conn, duty_queries.REPLACE_DUTY_PERSON,
+                (fio_replacement, replacement["user_id"] if replacement else None, date, role, ey, fio_removed))
         execute(conn, """
             INSERT INTO duty_replacements (date, role, group_name, enrollment_year, fio_removed, fio_replacement, reason, created_by_telegram_id)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?)
@@ -2583,6 +2436,8 @@ async def duty_remove_and_replace(data: dict):
             )
         except Exception:
             pass
+        # UPDATE может вытеснить запись заменяющего на эту дату (UNIQUE ... ON CONFLICT REPLACE)
+        _refresh_schedule_months(conn, ey, date[:7])
         conn.commit()
         editor = execute(conn,"SELECT fio FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
         editor_fio = (editor["fio"] or "").split()[0] if editor else "Сержант"
@@ -2592,13 +2447,14 @@ async def duty_remove_and_replace(data: dict):
             f"{editor_fio}: замена {fio_removed} → {fio_replacement}. Причина: {reason}.",
             telegram_id
         )
-        conn.close()
         return {"status": "ok", "message": "Замена выполнена"}
     except HTTPException:
         raise
     except Exception as e:
         print(f"[ERROR] remove-and-replace: {e}")
         raise HTTPException(status_code=500, detail="Ошибка замены")
+    finally:
+        conn.close()
 
 
 @app.post("/api/duties/add")
@@ -2606,7 +2462,8 @@ async def duty_add(data: dict):
     """Добавить наряд: курсант, дата, роль. Опционально — замена больному (логируем в duty_replacements)."""
     telegram_id = data.get("telegram_id")
     date = data.get("date")
-    role = data.get("role")
+    # Коды ролей в графике — в нижнем регистре (как из Excel и change-role): по ним считаются очки и распределение
+    role = (data.get("role") or "").strip().lower()
     fio = (data.get("fio") or "").strip()
     group_name = (data.get("group_name") or "").strip()
     reason_replacing = (data.get("reason_replacing_sick") or "").strip()
@@ -2621,24 +2478,24 @@ async def duty_add(data: dict):
             "SELECT role, group_name, enrollment_year FROM users WHERE telegram_id = ?", (telegram_id,)
         ).fetchone()
         if not user or user["role"] not in ("sergeant", "assistant", "admin"):
-            conn.close()
             raise HTTPException(status_code=403, detail="Нет прав")
         ey = user["enrollment_year"]
         if user["role"] == "sergeant" and group_name != (user["group_name"] or ""):
-            conn.close()
             raise HTTPException(status_code=403, detail="Можно добавлять только в свою группу")
-        gender_row = execute(conn,"SELECT gender FROM users WHERE fio = ? LIMIT 1", (fio,)).fetchone()
-        gender = gender_row["gender"] if gender_row else "male"
+        match = resolve_fio_user_ids(conn, [fio], ey).get(fio)
+        gender = match["gender"] if match else "male"
         execute(conn, """
-            INSERT OR REPLACE INTO duty_schedule (fio, date, role, group_name, enrollment_year, gender)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (fio, date, role, group_name, ey, gender))
+            INSERT OR REPLACE INTO duty_schedule (fio, date, role, group_name, enrollment_year, gender, user_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (fio, date, role, group_name, ey, gender, match["user_id"] if match else None))
         if reason_replacing and fio_replaced and reason_replacing.lower() in ("заболел", "1", "да", "true"):
             execute(conn, """
                 INSERT INTO duty_replacements (date, role, group_name, enrollment_year, fio_removed, fio_replacement, reason, created_by_telegram_id)
                 VALUES (?, ?, ?, ?, ?, ?, 'заболел', ?)
             """, (date, role, group_name, ey, fio_replaced, fio, telegram_id))
+        _refresh_schedule_months(conn, ey, date[:7])
         conn.commit()
+        _replan_after_edit(conn, ey, date)
         editor = execute(conn,"SELECT fio FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
         editor_fio = (editor["fio"] or "").split()[0] if editor else "Сержант"
         _create_schedule_notification(
@@ -2647,13 +2504,14 @@ async def duty_add(data: dict):
             f"{editor_fio}: добавлен наряд для {fio} ({role}).",
             telegram_id
         )
-        conn.close()
         return {"status": "ok", "message": "Наряд добавлен"}
     except HTTPException:
         raise
     except Exception as e:
         print(f"[ERROR] duty add: {e}")
         raise HTTPException(status_code=500, detail="Ошибка добавления")
+    finally:
+        conn.close()
 
 
 @app.post("/api/duties/remove")
@@ -2673,23 +2531,14 @@ async def duty_remove(data: dict):
             "SELECT role, group_name, enrollment_year FROM users WHERE telegram_id = ?", (telegram_id,)
         ).fetchone()
         if not user or user["role"] not in ("sergeant", "assistant", "admin"):
-            conn.close()
             raise HTTPException(status_code=403, detail="Нет прав")
         ey = user["enrollment_year"]
-        row = execute(conn, """
-            SELECT group_name FROM duty_schedule
-            WHERE date = ? AND role = ? AND enrollment_year = ? AND fio = ?
-        """, (date, role, ey, fio_removed)).fetchone()
+        row = execute(conn, duty_queries.DUTY_ROW, (date, role, ey, fio_removed)).fetchone()
         if not row:
-            conn.close()
             raise HTTPException(status_code=404, detail="Запись не найдена в графике на эту дату")
         if user["role"] == "sergeant" and row["group_name"] != (user["group_name"] or ""):
-            conn.close()
             raise HTTPException(status_code=403, detail="Можно править только свою группу")
-        execute(conn, """
-            DELETE FROM duty_schedule
-            WHERE date = ? AND role = ? AND enrollment_year = ? AND fio = ?
-        """, (date, role, ey, fio_removed))
+        execute(conn, duty_queries.DELETE_DUTY_PERSON, (date, role, ey, fio_removed))
         try:
             execute(conn,"DELETE FROM duty_shift_assignments WHERE date = ? AND role = ? AND enrollment_year = ? AND fio = ?",
                          (date, role, ey, fio_removed))
@@ -2697,7 +2546,9 @@ async def duty_remove(data: dict):
                          (date, ey, fio_removed))
         except Exception:
             pass
+        _refresh_schedule_months(conn, ey, date[:7])
         conn.commit()
+        _replan_after_edit(conn, ey, date)
         editor = execute(conn,"SELECT fio FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
         editor_fio = (editor["fio"] or "").split()[0] if editor else "Сержант"
         _create_schedule_notification(
@@ -2706,13 +2557,14 @@ async def duty_remove(data: dict):
             f"{editor_fio}: снят с наряда {fio_removed} (роль: {role}).",
             telegram_id
         )
-        conn.close()
         return {"status": "ok", "message": "Наряд удалён"}
     except HTTPException:
         raise
     except Exception as e:
         print(f"[ERROR] duty remove: {e}")
         raise HTTPException(status_code=500, detail="Ошибка удаления")
+    finally:
+        conn.close()
 
 
 @app.post("/api/duties/change-role")
@@ -2732,28 +2584,22 @@ async def duty_change_role(data: dict):
             "SELECT role, group_name, enrollment_year FROM users WHERE telegram_id = ?", (telegram_id,)
         ).fetchone()
         if not user or user["role"] not in ("sergeant", "assistant", "admin"):
-            conn.close()
             raise HTTPException(status_code=403, detail="Нет прав")
         ey = user["enrollment_year"]
-        row = execute(conn, """
-            SELECT role, group_name FROM duty_schedule
-            WHERE date = ? AND enrollment_year = ? AND fio = ?
-        """, (date, ey, fio)).fetchone()
+        row = execute(conn, duty_queries.CADET_DUTY_ON_DATE, (date, ey, fio)).fetchone()
         if not row:
-            conn.close()
             raise HTTPException(status_code=404, detail="Наряд на эту дату не найден")
         if user["role"] == "sergeant" and row["group_name"] != (user["group_name"] or ""):
-            conn.close()
             raise HTTPException(status_code=403, detail="Можно править только свою группу")
-        execute(conn, """
-            UPDATE duty_schedule SET role = ? WHERE date = ? AND enrollment_year = ? AND fio = ?
-        """, (new_role, date, ey, fio))
+        execute(conn, duty_queries.SET_DUTY_ROLE, (new_role, date, ey, fio))
         try:
             execute(conn,"DELETE FROM duty_shift_assignments WHERE date = ? AND enrollment_year = ? AND fio = ?", (date, ey, fio))
             execute(conn,"DELETE FROM duty_canteen_assignments WHERE date = ? AND enrollment_year = ? AND fio = ?", (date, ey, fio))
         except Exception:
             pass
+        _refresh_schedule_months(conn, ey, date[:7])
         conn.commit()
+        _replan_after_edit(conn, ey, date)
         editor = execute(conn,"SELECT fio FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
         editor_fio = (editor["fio"] or "").split()[0] if editor else "Сержант"
         _create_schedule_notification(
@@ -2762,13 +2608,14 @@ async def duty_change_role(data: dict):
             f"{editor_fio}: у {fio} изменена роль на {new_role}.",
             telegram_id
         )
-        conn.close()
         return {"status": "ok", "message": "Роль изменена"}
     except HTTPException:
         raise
     except Exception as e:
         print(f"[ERROR] duty change-role: {e}")
         raise HTTPException(status_code=500, detail="Ошибка изменения")
+    finally:
+        conn.close()
 
 
 # ============================================
@@ -2783,8 +2630,7 @@ async def get_notifications(telegram_id: int, limit: int = 50):
         raise HTTPException(status_code=500, detail="База данных не найдена")
     try:
         # Узнаём, как называется колонка группы в users (group_name / group_num / group)
-        cursor = execute(conn, "PRAGMA table_info(users)")
-        cols = [row["name"] for row in cursor.fetchall()]
+        cols = table_columns(conn, "users")
         if "group_name" in cols:
             group_col = "group_name"
         elif "group_num" in cols:
@@ -2807,7 +2653,6 @@ async def get_notifications(telegram_id: int, limit: int = 50):
                 (telegram_id,),
             ).fetchone()
         if not user:
-            conn.close()
             return {"items": [], "unread_count": 0}
 
         grp = (user.get("group_name") or "") if isinstance(user, dict) else (user["group_name"] if "group_name" in user.keys() else "")
@@ -2839,11 +2684,12 @@ async def get_notifications(telegram_id: int, limit: int = 50):
                 "created_at": r["created_at"],
                 "read": read,
             })
-        conn.close()
         return {"items": items, "unread_count": unread}
     except Exception as e:
         print(f"[ERROR] notifications: {e}")
         raise HTTPException(status_code=500, detail="Ошибка загрузки уведомлений")
+    finally:
+        conn.close()
 
 
 @app.post("/api/notifications/read")
@@ -2859,8 +2705,7 @@ async def mark_notifications_read(data: dict):
     try:
         if notification_ids == "all" or (isinstance(notification_ids, list) and len(notification_ids) == 0):
             # Получить все id уведомлений, которые пользователь видит и не прочитал
-            cursor = execute(conn, "PRAGMA table_info(users)")
-            cols = [row["name"] for row in cursor.fetchall()]
+            cols = table_columns(conn, "users")
             if "group_name" in cols:
                 group_col = "group_name"
             elif "group_num" in cols:
@@ -2884,7 +2729,6 @@ async def mark_notifications_read(data: dict):
                 ).fetchone()
 
             if not user:
-                conn.close()
                 return {"status": "ok", "marked": 0}
 
             grp = (user.get("group_name") or "") if isinstance(user, dict) else (user["group_name"] if "group_name" in user.keys() else "")
@@ -2897,198 +2741,179 @@ async def mark_notifications_read(data: dict):
             """, (telegram_id, telegram_id, grp, str(ey))).fetchall()]
         else:
             ids = [int(x) for x in notification_ids] if isinstance(notification_ids, list) else []
-        for nid in ids:
-            execute(conn,"INSERT OR IGNORE INTO notification_read (notification_id, telegram_id) VALUES (?, ?)", (nid, telegram_id))
+        execute_many(conn, "INSERT OR IGNORE INTO notification_read (notification_id, telegram_id) VALUES (?, ?)",
+                     [(nid, telegram_id) for nid in ids])
         conn.commit()
-        conn.close()
         return {"status": "ok", "marked": len(ids)}
     except Exception as e:
         print(f"[ERROR] notifications read: {e}")
         raise HTTPException(status_code=500, detail="Ошибка")
+    finally:
+        conn.close()
 
 
 # ============================================
 # 2.8. РЕЙТИНГ (очки из нарядов по весам опроса)
 # ============================================
 
-def _get_user_duty_points(conn, telegram_id: int, month_from: str = None, month_to: str = None):
-    """Сумма баллов пользователя за наряды (по duty_schedule + object_weights). Период опционально."""
-    # Определяем колонку с ФИО (fio или full_name), чтобы поддерживать старые БД
-    cursor = execute(conn, "PRAGMA table_info(users)")
-    cols = [row["name"] for row in cursor.fetchall()]
-    if "fio" in cols:
-        name_col = "fio"
-    elif "full_name" in cols:
-        name_col = "full_name"
-    else:
-        return 0.0
-
-    user = execute(
-        conn,
-        f"SELECT {name_col} as fio, enrollment_year FROM users WHERE telegram_id = ?",
-        (telegram_id,),
-    ).fetchone()
-    if not user:
-        return 0.0
-
-    fio, ey = user["fio"], user["enrollment_year"]
-    extra = ""
-    params = [fio, ey]
-    if month_from:
-        extra += " AND date >= ?"
-        params.append(month_from + "-01")
-    if month_to:
-        y, m = int(month_to[:4]), int(month_to[5:7])
-        if m == 12:
-            month_end = f"{y+1}-01-01"
-        else:
-            month_end = f"{y}-{m+1:02d}-01"
-        extra += " AND date < ?"
-        params.append(month_end)
-    rows = execute(conn,f"""
-        SELECT ds.role, ds.date FROM duty_schedule ds
-        WHERE ds.fio = ? AND ds.enrollment_year = ? {extra}
-    """, params).fetchall()
-    # Веса: duty_objects (name = Курс, ГБР, Столовая, ЗУБ и дочерние для столовой) + object_weights
-    weights = {}
-    for w in execute(conn,"SELECT o.name, o.parent_id, ow.weight FROM duty_objects o JOIN object_weights ow ON ow.object_id = o.id").fetchall():
-        key = (w["name"], w["parent_id"])
-        weights[key] = float(w["weight"] or 0)
-    # Роль в графике может быть кодом (к, гбр, с ...). Соответствие с duty_objects по имени
-    role_to_name = {"к": "Курс", "дк": "Дежурный по курсу", "с": "Столовая", "гбр": "ГБР", "зуб": "ЗУБ", "путсо": "ПУТСО", "м": "Медчасть"}
-    total = 0.0
+def _duty_points_ranking(conn, scope: str, enrollment_year=None, period_ym: str = ALL_PERIOD, limit=None):
+    """Топ по очкам из материализованного leaderboards: scope — course (курс enrollment_year) или institute,
+    period_ym — YYYY-MM или 'all'. Строки: telegram_id, fio, group_name, enrollment_year, points, rank."""
+    params = [scope, enrollment_year if scope == SCOPE_COURSE else 0, period_ym]
+    limit_sql = ""
+    if limit:
+        limit_sql = " AND lb.rank <= ?"
+        params.append(int(limit))
+    rows = execute(conn, f"""
+        SELECT lb.rank, lb.telegram_id, lb.points, u.fio, u.group_name, u.enrollment_year
+        FROM leaderboards lb
+        JOIN users u ON u.telegram_id = lb.telegram_id
+        WHERE lb.scope = ? AND lb.scope_key = ? AND lb.period_ym = ?{limit_sql}
+        ORDER BY lb.rank
+    """, tuple(params)).fetchall()
+    return [
+        {
+            "telegram_id": r["telegram_id"],
+            "fio": r["fio"],
+            "group_name": r["group_name"],
+            "enrollment_year": r["enrollment_year"],
+            "points": round(float(r["points"]), 1),
+            "rank": r["rank"],
+        }
+        for r in rows
+    ]
+
+
+def _rank_history(conn, telegram_ids, scope: str, period_ym: str, since: str) -> dict:
+    """Снимки мест пользователей с даты since (YYYY-MM-DD): {telegram_id: [(дата, место), ...]} по возрастанию дат."""
+    history = {}
+    if not telegram_ids:
+        return history
+    rows = execute(conn, f"""
+        SELECT telegram_id, snapshot_date, rank FROM rank_snapshots
+        WHERE telegram_id IN ({", ".join(["?"] * len(telegram_ids))})
+          AND scope = ? AND period_ym = ? AND snapshot_date >= ?
+        ORDER BY telegram_id, snapshot_date
+    """, (*telegram_ids, scope, period_ym, since)).fetchall()
     for r in rows:
-        role_code = (r["role"] or "").lower()
-        name = role_to_name.get(role_code, role_code)
-        # Ищем вес по имени (parent_id NULL для основных)
-        for (obj_name, parent_id), w in weights.items():
-            if obj_name == name and parent_id is None:
-                total += w
-                break
-        else:
-            total += 10.0  # дефолт если нет веса
-    return round(total, 1)
+        history.setdefault(r["telegram_id"], []).append((str(r["snapshot_date"]), r["rank"]))
+    return history
+
+
+def _points_rank(conn, telegram_id: int, points: float, period_ym: str, enrollment_year=None) -> int:
+    """Место пользователя среди активных (по курсу, если задан enrollment_year): 1 + число тех,
+    кто выше по (очки DESC, telegram_id). Счёт по индексу user_points; без строки в леджере — 0 очков."""
+    course_sql = " AND up.enrollment_year = ?" if enrollment_year is not None else ""
+    params = [period_ym] + ([enrollment_year] if enrollment_year is not None else []) + [points, points, telegram_id]
+    ahead = execute(conn, f"""
+        SELECT COUNT(*) FROM user_points up
+        JOIN users u ON u.telegram_id = up.telegram_id AND u.enrollment_year = up.enrollment_year
+        WHERE up.period_ym = ?{course_sql} AND u.status = 'активен'
+          AND (up.points > ? OR (up.points = ? AND up.telegram_id < ?))
+    """, tuple(params)).fetchone()[0]
+    if points <= 0:
+        # Пользователи без строки в леджере — с нулём очков; выше те, у кого telegram_id меньше
+        course_sql = " AND u.enrollment_year = ?" if enrollment_year is not None else ""
+        params = [telegram_id] + ([enrollment_year] if enrollment_year is not None else []) + [period_ym]
+        ahead += execute(conn, f"""
+            SELECT COUNT(*) FROM users u
+            WHERE u.status = 'активен' AND u.telegram_id < ?{course_sql}
+              AND NOT EXISTS (SELECT 1 FROM user_points up
+                              WHERE up.telegram_id = u.telegram_id AND up.enrollment_year = u.enrollment_year
+                                AND up.period_ym = ?)
+        """, tuple(params)).fetchone()[0]
+    return ahead + 1
+
+
+def _user_duty_points(conn, telegram_id: int, period_ym: str = ALL_PERIOD):
+    """Очки пользователя и места по курсу/институту — чтение строки user_points по ключу и два счёта по индексу.
+    Неактивный (или неизвестный) пользователь мест не получает."""
+    user = execute(conn, "SELECT enrollment_year, status FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
+    if not user:
+        return {"points": 0.0, "rank_course": None, "rank_institute": None}
+    row = execute(conn, """
+        SELECT points FROM user_points WHERE telegram_id = ? AND period_ym = ? AND enrollment_year = ?
+    """, (telegram_id, period_ym, user["enrollment_year"])).fetchone()
+    points = float(row["points"]) if row else 0.0
+    if user["status"] != "активен":
+        return {"points": round(points, 1), "rank_course": None, "rank_institute": None}
+    return {
+        "points": round(points, 1),
+        "rank_course": _points_rank(conn, telegram_id, points, period_ym, user["enrollment_year"]),
+        "rank_institute": _points_rank(conn, telegram_id, points, period_ym),
+    }
 
 
-@app.get("/api/rating/me")
-async def rating_me(telegram_id: int):
-    """Очки пользователя, место в топе по курсу и по институту (за всё время)."""
+def _get_user_duty_points(conn, telegram_id: int, period_ym: str = ALL_PERIOD):
+    """Сумма баллов пользователя за наряды (из user_points). period_ym — YYYY-MM или 'all'."""
+    return _user_duty_points(conn, telegram_id, period_ym)["points"]
+
+
+def _rating_me(telegram_id: int):
     conn = get_db()
     if not conn:
         raise HTTPException(status_code=500, detail="База данных не найдена")
     try:
-        # Для рейтинга нам нужен только год набора; поле group_name может отсутствовать в старых БД
-        user = execute(
-            conn,
-            "SELECT enrollment_year FROM users WHERE telegram_id = ?",
-            (telegram_id,),
-        ).fetchone()
+        user = execute(conn, "SELECT 1 FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
         if not user:
-            conn.close()
             return {"points": 0, "rank_course": None, "rank_institute": None}
-        ey = user["enrollment_year"]
-        points = _get_user_duty_points(conn, telegram_id, None, None)
-        # Ранг по курсу и институту — считаем очки для всех и ранжируем
-        all_course = []
-        for row in execute(conn,"SELECT telegram_id FROM users WHERE enrollment_year = ? AND status = 'активен'", (ey,)).fetchall():
-            tid = row["telegram_id"]
-            p = _get_user_duty_points(conn, tid, None, None)
-            all_course.append((tid, p))
-        all_course.sort(key=lambda x: -x[1])
-        rank_course = next((i + 1 for i, (tid, _) in enumerate(all_course) if tid == telegram_id), None)
-        all_inst = []
-        for row in execute(conn,"SELECT telegram_id FROM users WHERE status = 'активен'").fetchall():
-            p = _get_user_duty_points(conn, row["telegram_id"], None, None)
-            all_inst.append((row["telegram_id"], p))
-        all_inst.sort(key=lambda x: -x[1])
-        rank_institute = next((i + 1 for i, (tid, _) in enumerate(all_inst) if tid == telegram_id), None)
-        conn.close()
-        return {"points": points, "rank_course": rank_course, "rank_institute": rank_institute}
+        me = _user_duty_points(conn, telegram_id)
+        return me
     except Exception as e:
         print(f"[ERROR] rating/me: {e}")
         raise HTTPException(status_code=500, detail="Ошибка рейтинга")
+    finally:
+        conn.close()
 
 
-@app.get("/api/rating/top")
-async def rating_top(telegram_id: int, period: str = "all", scope: str = "course", limit: int = 30):
-    """Топ по очкам. period: month | all, scope: course | institute."""
+@app.get("/api/rating/me")
+async def rating_me(telegram_id: int):
+    """Очки пользователя, место в топе по курсу и по институту (за всё время)."""
+    return await run_db(_rating_me, telegram_id)
+
+
+def _rating_top(telegram_id: int, period: str = "all", scope: str = "course", limit: int = 30):
     conn = get_db()
     if not conn:
         raise HTTPException(status_code=500, detail="База данных не найдена")
     try:
         user = execute(conn,"SELECT enrollment_year FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
         if not user:
-            conn.close()
             return {"top": []}
         ey = user["enrollment_year"]
-        month_from = datetime.now().strftime("%Y-%m") if period == "month" else None
-        month_to = datetime.now().strftime("%Y-%m") if period == "month" else None
-        if scope == "course":
-            rows = execute(conn,"SELECT telegram_id, fio, group_name FROM users WHERE enrollment_year = ? AND status = 'активен'", (ey,)).fetchall()
-        else:
-            rows = execute(conn,"SELECT telegram_id, fio, group_name FROM users WHERE status = 'активен'").fetchall()
-        result = []
-        for r in rows:
-            p = _get_user_duty_points(conn, r["telegram_id"], month_from, month_to)
-            result.append({"telegram_id": r["telegram_id"], "fio": r["fio"], "group_name": r["group_name"], "points": p})
-        result.sort(key=lambda x: -x["points"])
-        result = result[:limit]
-        for i, row in enumerate(result):
-            row["rank"] = i + 1
-        conn.close()
+        period_ym = datetime.now().strftime("%Y-%m") if period == "month" else ALL_PERIOD
+        scope = SCOPE_COURSE if scope == "course" else SCOPE_INSTITUTE
+        ranking = _duty_points_ranking(conn, scope, ey, period_ym, limit)
+        result = [
+            {"telegram_id": r["telegram_id"], "fio": r["fio"], "group_name": r["group_name"], "points": r["points"],
+             "rank": r["rank"]}
+            for r in ranking
+        ]
         return {"top": result, "period": period, "scope": scope}
     except Exception as e:
         print(f"[ERROR] rating/top: {e}")
         raise HTTPException(status_code=500, detail="Ошибка рейтинга")
+    finally:
+        conn.close()
+
+
+@app.get("/api/rating/top")
+async def rating_top(telegram_id: int, period: str = "all", scope: str = "course", limit: int = 30):
+    """Топ по очкам. period: month | all, scope: course | institute."""
+    return await run_db(_rating_top, telegram_id, period, scope, limit)
 
 
 # ============================================
 # 2.9. ДОСТИЖЕНИЯ
 # ============================================
 
-def _unlock_achievements(conn, telegram_id: int):
-    """Проверяет условия достижений и добавляет в user_achievements при выполнении."""
-    try:
-        user = execute(conn,"SELECT fio, enrollment_year FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
-        if not user:
-            return
-        fio, ey = user["fio"], user["enrollment_year"]
-        # first_10_duties
-        count_duties = execute(conn,"SELECT COUNT(*) FROM duty_schedule WHERE fio = ? AND enrollment_year = ?", (fio, ey)).fetchone()[0]
-        if count_duties >= 10:
-            execute(conn,"INSERT OR IGNORE INTO user_achievements (telegram_id, achievement_id) VALUES (?, 'first_10_duties')", (telegram_id,))
-        # top3_course, top10_institute — по текущим очкам
-        points = _get_user_duty_points(conn, telegram_id, None, None)
-        course_list = []
-        for row in execute(conn,"SELECT telegram_id FROM users WHERE enrollment_year = ? AND status = 'активен'", (ey,)).fetchall():
-            p = _get_user_duty_points(conn, row["telegram_id"], None, None)
-            course_list.append((row["telegram_id"], p))
-        course_list.sort(key=lambda x: -x[1])
-        rank_course = next((i + 1 for i, (tid, _) in enumerate(course_list) if tid == telegram_id), None)
-        if rank_course is not None and rank_course <= 3:
-            execute(conn,"INSERT OR IGNORE INTO user_achievements (telegram_id, achievement_id) VALUES (?, 'top3_course')", (telegram_id,))
-        all_inst = []
-        for row in execute(conn,"SELECT telegram_id FROM users WHERE status = 'активен'").fetchall():
-            p = _get_user_duty_points(conn, row["telegram_id"], None, None)
-            all_inst.append((row["telegram_id"], p))
-        all_inst.sort(key=lambda x: -x[1])
-        rank_inst = next((i + 1 for i, (tid, _) in enumerate(all_inst) if tid == telegram_id), None)
-        if rank_inst is not None and rank_inst <= 10:
-            execute(conn,"INSERT OR IGNORE INTO user_achievements (telegram_id, achievement_id) VALUES (?, 'top10_institute')", (telegram_id,))
-        conn.commit()
-    except Exception as e:
-        print(f"[WARN] _unlock_achievements: {e}")
-
-
-@app.get("/api/achievements")
-async def get_achievements(telegram_id: int):
-    """Список всех достижений с флагом получено и процентом обладателей."""
+def _get_achievements(telegram_id: int):
     conn = get_db()
     if not conn:
         raise HTTPException(status_code=500, detail="База данных не найдена")
     try:
-        _unlock_achievements(conn, telegram_id)
-        total_users = execute(conn,"SELECT COUNT(*) FROM users WHERE status = 'активен'").fetchone()[0] or 1
+        owners, total_users = achievement_ownership(conn)
+        total_users = total_users or 1
         rows = execute(conn, """
             SELECT a.id, a.title, a.description, a.icon_url, a.sort_order,
                    ua.telegram_id IS NOT NULL AS unlocked
@@ -3098,8 +2923,7 @@ async def get_achievements(telegram_id: int):
         """, (telegram_id,)).fetchall()
         result = []
         for r in rows:
-            count = execute(conn,"SELECT COUNT(*) FROM user_achievements WHERE achievement_id = ?", (r["id"],)).fetchone()[0]
-            pct = round(100.0 * count / total_users, 1) if total_users else 0
+            pct = round(100.0 * owners.get(r["id"], 0) / total_users, 1)
             result.append({
                 "id": r["id"],
                 "title": r["title"],
@@ -3108,16 +2932,21 @@ async def get_achievements(telegram_id: int):
                 "unlocked": bool(r["unlocked"]),
                 "percent_owners": pct,
             })
-        conn.close()
         return {"achievements": result}
     except Exception as e:
         print(f"[ERROR] achievements: {e}")
         raise HTTPException(status_code=500, detail="Ошибка загрузки достижений")
+    finally:
+        conn.close()
 
 
-@app.get("/api/user/{target_id}/achievements")
-async def get_user_achievements(target_id: int, telegram_id: int):
-    """Достижения пользователя (для отображения в рейтинге по клику)."""
+@app.get("/api/achievements")
+async def get_achievements(telegram_id: int):
+    """Список всех достижений с флагом получено и процентом обладателей."""
+    return await run_db(_get_achievements, telegram_id)
+
+
+def _get_user_achievements(target_id: int, telegram_id: int):
     conn = get_db()
     if not conn:
         raise HTTPException(500, detail="БД не найдена")
@@ -3125,7 +2954,6 @@ async def get_user_achievements(target_id: int, telegram_id: int):
         row = execute(conn, "SELECT fio FROM users WHERE telegram_id = ?", (target_id,)).fetchone()
         if not row:
             return {"fio": "—", "achievements": []}
-        _unlock_achievements(conn, target_id)
         achs = execute(conn, """
             SELECT a.id, a.title, a.description, a.icon_url,
                    ua.telegram_id IS NOT NULL AS unlocked
@@ -3141,6 +2969,12 @@ async def get_user_achievements(target_id: int, telegram_id: int):
         conn.close()
 
 
+@app.get("/api/user/{target_id}/achievements")
+async def get_user_achievements(target_id: int, telegram_id: int):
+    """Достижения пользователя (для отображения в рейтинге по клику)."""
+    return await run_db(_get_user_achievements, target_id, telegram_id)
+
+
 # ============================================
 # 5. ОПРОСНИК (SURVEY) API — попарное сравнение 2/1/0
 # ============================================
@@ -3169,7 +3003,6 @@ async def get_survey_list(telegram_id: int):
             (telegram_id,)
         ).fetchone()
         if not user:
-            conn.close()
             return {"system": [], "custom": []}
         gender = user["gender"] or "male"
         group_name = user["group_name"] or ""
@@ -3204,11 +3037,12 @@ async def get_survey_list(telegram_id: int):
                 "completed_at": r["completed_at"],
                 "can_complete": r["created_by_telegram_id"] == telegram_id or role in ("admin", "assistant"),
             })
-        conn.close()
         return {"system": system, "custom": custom, "user_gender": gender}
     except Exception as e:
         print(f"[ERROR] Ошибка списка опросов: {e}")
         raise HTTPException(status_code=500, detail="Ошибка базы данных")
+    finally:
+        conn.close()
 
 
 @app.get("/api/survey/pairs")
@@ -3230,7 +3064,6 @@ async def get_survey_pairs(stage: str = "main"):
                 "SELECT id FROM duty_objects WHERE name = 'Опрос девушек' AND parent_id IS NULL"
             ).fetchone()
             if not female_parent:
-                conn.close()
                 return {"pairs": [], "stage": stage}
             rows = execute(conn,
                 "SELECT id, name FROM duty_objects WHERE parent_id = ? ORDER BY id",
@@ -3238,7 +3071,6 @@ async def get_survey_pairs(stage: str = "main"):
             ).fetchall()
             objects = [{"id": r["id"], "name": r["name"]} for r in rows]
             pairs = _get_all_pairs(objects)
-            conn.close()
             return {"pairs": pairs, "stage": stage}
         else:  # canteen — 6 объектов столовой, все возможные пары без повторений (15 пар)
             CANTEEN_OBJECT_NAMES = [
@@ -3248,7 +3080,6 @@ async def get_survey_pairs(stage: str = "main"):
                 "SELECT id FROM duty_objects WHERE name='Столовая' AND parent_id IS NULL"
             ).fetchone()
             if not canteen:
-                conn.close()
                 return {"pairs": [], "stage": stage}
             rows = execute(conn,
                 "SELECT id, name FROM duty_objects WHERE parent_id = ? ORDER BY id",
@@ -3264,17 +3095,17 @@ async def get_survey_pairs(stage: str = "main"):
             objects = [o for o in objects if o["id"] not in seen and not seen.add(o["id"])]
             pairs = _get_all_pairs(objects)
             random.shuffle(pairs)
-            conn.close()
             return {"pairs": pairs, "stage": stage}
         
         objects = [{"id": r["id"], "name": r["name"]} for r in rows]
         pairs = _get_all_pairs(objects)
         random.shuffle(pairs)
-        conn.close()
         return {"pairs": pairs, "stage": stage}
     except Exception as e:
         print(f"[ERROR] Ошибка получения пар: {e}")
         raise HTTPException(status_code=500, detail="Ошибка базы данных")
+    finally:
+        conn.close()
 
 
 @app.post("/api/survey/pair-vote")
@@ -3497,20 +3328,25 @@ async def finalize_survey(data: dict):
         raise HTTPException(status_code=500, detail="База данных не найдена")
     try:
         user = execute(conn,"SELECT role FROM users WHERE telegram_id = ?", (admin_id,)).fetchone()
-        if not user or user['role'] not in ('admin', 'assistant'):
-            raise HTTPException(status_code=403, detail="Недостаточно прав")
     except Exception:
+        conn.close()
         raise HTTPException(status_code=500, detail="Ошибка проверки прав")
-    finally:
+    if not user or user['role'] not in ('admin', 'assistant'):
         conn.close()
+        raise HTTPException(status_code=403, detail="Недостаточно прав")
 
-    conn = get_db()
     try:
         stage = (data.get('stage') or '').strip() or None
         if stage and stage not in ('main', 'canteen', 'female'):
             stage = None
         voted = execute(conn,"SELECT COUNT(DISTINCT user_id) as cnt FROM survey_pair_votes").fetchone()["cnt"]
         _calc_weights_from_pair_votes(conn, stage_filter=stage)
+        # Новые веса меняют очки за все наряды — леджер и топы перестраиваются целиком;
+        # меняется и набор тяжёлых объектов столовой — агрегаты истории тоже
+        rebuild_user_points(conn)
+        rebuild_leaderboards(conn)
+        rebuild_assignment_stats(conn)
+        evaluate_achievements(conn)
         conn.commit()
         from datetime import date as date_type
         today = date_type.today()
@@ -3537,7 +3373,6 @@ async def get_survey_pair_stats(stage: str = "main"):
                 "SELECT id FROM duty_objects WHERE name = 'Опрос девушек' AND parent_id IS NULL"
             ).fetchone()
             if not female_parent:
-                conn.close()
                 return {"pairs": []}
             rows = execute(conn,
                 "SELECT id, name FROM duty_objects WHERE parent_id = ? ORDER BY id",
@@ -3548,7 +3383,6 @@ async def get_survey_pair_stats(stage: str = "main"):
                 "SELECT id FROM duty_objects WHERE name = 'Столовая' AND parent_id IS NULL"
             ).fetchone()
             if not canteen:
-                conn.close()
                 return {"pairs": []}
             rows = execute(conn,
                 "SELECT id, name FROM duty_objects WHERE parent_id = ? ORDER BY id",
@@ -3587,11 +3421,12 @@ async def get_survey_pair_stats(stage: str = "main"):
                 "pct_b": round(100 * counts["b"] / total, 1),
                 "pct_equal": round(100 * counts["equal"] / total, 1),
             })
-        conn.close()
         return {"pairs": pairs, "stage": stage}
     except Exception as e:
         print(f"[ERROR] pair-stats: {e}")
         raise HTTPException(status_code=500, detail="Ошибка базы данных")
+    finally:
+        conn.close()
 
 
 @app.get("/api/survey/results")
@@ -3736,13 +3571,14 @@ async def create_custom_survey(data: dict):
                     (survey_id, str(text).strip(), i)
                 )
         conn.commit()
-        conn.close()
         return {"status": "ok", "survey_id": survey_id}
     except HTTPException:
         raise
     except Exception as e:
         print(f"[ERROR] Создание опроса: {e}")
         raise HTTPException(status_code=500, detail="Ошибка базы данных")
+    finally:
+        conn.close()
 
 
 @app.get("/api/survey/custom/{survey_id}")
@@ -3778,7 +3614,6 @@ async def get_custom_survey(survey_id: int, telegram_id: int):
         can_complete = s["completed_at"] is None and (
             s["created_by_telegram_id"] == telegram_id or role in ("admin", "assistant")
         )
-        conn.close()
         return {
             "id": s["id"],
             "title": s["title"],
@@ -3794,6 +3629,8 @@ async def get_custom_survey(survey_id: int, telegram_id: int):
     except Exception as e:
         print(f"[ERROR] Опрос: {e}")
         raise HTTPException(status_code=500, detail="Ошибка базы данных")
+    finally:
+        conn.close()
 
 
 @app.post("/api/survey/custom/{survey_id}/vote")
@@ -3820,13 +3657,14 @@ async def vote_custom_survey(survey_id: int, data: dict):
             (survey_id, telegram_id, option_id)
         )
         conn.commit()
-        conn.close()
         return {"status": "ok"}
     except HTTPException:
         raise
     except Exception as e:
         print(f"[ERROR] Голос: {e}")
         raise HTTPException(status_code=500, detail="Ошибка базы данных")
+    finally:
+        conn.close()
 
 
 @app.post("/api/survey/custom/{survey_id}/complete")
@@ -3845,7 +3683,6 @@ async def complete_custom_survey(survey_id: int, data: dict):
         if not s:
             raise HTTPException(status_code=404, detail="Опрос не найден")
         if s["completed_at"]:
-            conn.close()
             return {"status": "ok", "message": "Уже завершён"}
         user = execute(conn,"SELECT role FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
         if not user or (user["role"] not in ("admin", "assistant") and s["created_by_telegram_id"] != telegram_id):
@@ -3856,13 +3693,14 @@ async def complete_custom_survey(survey_id: int, data: dict):
             (datetime.utcnow().isoformat(), survey_id)
         )
         conn.commit()
-        conn.close()
         return {"status": "ok"}
     except HTTPException:
         raise
     except Exception as e:
         print(f"[ERROR] Завершение опроса: {e}")
         raise HTTPException(status_code=500, detail="Ошибка базы данных")
+    finally:
+        conn.close()
 
 
 # ============================================
@@ -3913,15 +3751,12 @@ async def get_avatar(telegram_id: int):
     raise HTTPException(status_code=404, detail="Аватар не найден")
 
 
-@app.get("/api/profile/full")
-async def get_full_profile(telegram_id: int):
-    """Полная информация для страницы профиля."""
+def _get_full_profile(telegram_id: int):
     conn = get_db()
     if not conn:
         raise HTTPException(status_code=500, detail="База данных не найдена")
     try:
-        cursor = execute(conn, "PRAGMA table_info(users)")
-        cols = [r['name'] for r in cursor.fetchall()]
+        cols = table_columns(conn, "users")
         name_col = 'fio' if 'fio' in cols else 'full_name'
         group_col = 'group_name' if 'group_name' in cols else None
         
@@ -3950,21 +3785,15 @@ async def get_full_profile(telegram_id: int):
                 break
         
         # Duty stats
-        points = _get_user_duty_points(conn, telegram_id, None, None)
-        fio_variants = _fio_match_variants(fio) or [fio or ""]
-        placeholders = ",".join(["?"] * len(fio_variants))
+        points = _get_user_duty_points(conn, telegram_id)
         try:
-            duty_count = execute(conn,
-                f"SELECT COUNT(*) as cnt FROM duty_schedule WHERE fio IN ({placeholders})",
-                tuple(fio_variants)
-            ).fetchone()
+            duty_count = execute(conn, duty_queries.USER_DUTY_COUNT, (telegram_id,)).fetchone()
             total_duties = duty_count['cnt'] if duty_count else 0
         except Exception:
             total_duties = 0
         
         # Achievements
         try:
-            _unlock_achievements(conn, telegram_id)
             achs = execute(conn, """
                 SELECT a.id, a.title, a.description, a.icon_url,
                        ua.telegram_id IS NOT NULL AS unlocked
@@ -3990,13 +3819,6 @@ async def get_full_profile(telegram_id: int):
         
         test_role = None
         try:
-            execute(conn, """
-                CREATE TABLE IF NOT EXISTS user_test_roles (
-                    telegram_id INTEGER PRIMARY KEY,
-                    role TEXT NOT NULL,
-                    updated_at TEXT DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
             tr = execute(conn, "SELECT role FROM user_test_roles WHERE telegram_id = ?", (telegram_id,)).fetchone()
             if tr and tr.get("role"):
                 test_role = tr["role"]
@@ -4028,6 +3850,12 @@ async def get_full_profile(telegram_id: int):
         conn.close()
 
 
+@app.get("/api/profile/full")
+async def get_full_profile(telegram_id: int):
+    """Полная информация для страницы профиля."""
+    return await run_db(_get_full_profile, telegram_id)
+
+
 @app.post("/api/profile/update")
 async def update_profile(data: dict):
     """Обновить ФИО и другие данные профиля текущего пользователя."""
@@ -4039,8 +3867,7 @@ async def update_profile(data: dict):
     if not conn:
         raise HTTPException(status_code=500, detail="База данных не найдена")
     try:
-        cursor = execute(conn, "PRAGMA table_info(users)")
-        cols = [r["name"] for r in cursor.fetchall()]
+        cols = table_columns(conn, "users")
         name_col = "fio" if "fio" in cols else "full_name"
         if name_col not in cols:
             raise HTTPException(status_code=400, detail="Поле ФИО не найдено в базе")
@@ -4048,6 +3875,7 @@ async def update_profile(data: dict):
             if len(fio) < 2 or len(fio) > 200:
                 raise HTTPException(status_code=400, detail="ФИО: от 2 до 200 символов")
             execute(conn, f"UPDATE users SET {name_col} = ? WHERE telegram_id = ?", (fio, telegram_id))
+            refresh_user_fio_aliases(conn, telegram_id)
             conn.commit()
             return {"status": "ok", "fio": fio}
         return {"status": "ok"}
@@ -4069,13 +3897,6 @@ async def set_test_role(data: dict):
     if not conn:
         raise HTTPException(status_code=500, detail="База данных не найдена")
     try:
-        execute(conn, """
-            CREATE TABLE IF NOT EXISTS user_test_roles (
-                telegram_id INTEGER PRIMARY KEY,
-                role TEXT NOT NULL,
-                updated_at TEXT DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
         if role:
             execute(conn, """
                 INSERT INTO user_test_roles (telegram_id, role) VALUES (?, ?)
@@ -4204,9 +4025,7 @@ async def get_week_schedule_by_group(group: str, year: int, date: str = None):
     return {"week_start": monday.strftime("%Y-%m-%d"), "group": group, "year": year, "schedule": week_schedule, "message": message}
 
 
-@app.get("/api/rating/top-enhanced")
-async def rating_top_enhanced(telegram_id: int, period: str = "all", scope: str = "course", limit: int = 30):
-    """Расширенный топ рейтинга с аватарами и изменением за сегодня."""
+def _rating_top_enhanced(telegram_id: int, period: str = "all", scope: str = "course", limit: int = 30):
     conn = get_db()
     if not conn:
         raise HTTPException(status_code=500, detail="База данных не найдена")
@@ -4215,16 +4034,19 @@ async def rating_top_enhanced(telegram_id: int, period: str = "all", scope: str
         if not user:
             return {"top": []}
         ey = user["enrollment_year"]
-        month_from = datetime.now().strftime("%Y-%m") if period == "month" else None
-        month_to = datetime.now().strftime("%Y-%m") if period == "month" else None
-        if scope == "course":
-            rows = execute(conn, "SELECT telegram_id, fio, group_name FROM users WHERE enrollment_year = ? AND status = 'активен'", (ey,)).fetchall()
-        else:
-            rows = execute(conn, "SELECT telegram_id, fio, group_name FROM users WHERE status = 'активен'").fetchall()
+        now = datetime.now()
+        period_ym = now.strftime("%Y-%m") if period == "month" else ALL_PERIOD
+        scope = SCOPE_COURSE if scope == "course" else SCOPE_INSTITUTE
+        ranking = _duty_points_ranking(conn, scope, ey, period_ym, limit)
+        history = _rank_history(conn, [r["telegram_id"] for r in ranking], scope, period_ym,
+                                (now - timedelta(days=RANK_HISTORY_DAYS)).strftime("%Y-%m-%d"))
+        today = now.strftime("%Y-%m-%d")
         result = []
-        for r in rows:
+        for r in ranking:
             tid = r["telegram_id"]
-            p = _get_user_duty_points(conn, tid, month_from, month_to)
+            snapshots = history.get(tid, [])
+            # Изменение за сегодня: место на начало дня минус текущее (плюс — поднялся)
+            rank_change = snapshots[-1][1] - r["rank"] if snapshots and snapshots[-1][0] == today else None
             avatar_url = None
             for ext in (".jpg", ".jpeg", ".png", ".webp", ".gif"):
                 if os.path.isfile(os.path.join(AVATARS_DIR, f"{tid}{ext}")):
@@ -4234,18 +4056,23 @@ async def rating_top_enhanced(telegram_id: int, period: str = "all", scope: str
                 "telegram_id": tid,
                 "fio": r["fio"],
                 "group_name": r["group_name"],
-                "points": p,
+                "points": r["points"],
                 "avatar_url": avatar_url,
+                "rank": r["rank"],
+                "rank_change": rank_change,
+                "trend": [rank for date, rank in snapshots if date != today] + [r["rank"]],
             })
-        result.sort(key=lambda x: -x["points"])
-        result = result[:limit]
-        for i, row in enumerate(result):
-            row["rank"] = i + 1
         return {"top": result, "period": period, "scope": scope}
     finally:
         conn.close()
 
 
+@app.get("/api/rating/top-enhanced")
+async def rating_top_enhanced(telegram_id: int, period: str = "all", scope: str = "course", limit: int = 30):
+    """Расширенный топ рейтинга с аватарами, изменением места за сегодня (rank_change) и трендом мест по дням (trend)."""
+    return await run_db(_rating_top_enhanced, telegram_id, period, scope, limit)
+
+
 # ============================================
 # 6. СТАТИКА И ГЛАВНАЯ (исправлено: не подменяем пути)
 # ============================================
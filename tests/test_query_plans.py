@@ -0,0 +1,114 @@
+# tests/test_query_plans.py — планы запросов к duty_schedule (EXPLAIN QUERY PLAN на схеме init_db + миграции).
+# Запросы берутся из кода (utils/duty_queries.py и движки), поэтому правка запроса или индексов, которая вернёт
+# полный проход таблицы, ломает тест.
+
+import os
+import re
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+from utils import duty_queries  # noqa: E402
+from utils.distribution import (  # noqa: E402
+    CANTEEN_PEOPLE_QUERY, DATE_YEARS_QUERY, PERIOD_SCHEDULE_QUERY, SHIFT_PEOPLE_QUERY,
+)
+from utils.fio import LINK_USER_ROWS_QUERY  # noqa: E402
+from utils.points import USER_DUTIES_QUERY, course_month_points_query  # noqa: E402
+from utils.schedule_snapshot import MONTH_SCHEDULE_QUERY  # noqa: E402
+
+# Уникальный ключ (fio, date, enrollment_year) — тоже индекс: точечные запросы по ФИО и дате идут по нему
+UNIQUE_FIO_DATE = "sqlite_autoindex_duty_schedule_1"
+
+# (название, SQL из кода, параметры, допустимые индексы duty_schedule)
+QUERIES = [
+    ("снимок графика курса за месяц (/api/duties, by-date, day-detail)", MONTH_SCHEDULE_QUERY,
+     (2024, "2026-03-01", "2026-04-01"), {"idx_duty_year_date"}),
+    ("by-date без курса", duty_queries.DUTIES_ON_DATE, ("2026-03-01",), {"idx_duty_date_role_year"}),
+    ("распределение по сменам (Курс/ГБР)", SHIFT_PEOPLE_QUERY, ("2026-03-01", "к", 2024),
+     {"idx_duty_date_role_year"}),
+    ("распределение столовой", CANTEEN_PEOPLE_QUERY, ("2026-03-01", 2024), {"idx_duty_date_role_year"}),
+    ("план на период", PERIOD_SCHEDULE_QUERY, (2024, "2026-03-01", "2026-04-01"),
+     {"idx_duty_year_date", "idx_duty_date_role_year"}),
+    ("курсы на дату (распределение при фиксации)", DATE_YEARS_QUERY, ("2026-03-01",), {"idx_duty_date_role_year"}),
+    ("мои наряды за месяц: курсы", duty_queries.USER_MONTH_YEARS, (1, "2026-03-01", "2026-04-01"),
+     {"idx_duty_user_date"}),
+    ("мои наряды с напарниками", duty_queries.USER_DUTIES_WITH_PARTNERS, (1, 1),
+     {"idx_duty_user_date", "idx_duty_date_role_year"}),
+    ("число нарядов в профиле", duty_queries.USER_DUTY_COUNT, (1,), {"idx_duty_user_date"}),
+    # без статистики по данным планировщик может выбрать и индекс курса
+    ("очки пользователя", USER_DUTIES_QUERY, (1, 2024), {"idx_duty_user_date", "idx_duty_year_date"}),
+    ("очки курса за месяц", course_month_points_query(1), ("к", 10.0, "2026-03", 2024, "2026-03-01", "2026-04-01"),
+     {"idx_duty_year_date"}),
+    ("привязка строк графика к пользователю", LINK_USER_ROWS_QUERY, (1, 2024, 1),
+     {"idx_duty_fio_year_date", UNIQUE_FIO_DATE, "idx_duty_user_date"}),
+    ("каталог месяцев курса", duty_queries.REFRESH_MONTH_CATALOG, ("2026-03", 2024, "2026-03-01", "2026-04-01"),
+     {"idx_duty_year_date"}),
+    ("удаление месяца группы", duty_queries.DELETE_GROUP_MONTH, ("ИО6", 2024, "2026-03-01", "2026-04-01"),
+     {"idx_duty_group_year_date"}),
+    ("удаление месяца курса", duty_queries.DELETE_COURSE_MONTH, (2024, "2026-03-01", "2026-04-01"),
+     {"idx_duty_year_date"}),
+    ("контекст правки графика: группа", duty_queries.GROUP_MONTH_CADETS, (2024, "ИО6", "2026-03-01", "2026-04-01"),
+     {"idx_duty_group_year_date", "idx_duty_year_date"}),
+    ("контекст правки графика: курс", duty_queries.COURSE_MONTH_CADETS, (2024, "2026-03-01", "2026-04-01"),
+     {"idx_duty_year_date"}),
+    ("наряд курсанта на дату", duty_queries.CADET_DUTY_ON_DATE, ("2026-03-01", 2024, "Иванов И.И."),
+     {"idx_duty_fio_year_date", UNIQUE_FIO_DATE}),
+    ("смена роли в наряде", duty_queries.SET_DUTY_ROLE, ("гбр", "2026-03-01", 2024, "Иванов И.И."),
+     {"idx_duty_fio_year_date", UNIQUE_FIO_DATE}),
+    ("строка наряда", duty_queries.DUTY_ROW, ("2026-03-01", "к", 2024, "Иванов И.И."),
+     {"idx_duty_date_role_year", "idx_duty_fio_year_date", UNIQUE_FIO_DATE}),
+    ("замена в наряде", duty_queries.REPLACE_DUTY_PERSON, ("Петров П.П.", None, "2026-03-01", "к", 2024, "Иванов И.И."),
+     {"idx_duty_date_role_year", "idx_duty_fio_year_date", UNIQUE_FIO_DATE}),
+    ("удаление из наряда", duty_queries.DELETE_DUTY_PERSON, ("2026-03-01", "к", 2024, "Иванов И.И."),
+     {"idx_duty_date_role_year", "idx_duty_fio_year_date", UNIQUE_FIO_DATE}),
+]
+
+_INDEX_RE = re.compile(r"USING (?:COVERING )?INDEX (\w+)")
+
+
+@pytest.fixture(scope="module")
+def conn(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("db") / "bot.db")
+    old_name = database.DB_NAME
+    database.DB_NAME = path
+    try:
+        database.init_db()
+    finally:
+        database.DB_NAME = old_name
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    yield conn
+    conn.close()
+
+
+def _duty_schedule_steps(conn, sql, params):
+    """Шаги плана, которые читают duty_schedule (по псевдониму или имени таблицы)."""
+    aliases = {"duty_schedule"} | set(re.findall(r"duty_schedule\s+(?:AS\s+)?(\w+)", sql))
+    aliases -= {"WHERE", "SET", "ORDER", "GROUP", "LEFT", "JOIN"}
+    steps = []
+    for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall():
+        detail = row["detail"]
+        m = re.match(r"(?:SCAN|SEARCH) (\w+)", detail)
+        if m and m.group(1) in aliases:
+            steps.append(detail)
+    return steps
+
+
+@pytest.mark.parametrize("name, sql, params, indexes", QUERIES, ids=[q[0] for q in QUERIES])
+def test_duty_schedule_query_uses_index(conn, name, sql, params, indexes):
+    steps = _duty_schedule_steps(conn, sql, params)
+    assert steps, f"{name}: в плане нет чтения duty_schedule"
+    for detail in steps:
+        m = _INDEX_RE.search(detail)
+        assert m, f"{name}: полный проход duty_schedule — {detail}"
+        assert m.group(1) in indexes, f"{name}: ожидался индекс из {sorted(indexes)} — {detail}"
+
+
+def test_shift_people_are_read_from_covering_index(conn):
+    """Участники наряда Курс/ГБР читаются только из индекса, без обращения к таблице."""
+    steps = _duty_schedule_steps(conn, SHIFT_PEOPLE_QUERY, ("2026-03-01", "к", 2024))
+    assert len(steps) == 1 and "USING COVERING INDEX idx_duty_date_role_year" in steps[0], steps
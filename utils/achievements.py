@@ -0,0 +1,91 @@
+# utils/achievements.py — выдача достижений по правилам (user_achievements).
+# Правило — запрос, который возвращает telegram_id всех, кто выполнил условие. После правки графика и привязки
+# строк проверяются только пользователи, чьи очки или места изменились (utils/points.py возвращает их);
+# новые веса опроса и ежедневная сверка проверяют всех. Эндпоинты достижений только читают user_achievements.
+# Достижения не отзываются: выданное остаётся, даже если условие перестало выполняться.
+# Число обладателей каждого достижения кэшируется в памяти процесса и сбрасывается при новых выдачах;
+# TTL ограничивает устаревание, если достижения выдал другой процесс (бот).
+
+import os
+import threading
+import time
+
+from db import execute
+from utils.points import ALL_PERIOD, SCOPE_COURSE, SCOPE_INSTITUTE
+
+# id достижения → (SQL, параметры): telegram_id пользователей, выполнивших условие
+ACHIEVEMENT_RULES = {
+    # 10 нарядов за всё время (строки графика, привязанные к пользователю в его курсе)
+    "first_10_duties": (
+        "SELECT telegram_id FROM user_points WHERE period_ym = ? AND duty_count >= 10",
+        (ALL_PERIOD,),
+    ),
+    # места в топе по очкам за всё время
+    "top3_course": (
+        "SELECT telegram_id FROM leaderboards WHERE scope = ? AND period_ym = ? AND rank <= 3",
+        (SCOPE_COURSE, ALL_PERIOD),
+    ),
+    "top10_institute": (
+        "SELECT telegram_id FROM leaderboards WHERE scope = ? AND period_ym = ? AND rank <= 10",
+        (SCOPE_INSTITUTE, ALL_PERIOD),
+    ),
+}
+
+
+# Больше затронутых пользователей — один проход по всем вместо длинного IN (...)
+ACHIEVEMENT_SCOPE_LIMIT = 500
+
+
+def evaluate_achievements(conn, telegram_ids=None) -> int:
+    """Проверить все правила (один INSERT ... SELECT на правило): для telegram_ids — только этих пользователей
+    (затронутых изменением леджера или топов), без них — всех. Возвращает число новых выдач (при выдаче
+    сбрасывает кэш обладателей). Коммит — на вызывающем."""
+    scope, scope_params = "", ()
+    if telegram_ids is not None:
+        telegram_ids = sorted(set(telegram_ids))
+        if not telegram_ids:
+            return 0
+        if len(telegram_ids) <= ACHIEVEMENT_SCOPE_LIMIT:
+            scope = f" AND q.telegram_id IN ({','.join(['?'] * len(telegram_ids))})"
+            scope_params = tuple(telegram_ids)
+    unlocked = 0
+    for achievement_id, (sql, params) in ACHIEVEMENT_RULES.items():
+        cur = execute(conn, f"""
+            INSERT INTO user_achievements (telegram_id, achievement_id)
+            SELECT q.telegram_id, ? FROM ({sql}) q
+            WHERE EXISTS (SELECT 1 FROM achievements a WHERE a.id = ?){scope}
+            ON CONFLICT (telegram_id, achievement_id) DO NOTHING
+        """, (achievement_id, *params, achievement_id, *scope_params))
+        unlocked += max(cur.rowcount, 0)
+    if unlocked:
+        invalidate_ownership_cache()
+    return unlocked
+
+
+OWNERSHIP_CACHE_TTL = float(os.getenv("ACHIEVEMENT_OWNERSHIP_TTL", "60"))
+
+_ownership = None  # (истекает_в, {achievement_id: обладателей}, активных пользователей)
+_ownership_lock = threading.Lock()
+
+
+def invalidate_ownership_cache():
+    global _ownership
+    with _ownership_lock:
+        _ownership = None
+
+
+def achievement_ownership(conn):
+    """({achievement_id: число обладателей}, число активных пользователей) — из кэша или двумя запросами
+    (один GROUP BY по user_achievements)."""
+    global _ownership
+    with _ownership_lock:
+        cached = _ownership
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1], cached[2]
+    counts = {r["achievement_id"]: r["cnt"] for r in execute(conn, """
+        SELECT achievement_id, COUNT(*) AS cnt FROM user_achievements GROUP BY achievement_id
+    """).fetchall()}
+    total_users = execute(conn, "SELECT COUNT(*) FROM users WHERE status = 'активен'").fetchone()[0]
+    with _ownership_lock:
+        _ownership = (time.monotonic() + OWNERSHIP_CACHE_TTL, counts, total_users)
+    return counts, total_users
@@ -0,0 +1,559 @@
+# utils/distribution.py — распределение наряда по сменам (Курс/ГБР) и объектам столовой.
+# Общий движок для server.py (day-detail, ручной запуск) и бота (handlers/duty_distributor.py).
+# Все данные для расчёта читаются пачкой, назначения считаются в памяти и пишутся одной транзакцией.
+# План на месяц вперёд пишется с provisional = 1 и в FREEZE_HOUR:FREEZE_MINUTE дня наряда фиксируется
+# (provisional = 0, запись в duty_assignment_history). До фиксации предварительный план не показывается.
+# Приоритет в столовой считается по компактному агрегату assignment_stats (последние объекты, серия тяжёлых,
+# счётчики по объектам), который обновляется вместе с каждой записью в историю; старая история архивируется.
+
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from db import execute, execute_many, transaction
+from utils.schedule_snapshot import month_bounds
+
+CANTEEN_OBJECTS = ["ГЦ", "овощи", "тарелки", "железо", "стаканы", "лента"]
+SHIFT_ROLES = ["к", "гбр"]
+# Объект с весом от HEAVY_OBJECT_WEIGHT — тяжёлый; два тяжёлых подряд дают штраф к приоритету
+HEAVY_OBJECT_WEIGHT = 12
+HEAVY_STREAK_PENALTY = 5
+# Сколько последних объектов хранится в assignment_stats.last_objects
+CANTEEN_HISTORY_DEPTH = 5
+# Распределение фиксируется за 3 часа до развода (18:30)
+FREEZE_HOUR = 15
+FREEZE_MINUTE = 30
+# Распределение по запросу (day-detail) — один расчёт на (дата, роль, курс); остальные ждут его результата
+DISTRIBUTION_WAIT_SECONDS = 10
+DISTRIBUTION_STALE_SECONDS = 60
+# Сырая история назначений старше стольких дней переносится в архив
+ASSIGNMENT_HISTORY_DAYS = int(os.getenv("ASSIGNMENT_HISTORY_DAYS", "365"))
+
+# Запросы к duty_schedule (планы проверяет tests/test_query_plans.py)
+# Участники наряда Курс/ГБР на дату: (дата, роль, курс)
+SHIFT_PEOPLE_QUERY = """
+    SELECT fio FROM duty_schedule
+    WHERE date = ? AND role = ? AND enrollment_year = ?
+    ORDER BY fio
+"""
+# Участники столовой на дату с рейтингом: (дата, курс)
+CANTEEN_PEOPLE_QUERY = """
+    SELECT ds.fio, u.global_score
+    FROM duty_schedule ds
+    LEFT JOIN users u ON u.telegram_id = ds.user_id
+    WHERE ds.date = ? AND ds.role = 'с' AND ds.enrollment_year = ?
+    ORDER BY ds.fio
+"""
+# Распределяемые наряды курса за период: (курс, с, по — не включая)
+PERIOD_SCHEDULE_QUERY = """
+    SELECT ds.date, ds.role, ds.fio, u.global_score
+    FROM duty_schedule ds
+    LEFT JOIN users u ON u.telegram_id = ds.user_id
+    WHERE ds.enrollment_year = ? AND ds.date >= ? AND ds.date < ? AND ds.role IN ('к', 'гбр', 'с')
+    ORDER BY ds.date, ds.role, ds.fio
+"""
+# Курсы с распределяемыми нарядами на дату: (дата,)
+DATE_YEARS_QUERY = """
+    SELECT DISTINCT enrollment_year FROM duty_schedule WHERE date = ? AND role IN ('к', 'гбр', 'с')
+"""
+
+_flight_locks = {}  # ключ → [блокировка, число ждущих и держащих]; запись удаляется за последним
+_flight_guard = threading.Lock()
+
+
+def past_freeze_time(date_str, now=None) -> bool:
+    """Наступило ли время фиксации распределения на дату (FREEZE_HOUR:FREEZE_MINUTE того же дня)."""
+    try:
+        freeze_at = datetime.strptime(str(date_str), "%Y-%m-%d").replace(hour=FREEZE_HOUR, minute=FREEZE_MINUTE)
+    except ValueError:
+        return False
+    return (now or datetime.now()) >= freeze_at
+
+
+def load_object_weights(conn) -> dict:
+    """Веса объектов: имя объекта → вес (по умолчанию у объекта 10)."""
+    try:
+        rows = execute(conn, """
+            SELECT o.name, ow.weight FROM duty_objects o
+            JOIN object_weights ow ON o.id = ow.object_id
+        """).fetchall()
+    except Exception:
+        return {}
+    return {r["name"]: r["weight"] for r in rows}
+
+
+def _heavy_objects(weights: dict) -> set:
+    return {o for o in CANTEEN_OBJECTS if weights.get(o, 10) >= HEAVY_OBJECT_WEIGHT}
+
+
+def _empty_stats() -> dict:
+    return {"last_objects": [], "heavy_streak": 0, "per_object_counts": {}}
+
+
+def _advance_stats(stats: dict, obj: str, heavy: set):
+    """Учесть новое (самое свежее) назначение на объект в агрегате человека."""
+    stats["last_objects"] = [obj] + stats["last_objects"][:CANTEEN_HISTORY_DEPTH - 1]
+    stats["heavy_streak"] = stats["heavy_streak"] + 1 if obj in heavy else 0
+    stats["per_object_counts"][obj] = stats["per_object_counts"].get(obj, 0) + 1
+
+
+def load_assignment_stats(conn, fios, ey) -> dict:
+    """Агрегаты столовой (assignment_stats) для fios одним запросом: fio → {"last_objects" (свежие первыми),
+    "heavy_streak", "per_object_counts"}. У кого назначений не было, в результате нет."""
+    if not fios:
+        return {}
+    placeholders = ",".join(["?"] * len(fios))
+    rows = execute(conn, f"""
+        SELECT fio, last_objects, heavy_streak, per_object_counts FROM assignment_stats
+        WHERE enrollment_year = ? AND fio IN ({placeholders})
+    """, (ey, *fios)).fetchall()
+    return {
+        r["fio"]: {
+            "last_objects": json.loads(r["last_objects"] or "[]"),
+            "heavy_streak": r["heavy_streak"] or 0,
+            "per_object_counts": json.loads(r["per_object_counts"] or "{}"),
+        }
+        for r in rows
+    }
+
+
+def _save_assignment_stats(conn, ey, stats: dict):
+    execute_many(conn, """
+        INSERT INTO assignment_stats (fio, enrollment_year, last_objects, heavy_streak, per_object_counts, updated_at)
+        VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT (fio, enrollment_year) DO UPDATE SET
+            last_objects = excluded.last_objects,
+            heavy_streak = excluded.heavy_streak,
+            per_object_counts = excluded.per_object_counts,
+            updated_at = excluded.updated_at
+    """, [
+        (fio, ey, json.dumps(s["last_objects"], ensure_ascii=False), s["heavy_streak"],
+         json.dumps(s["per_object_counts"], ensure_ascii=False))
+        for fio, s in stats.items()
+    ])
+
+
+def record_canteen_assignments(conn, ey, assignments: list, weights: dict):
+    """Дописать назначения столовой [{"fio", "object"}] в assignment_stats. Вызывается в транзакции записи
+    назначений в историю — агрегат всегда соответствует duty_assignment_history."""
+    if not assignments:
+        return
+    stats = load_assignment_stats(conn, [a["fio"] for a in assignments], ey)
+    heavy = _heavy_objects(weights)
+    for a in assignments:
+        _advance_stats(stats.setdefault(a["fio"], _empty_stats()), a["object"], heavy)
+    _save_assignment_stats(conn, ey, {a["fio"]: stats[a["fio"]] for a in assignments})
+
+
+def _history_stats(conn, heavy: set, ey=None, fios=None) -> dict:
+    """Агрегаты столовой по сырой истории и архиву: {ey: {fio: stats}}; ey и fios — фильтр."""
+    where = "role = 'с' AND sub_object IS NOT NULL"
+    params = []
+    if ey is not None:
+        where += " AND enrollment_year = ?"
+        params.append(ey)
+    if fios is not None:
+        where += f" AND fio IN ({','.join(['?'] * len(fios))})"
+        params += list(fios)
+    rows = execute(conn, f"""
+        SELECT fio, enrollment_year, sub_object, date, id FROM duty_assignment_history WHERE {where}
+        UNION ALL
+        SELECT fio, enrollment_year, sub_object, date, id FROM duty_assignment_history_archive WHERE {where}
+        ORDER BY enrollment_year, fio, date, id
+    """, tuple(params) * 2).fetchall()
+    by_year = {}
+    for r in rows:
+        stats = by_year.setdefault(r["enrollment_year"], {}).setdefault(r["fio"], _empty_stats())
+        _advance_stats(stats, r["sub_object"], heavy)
+    return by_year
+
+
+def rebuild_assignment_stats(conn):
+    """Пересчитать assignment_stats по всей истории назначений (заполнение при миграции, новые веса опроса —
+    меняется набор тяжёлых объектов). Коммит — на вызывающем."""
+    by_year = _history_stats(conn, _heavy_objects(load_object_weights(conn)))
+    execute(conn, "DELETE FROM assignment_stats")
+    for ey, stats in by_year.items():
+        _save_assignment_stats(conn, ey, stats)
+
+
+def _recount_assignment_stats(conn, ey, fios, weights: dict):
+    """Пересчитать агрегаты fios по истории — когда вклад даты заменён (повторное распределение)."""
+    fios = sorted(set(fios))
+    stats = _history_stats(conn, _heavy_objects(weights), ey, fios).get(ey, {})
+    _save_assignment_stats(conn, ey, {fio: stats.get(fio, _empty_stats()) for fio in fios})
+
+
+def archive_assignment_history(conn, before_date: str) -> int:
+    """Перенести сырую историю назначений старше before_date в duty_assignment_history_archive.
+    Для распределения она не нужна — приоритет считается по assignment_stats. Возвращает число строк."""
+    with transaction(conn):
+        execute(conn, """
+            INSERT INTO duty_assignment_history_archive (id, fio, date, role, sub_object, shift, enrollment_year, created_at)
+            SELECT id, fio, date, role, sub_object, shift, enrollment_year, created_at
+            FROM duty_assignment_history WHERE date < ?
+        """, (before_date,))
+        moved = execute(conn, "DELETE FROM duty_assignment_history WHERE date < ?", (before_date,)).rowcount
+    return max(moved, 0)
+
+
+def assign_shifts(role: str, people: list) -> list:
+    """Смены для Курс/ГБР по уже перемешанному списку ФИО. Возвращает [{"fio", "shift"}]."""
+    assignments = []
+    if role == "к":
+        # Фиксированный дежурный по курсу (shift=0) + до 3 дневальных (shift=1..3), остальные без смены
+        day_count = min(3, len(people) - 1)
+        for i, fio in enumerate(people):
+            assignments.append({"fio": fio, "shift": i if 1 <= i <= day_count else 0})
+    elif role == "гбр":
+        for i, fio in enumerate(people):
+            assignments.append({"fio": fio, "shift": (i // 2) + 1})
+    else:
+        for i, fio in enumerate(people):
+            assignments.append({"fio": fio, "shift": (i % 3) + 1})
+    return assignments
+
+
+def assign_canteen(people: list, scores: dict, stats: dict, weights: dict) -> list:
+    """Объекты столовой: чем ниже приоритет (0.5 × рейтинг + штраф за два и более тяжёлых объекта подряд),
+    тем тяжелее объект. stats — агрегаты из load_assignment_stats. Возвращает [{"fio", "object"}]."""
+    def priority(fio):
+        streak = stats[fio]["heavy_streak"] if fio in stats else 0
+        return 0.5 * (scores.get(fio) or 0) + (HEAVY_STREAK_PENALTY if streak >= 2 else 0)
+
+    objects_sorted = sorted(CANTEEN_OBJECTS, key=lambda o: weights.get(o, 10), reverse=True)
+    return [
+        {"fio": fio, "object": objects_sorted[i % len(objects_sorted)]}
+        for i, fio in enumerate(sorted(people, key=priority))
+    ]
+
+
+def distribute_shifts_for_date(date_str: str, role: str, ey: int, conn) -> list:
+    """Распределяет людей по сменам для Курс/ГБР; прежнее распределение на дату заменяется.
+    Возвращает список назначений."""
+    rows = execute(conn, SHIFT_PEOPLE_QUERY, (date_str, role, ey)).fetchall()
+    people = [r["fio"] for r in rows]
+    if not people:
+        return []
+    random.shuffle(people)
+    assignments = assign_shifts(role, people)
+    with transaction(conn):
+        execute(conn, "DELETE FROM duty_shift_assignments WHERE date = ? AND role = ? AND enrollment_year = ?",
+                (date_str, role, ey))
+        # Повторное распределение заменяет историю даты, а не дописывает её второй раз
+        execute(conn, "DELETE FROM duty_assignment_history WHERE date = ? AND role = ? AND enrollment_year = ?",
+                (date_str, role, ey))
+        execute_many(conn, """
+            INSERT OR REPLACE INTO duty_shift_assignments (date, role, fio, shift, enrollment_year)
+            VALUES (?, ?, ?, ?, ?)
+        """, [(date_str, role, a["fio"], a["shift"], ey) for a in assignments])
+        execute_many(conn, """
+            INSERT INTO duty_assignment_history (fio, date, role, shift, enrollment_year)
+            VALUES (?, ?, ?, ?, ?)
+        """, [(a["fio"], date_str, role, a["shift"], ey) for a in assignments])
+    return assignments
+
+
+def distribute_canteen_for_date(date_str: str, ey: int, conn, weights: dict = None) -> list:
+    """Распределяет людей по объектам столовой с учётом рейтинга и истории; прежнее распределение заменяется.
+    weights — заранее загруженные веса объектов (при распределении нескольких курсов подряд)."""
+    # Рейтинг — по привязке строки графика к пользователю (duty_schedule.user_id)
+    rows = execute(conn, CANTEEN_PEOPLE_QUERY, (date_str, ey)).fetchall()
+    if not rows:
+        return []
+    people = [r["fio"] for r in rows]
+    scores = {r["fio"]: r["global_score"] for r in rows}
+    if weights is None:
+        weights = load_object_weights(conn)
+    assignments = assign_canteen(people, scores, load_assignment_stats(conn, people, ey), weights)
+    with transaction(conn):
+        execute(conn, "DELETE FROM duty_canteen_assignments WHERE date = ? AND enrollment_year = ?",
+                (date_str, ey))
+        # Повторное распределение: прежний вклад даты в историю и агрегаты заменяется, а не добавляется
+        replaced = [r["fio"] for r in execute(conn, """
+            DELETE FROM duty_assignment_history WHERE date = ? AND role = 'с' AND enrollment_year = ?
+            RETURNING fio
+        """, (date_str, ey)).fetchall()]
+        execute_many(conn, """
+            INSERT OR REPLACE INTO duty_canteen_assignments (date, fio, object_name, enrollment_year)
+            VALUES (?, ?, ?, ?)
+        """, [(date_str, a["fio"], a["object"], ey) for a in assignments])
+        execute_many(conn, """
+            INSERT INTO duty_assignment_history (fio, date, role, sub_object, enrollment_year)
+            VALUES (?, ?, 'с', ?, ?)
+        """, [(a["fio"], date_str, a["object"], ey) for a in assignments])
+        if replaced:
+            _recount_assignment_stats(conn, ey, replaced + people, weights)
+        else:
+            record_canteen_assignments(conn, ey, assignments, weights)
+    return assignments
+
+
+def plan_period(conn, ey, date_from: str, date_to: str, now=None) -> int:
+    """Предварительное распределение курса на даты [date_from, date_to) за один проход (provisional = 1).
+    Даты, для которых время фиксации наступило, и роли с зафиксированными назначениями пропускаются.
+    Прежний предварительный план наряда сохраняется, если состав по графику не изменился (повторный запуск
+    не перемешивает план); пересчитываются только изменившиеся наряды. Агрегаты столовой продолжаются
+    в памяти от даты к дате. Возвращает число новых назначений."""
+    now = now or datetime.now()
+    # Сегодня план ещё можно менять только до фиксации
+    first_open = now.date() + timedelta(days=1 if past_freeze_time(now.strftime("%Y-%m-%d"), now) else 0)
+    date_from = max(date_from, first_open.strftime("%Y-%m-%d"))
+    if date_from >= date_to:
+        return 0
+    period = (ey, date_from, date_to)
+    rows = execute(conn, PERIOD_SCHEDULE_QUERY, period).fetchall()
+    frozen = set()
+    planned = {}
+    for r in execute(conn, """
+        SELECT date, role, fio, shift, provisional FROM duty_shift_assignments
+        WHERE enrollment_year = ? AND date >= ? AND date < ?
+    """, period).fetchall():
+        key = (str(r["date"]), r["role"])
+        if r["provisional"]:
+            planned.setdefault(key, []).append((r["fio"], r["shift"]))
+        else:
+            frozen.add(key)
+    for r in execute(conn, """
+        SELECT date, fio, object_name, provisional FROM duty_canteen_assignments
+        WHERE enrollment_year = ? AND date >= ? AND date < ?
+    """, period).fetchall():
+        key = (str(r["date"]), "с")
+        if r["provisional"]:
+            planned.setdefault(key, []).append((r["fio"], r["object_name"]))
+        else:
+            frozen.add(key)
+    people = {}
+    scores = {}
+    for r in rows:
+        key = (str(r["date"]), r["role"])
+        if key not in frozen:
+            people.setdefault(key, []).append(r["fio"])
+            scores[r["fio"]] = r["global_score"]
+    canteen_people = sorted({fio for (_, role), fios in people.items() if role == "с" for fio in fios})
+    stats = load_assignment_stats(conn, canteen_people, ey)
+    weights = load_object_weights(conn)
+    heavy = _heavy_objects(weights)
+    shift_rows = []
+    canteen_rows = []
+    # Наряды, чей предварительный план заменяется: изменился состав или наряда больше нет в графике
+    replaced = {key for key in planned if key not in people}
+    for date, role in sorted(people):
+        fios = people[(date, role)]
+        kept = planned.get((date, role))
+        if kept and sorted(fio for fio, _ in kept) == sorted(fios):
+            if role == "с":
+                for fio, obj in kept:
+                    _advance_stats(stats.setdefault(fio, _empty_stats()), obj, heavy)
+            continue
+        if kept:
+            replaced.add((date, role))
+        if role == "с":
+            for a in assign_canteen(fios, scores, stats, weights):
+                canteen_rows.append((date, a["fio"], a["object"], ey))
+                _advance_stats(stats.setdefault(a["fio"], _empty_stats()), a["object"], heavy)
+        else:
+            random.shuffle(fios)
+            shift_rows += [(date, role, a["fio"], a["shift"], ey) for a in assign_shifts(role, fios)]
+    if not replaced and not shift_rows and not canteen_rows:
+        return 0
+    with transaction(conn):
+        execute_many(conn, """
+            DELETE FROM duty_shift_assignments
+            WHERE enrollment_year = ? AND date = ? AND role = ? AND provisional = 1
+        """, [(ey, date, role) for date, role in replaced if role != "с"])
+        execute_many(conn, """
+            DELETE FROM duty_canteen_assignments
+            WHERE enrollment_year = ? AND date = ? AND provisional = 1
+        """, [(ey, date) for date, role in replaced if role == "с"])
+        execute_many(conn, """
+            INSERT OR REPLACE INTO duty_shift_assignments (date, role, fio, shift, enrollment_year, provisional)
+            VALUES (?, ?, ?, ?, ?, 1)
+        """, shift_rows)
+        execute_many(conn, """
+            INSERT OR REPLACE INTO duty_canteen_assignments (date, fio, object_name, enrollment_year, provisional)
+            VALUES (?, ?, ?, ?, 1)
+        """, canteen_rows)
+    return len(shift_rows) + len(canteen_rows)
+
+
+def plan_month(conn, ey, ym: str, now=None) -> int:
+    """Предварительное распределение курса на весь месяц YYYY-MM (оставшиеся даты)."""
+    return plan_period(conn, ey, *month_bounds(ym), now=now)
+
+
+def plan_upcoming(conn, now=None) -> list:
+    """План на текущий и следующий месяц для всех курсов с загруженным графиком (неизменившиеся наряды
+    сохраняют прежний план). Возвращает [(ey, ym, число новых назначений)]."""
+    now = now or datetime.now()
+    this_month = now.strftime("%Y-%m")
+    next_month = (now.replace(day=1) + timedelta(days=32)).strftime("%Y-%m")
+    rows = execute(conn, """
+        SELECT DISTINCT enrollment_year, ym FROM schedule_months
+        WHERE ym IN (?, ?)
+        ORDER BY enrollment_year, ym
+    """, (this_month, next_month)).fetchall()
+    return [(r["enrollment_year"], r["ym"], plan_month(conn, r["enrollment_year"], r["ym"], now)) for r in rows]
+
+
+def replan_date(conn, ey, date_str: str):
+    """После правки графика: пересчитать предварительный план на дату, если он есть и ещё не зафиксирован."""
+    if past_freeze_time(date_str):
+        return
+    has_plan = execute(conn, """
+        SELECT 1 FROM duty_shift_assignments WHERE date = ? AND enrollment_year = ? AND provisional = 1
+        UNION ALL
+        SELECT 1 FROM duty_canteen_assignments WHERE date = ? AND enrollment_year = ? AND provisional = 1
+        LIMIT 1
+    """, (date_str, ey, date_str, ey)).fetchone()
+    if has_plan:
+        next_day = (datetime.strptime(date_str, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+        plan_period(conn, ey, date_str, next_day)
+
+
+def freeze_date(conn, date_str: str) -> int:
+    """Зафиксировать предварительное распределение на дату: provisional = 0 и запись в историю назначений.
+    В историю идут только строки, которые снял с плана этот вызов (UPDATE ... RETURNING), — при
+    одновременной фиксации из бота и сервера история не дублируется. Возвращает число назначений."""
+    with transaction(conn):
+        shifts = execute(conn, """
+            UPDATE duty_shift_assignments SET provisional = 0
+            WHERE date = ? AND provisional = 1
+            RETURNING fio, role, shift, enrollment_year
+        """, (date_str,)).fetchall()
+        canteen = execute(conn, """
+            UPDATE duty_canteen_assignments SET provisional = 0
+            WHERE date = ? AND provisional = 1
+            RETURNING fio, object_name, enrollment_year
+        """, (date_str,)).fetchall()
+        execute_many(conn, """
+            INSERT INTO duty_assignment_history (fio, date, role, shift, enrollment_year)
+            VALUES (?, ?, ?, ?, ?)
+        """, [(r["fio"], date_str, r["role"], r["shift"], r["enrollment_year"]) for r in shifts])
+        execute_many(conn, """
+            INSERT INTO duty_assignment_history (fio, date, role, sub_object, enrollment_year)
+            VALUES (?, ?, 'с', ?, ?)
+        """, [(r["fio"], date_str, r["object_name"], r["enrollment_year"]) for r in canteen])
+        if canteen:
+            weights = load_object_weights(conn)
+            for ey in {r["enrollment_year"] for r in canteen}:
+                record_canteen_assignments(conn, ey, [
+                    {"fio": r["fio"], "object": r["object_name"]} for r in canteen if r["enrollment_year"] == ey
+                ], weights)
+    return len(shifts) + len(canteen)
+
+
+@contextmanager
+def _flight_lock(key):
+    """Блокировка на ключ в процессе; запись в _flight_locks живёт, пока её кто-то держит или ждёт."""
+    with _flight_guard:
+        entry = _flight_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _flight_guard:
+            entry[1] -= 1
+            if not entry[1]:
+                del _flight_locks[key]
+
+
+def _has_assignments(conn, date_str: str, role: str, ey) -> bool:
+    if role == "с":
+        row = execute(conn, "SELECT 1 FROM duty_canteen_assignments WHERE date = ? AND enrollment_year = ? LIMIT 1",
+                      (date_str, ey)).fetchone()
+    else:
+        row = execute(conn, """
+            SELECT 1 FROM duty_shift_assignments WHERE date = ? AND role = ? AND enrollment_year = ? LIMIT 1
+        """, (date_str, role, ey)).fetchone()
+    return row is not None
+
+
+def _claim_run(conn, date_str: str, role: str, ey) -> bool:
+    """Занять запуск в distribution_runs: новая строка, завершённый запуск или зависший дольше
+    DISTRIBUTION_STALE_SECONDS. True — распределяет этот процесс."""
+    now = datetime.now()
+    started_at = now.strftime("%Y-%m-%d %H:%M:%S")
+    stale_before = (now - timedelta(seconds=DISTRIBUTION_STALE_SECONDS)).strftime("%Y-%m-%d %H:%M:%S")
+    with transaction(conn):
+        claimed = execute(conn, """
+            INSERT INTO distribution_runs (date, role, enrollment_year, status, started_at)
+            VALUES (?, ?, ?, 'running', ?)
+            ON CONFLICT (date, role, enrollment_year) DO NOTHING
+        """, (date_str, role, ey, started_at)).rowcount
+        if claimed <= 0:
+            claimed = execute(conn, """
+                UPDATE distribution_runs SET status = 'running', started_at = ?
+                WHERE date = ? AND role = ? AND enrollment_year = ? AND (status = 'done' OR started_at < ?)
+            """, (started_at, date_str, role, ey, stale_before)).rowcount
+    return claimed > 0
+
+
+def _finish_run(conn, date_str: str, role: str, ey):
+    with transaction(conn):
+        execute(conn, "UPDATE distribution_runs SET status = 'done' WHERE date = ? AND role = ? AND enrollment_year = ?",
+                (date_str, role, ey))
+
+
+def _wait_for_run(conn, date_str: str, role: str, ey):
+    deadline = time.monotonic() + DISTRIBUTION_WAIT_SECONDS
+    while time.monotonic() < deadline:
+        row = execute(conn, "SELECT status FROM distribution_runs WHERE date = ? AND role = ? AND enrollment_year = ?",
+                      (date_str, role, ey)).fetchone()
+        if not row or row["status"] == "done":
+            return
+        time.sleep(0.2)
+
+
+def ensure_distributed(conn, date_str: str, role: str, ey, weights: dict = None) -> list:
+    """Распределить наряд (role = 'с' — столовая), если назначений ещё нет, — не более одного расчёта на
+    (дата, роль, курс): в процессе конкуренты ждут на блокировке, между процессами (бот, воркеры сервера) —
+    на строке distribution_runs. Возвращает назначения, если распределял этот вызов, иначе []."""
+    with _flight_lock((str(date_str), role, ey)):
+        if _has_assignments(conn, date_str, role, ey):
+            return []
+        if not _claim_run(conn, date_str, role, ey):
+            _wait_for_run(conn, date_str, role, ey)
+            return []
+        try:
+            # Пока занимали запуск, другой процесс мог успеть закончить
+            if _has_assignments(conn, date_str, role, ey):
+                return []
+            if role == "с":
+                return distribute_canteen_for_date(date_str, ey, conn, weights)
+            return distribute_shifts_for_date(date_str, role, ey, conn)
+        finally:
+            _finish_run(conn, date_str, role, ey)
+
+
+def distribute_pending_for_date(conn, date_str: str) -> list:
+    """Зафиксировать план на дату и распределить наряды, у которых назначений нет (все курсы, Курс/ГБР и столовая).
+    Существующие назначения берутся одним запросом на таблицу. Возвращает [(ey, role, число назначений)]."""
+    freeze_date(conn, date_str)
+    years = [r["enrollment_year"] for r in execute(conn, DATE_YEARS_QUERY, (date_str,)).fetchall()]
+    if not years:
+        return []
+    done_shifts = {(r["enrollment_year"], r["role"]) for r in execute(conn,
+        "SELECT DISTINCT enrollment_year, role FROM duty_shift_assignments WHERE date = ?", (date_str,)
+    ).fetchall()}
+    done_canteen = {r["enrollment_year"] for r in execute(conn,
+        "SELECT DISTINCT enrollment_year FROM duty_canteen_assignments WHERE date = ?", (date_str,)
+    ).fetchall()}
+    weights = load_object_weights(conn)
+    result = []
+    for ey in years:
+        for role in SHIFT_ROLES:
+            if (ey, role) not in done_shifts:
+                assignments = ensure_distributed(conn, date_str, role, ey)
+                if assignments:
+                    result.append((ey, role, len(assignments)))
+        if ey not in done_canteen:
+            assignments = ensure_distributed(conn, date_str, "с", ey, weights)
+            if assignments:
+                result.append((ey, "с", len(assignments)))
+    return result
@@ -0,0 +1,92 @@
+# utils/duty_queries.py — запросы эндпоинтов server.py к duty_schedule.
+# Вынесены в константы, чтобы tests/test_query_plans.py проверял планы именно тех запросов, что выполняются:
+# каждый должен идти по индексу (миграции 8 и 9), без полного прохода таблицы.
+# Запросы движков — рядом с кодом: utils/schedule_snapshot.py, utils/points.py, utils/distribution.py.
+
+# Наряды на дату по всем курсам (by-date без курса пользователя): (дата,)
+DUTIES_ON_DATE = """
+    SELECT ds.fio, ds.role, ds.group_name, ds.enrollment_year, ds.gender, u.telegram_id
+    FROM duty_schedule ds
+    LEFT JOIN users u ON u.telegram_id = ds.user_id AND u.status = 'активен'
+    WHERE ds.date = ?
+    ORDER BY ds.role, ds.group_name, ds.fio
+"""
+
+# Курсы строк графика пользователя за месяц: (telegram_id, начало месяца, начало следующего)
+USER_MONTH_YEARS = """
+    SELECT DISTINCT enrollment_year FROM duty_schedule
+    WHERE user_id = ? AND date >= ? AND date < ?
+"""
+
+# Число строк графика пользователя (профиль): (telegram_id,)
+USER_DUTY_COUNT = "SELECT COUNT(*) as cnt FROM duty_schedule WHERE user_id = ?"
+
+# Наряды пользователя за всё время + все участники того же наряда + статус подтверждения: (telegram_id, telegram_id)
+USER_DUTIES_WITH_PARTNERS = """
+    SELECT me.fio AS my_fio, me.date, me.role, me.group_name, me.enrollment_year,
+           p.fio AS partner_fio, p.group_name AS partner_group,
+           c.status AS confirmation_status
+    FROM duty_schedule me
+    JOIN duty_schedule p
+      ON p.date = me.date AND p.role = me.role AND p.enrollment_year = me.enrollment_year
+    LEFT JOIN duty_confirmations c
+      ON c.telegram_id = ? AND c.date = me.date AND c.role = me.role
+    WHERE me.user_id = ?
+    ORDER BY me.date, me.role, me.fio, p.group_name, p.fio
+"""
+
+# Каталог schedule_months курса за месяц: (YYYY-MM, курс, начало месяца, начало следующего)
+REFRESH_MONTH_CATALOG = """
+    INSERT INTO schedule_months (enrollment_year, ym, group_name, row_count, updated_at)
+    SELECT enrollment_year, ?, group_name, COUNT(*), CURRENT_TIMESTAMP
+    FROM duty_schedule
+    WHERE enrollment_year = ? AND date >= ? AND date < ?
+    GROUP BY enrollment_year, group_name
+"""
+
+# Удаление графика за месяц: группы (группа, курс, начало, конец) и курса (курс, начало, конец)
+DELETE_GROUP_MONTH = """
+    DELETE FROM duty_schedule
+    WHERE group_name = ? AND enrollment_year = ? AND date >= ? AND date < ?
+"""
+DELETE_COURSE_MONTH = """
+    DELETE FROM duty_schedule
+    WHERE enrollment_year = ? AND date >= ? AND date < ?
+"""
+
+# Курсанты в графике за месяц (контекст правки): группы (курс, группа, начало, конец) и курса (курс, начало, конец)
+GROUP_MONTH_CADETS = """
+    SELECT DISTINCT fio, group_name FROM duty_schedule
+    WHERE enrollment_year = ? AND group_name = ? AND date >= ? AND date < ?
+    ORDER BY group_name, fio
+"""
+COURSE_MONTH_CADETS = """
+    SELECT DISTINCT fio, group_name FROM duty_schedule
+    WHERE enrollment_year = ? AND date >= ? AND date < ?
+    ORDER BY group_name, fio
+"""
+
+# Наряд курсанта на дату: (дата, курс, ФИО)
+CADET_DUTY_ON_DATE = """
+    SELECT role, group_name FROM duty_schedule
+    WHERE date = ? AND enrollment_year = ? AND fio = ?
+"""
+# Смена роли в наряде: (роль, дата, курс, ФИО)
+SET_DUTY_ROLE = """
+    UPDATE duty_schedule SET role = ? WHERE date = ? AND enrollment_year = ? AND fio = ?
+"""
+
+# Строка наряда: (дата, роль, курс, ФИО)
+DUTY_ROW = """
+    SELECT id, group_name FROM duty_schedule
+    WHERE date = ? AND role = ? AND enrollment_year = ? AND fio = ?
+"""
+# Замена участника наряда: (новое ФИО, user_id, дата, роль, курс, прежнее ФИО)
+REPLACE_DUTY_PERSON = """
+    UPDATE duty_schedule SET fio = ?, user_id = ? WHERE date = ? AND role = ? AND enrollment_year = ? AND fio = ?
+"""
+# Удаление участника из наряда: (дата, роль, курс, ФИО)
+DELETE_DUTY_PERSON = """
+    DELETE FROM duty_schedule
+    WHERE date = ? AND role = ? AND enrollment_year = ? AND fio = ?
+"""
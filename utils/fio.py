@@ -0,0 +1,86 @@
+# utils/fio.py — варианты написания ФИО и таблица fio_aliases (алиас → telegram_id).
+# В графике (duty_schedule) ФИО бывает полным или с инициалами; сопоставление с users идёт через fio_aliases,
+# которую обновляют при регистрации, правке профиля и смене ФИО.
+
+from db import execute, execute_many
+from utils.achievements import evaluate_achievements
+from utils.points import refresh_user_points
+from utils.schedule_snapshot import bump_course_schedule_versions
+
+# Привязка непривязанных строк графика курса к пользователю по его алиасам: (telegram_id, курс, telegram_id);
+# план проверяет tests/test_query_plans.py
+LINK_USER_ROWS_QUERY = """
+    UPDATE duty_schedule SET user_id = ?
+    WHERE user_id IS NULL AND enrollment_year = ?
+      AND fio IN (SELECT alias FROM fio_aliases WHERE telegram_id = ?)
+"""
+
+
+def fio_match_variants(full_fio: str) -> list:
+    """Строит варианты ФИО для сопоставления: полное и в виде инициалов (Граков В.А.)."""
+    if not full_fio or not full_fio.strip():
+        return []
+    parts = [p.strip() for p in full_fio.strip().split() if p.strip()]
+    if not parts:
+        return []
+    variants = [full_fio.strip()]
+    if len(parts) >= 3:
+        surname, name, patronymic = parts[0], parts[1], parts[2]
+        variants.append(f"{surname} {name[0]}.{patronymic[0]}.")
+        variants.append(f"{surname} {name[0]}.{patronymic[0]}")
+        variants.append(f"{surname} {name[0]} {patronymic[0]}")
+        variants.append(f"{surname} {name[0]}. {patronymic[0]}.")
+    elif len(parts) == 2:
+        variants.append(f"{parts[0]} {parts[1][0]}.")
+    return list(dict.fromkeys(variants))
+
+
+def sync_fio_aliases(conn, telegram_id: int, fio: str, enrollment_year):
+    """Перезаписывает алиасы пользователя по текущему ФИО. Коммит — на вызывающем."""
+    execute(conn, "DELETE FROM fio_aliases WHERE telegram_id = ?", (telegram_id,))
+    execute_many(conn,
+        "INSERT INTO fio_aliases (alias, telegram_id, enrollment_year) VALUES (?, ?, ?)",
+        [(alias, telegram_id, enrollment_year) for alias in fio_match_variants(fio)]
+    )
+
+
+def refresh_user_fio_aliases(conn, telegram_id: int):
+    """Пересчитать алиасы пользователя по его текущей записи в users (после INSERT/UPDATE ФИО или курса)
+    и привязать к нему строки графика, которые при загрузке остались без user_id; пересчитать его очки."""
+    user = execute(conn, "SELECT fio, enrollment_year FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
+    if user:
+        sync_fio_aliases(conn, telegram_id, user["fio"], user["enrollment_year"])
+        linked = execute(conn, LINK_USER_ROWS_QUERY, (telegram_id, user["enrollment_year"], telegram_id))
+        if linked.rowcount > 0:
+            bump_course_schedule_versions(conn, user["enrollment_year"])
+        # Очки зависят и от привязанных строк, и от курса пользователя; достижения — только при изменениях
+        changed = refresh_user_points(conn, telegram_id)
+        if changed:
+            evaluate_achievements(conn, changed)
+
+
+def resolve_fio_user_ids(conn, fios, enrollment_year=None) -> dict:
+    """ФИО из графика → {"user_id", "gender"} по fio_aliases, одним запросом на все ФИО.
+    При совпадении у нескольких пользователей приоритет у курса enrollment_year.
+    ФИО без совпадения в результат не попадают — такие строки графика сохраняются с user_id = NULL."""
+    fios = list(dict.fromkeys(f for f in fios if f))
+    if not fios:
+        return {}
+    placeholders = ",".join(["?"] * len(fios))
+    rows = execute(conn, f"""
+        SELECT a.alias, a.telegram_id, a.enrollment_year, u.gender
+        FROM fio_aliases a
+        JOIN users u ON u.telegram_id = a.telegram_id
+        WHERE a.alias IN ({placeholders})
+        ORDER BY a.alias, a.telegram_id
+    """, tuple(fios)).fetchall()
+    resolved = {}
+    for r in rows:
+        prev = resolved.get(r["alias"])
+        if prev is None or (r["enrollment_year"] == enrollment_year and not prev["same_course"]):
+            resolved[r["alias"]] = {
+                "user_id": r["telegram_id"],
+                "gender": r["gender"] or "male",
+                "same_course": r["enrollment_year"] == enrollment_year,
+            }
+    return {alias: {"user_id": v["user_id"], "gender": v["gender"]} for alias, v in resolved.items()}
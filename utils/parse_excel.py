@@ -4,6 +4,7 @@
 import pandas as pd
 from database import get_db
 from utils.roles import validate_duty_role
+from utils.fio import resolve_fio_user_ids
 
 
 def parse_excel_schedule_with_validation(file_path: str) -> dict:
@@ -11,7 +12,7 @@ def parse_excel_schedule_with_validation(file_path: str) -> dict:
     Возвращает:
     {
         'success': bool,
-        'data': [{'fio', 'date', 'role', 'group', 'gender'}],
+        'data': [{'fio', 'date', 'role', 'group', 'gender', 'user_id'}],
         'group': str,
         'errors': [str],
         'warnings': [str],
@@ -97,9 +98,6 @@ def parse_excel_schedule_with_validation(file_path: str) -> dict:
         if year is None:
             year = 2026 if month_num == 1 else 2025
 
-        conn = get_db()
-        cursor = conn.cursor()
-
         for i, fio in enumerate(fio_list):
             if not fio:
                 continue
@@ -127,20 +125,28 @@ def parse_excel_schedule_with_validation(file_path: str) -> dict:
                     errors.append(f"Ошибка даты: строка {i+6}, день {day}")
                     continue
 
-                cursor.execute("SELECT gender FROM users WHERE fio LIKE ?", (f"{fio}%",))
-                user = cursor.fetchone()
-                gender = user['gender'] if user else 'male'
-
                 duty_data.append({
                     "fio": fio,
                     "date": full_date,
                     "role": role,
                     "group": group,
-                    "gender": gender
                 })
                 valid_count += 1
 
-        conn.close()
+        # Сопоставление ФИО с пользователями (fio_aliases) — один запрос на весь график.
+        # user_id = None — ФИО не найдено, строка помечается как несопоставленная.
+        conn = get_db()
+        try:
+            resolved = resolve_fio_user_ids(conn, [d["fio"] for d in duty_data])
+        finally:
+            conn.close()
+        for d in duty_data:
+            match = resolved.get(d["fio"])
+            d["user_id"] = match["user_id"] if match else None
+            d["gender"] = match["gender"] if match else 'male'
+        unresolved = sorted({d["fio"] for d in duty_data if d["user_id"] is None})
+        if unresolved:
+            warnings.append("Не найдены в базе пользователей: " + ", ".join(unresolved))
 
         if not duty_data:
             errors.append("Не найдено ни одного корректного наряда.")
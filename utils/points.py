@@ -0,0 +1,219 @@
+# utils/points.py — очки за наряды: веса ролей по опросу, таблица-леджер user_points и материализованные топы.
+# user_points хранит очки пользователя за каждый месяц (period_ym = YYYY-MM) и итог (period_ym = 'all').
+# Обновляется точечно: правка графика курса за месяц, привязка строк графика к пользователю,
+# пересчёт весов опроса — полная перестройка. Рейтинг читает только user_points и leaderboards.
+# leaderboards — готовые места по курсу (scope_key = enrollment_year) и институту (scope_key = 0) за период
+# среди всех активных пользователей (без нарядов — с нулём очков); пересчитываются вместе с очками периода. rank_snapshots — места на начало дня (изменение за день, тренд).
+# Наряды засчитываются в курсе пользователя (duty_schedule.enrollment_year = users.enrollment_year).
+
+import os
+from collections import defaultdict
+
+from db import execute, execute_many
+from utils.schedule_snapshot import month_bounds
+
+# Роль в графике (код) → объект опроса, по весу которого начисляются очки; без веса — DEFAULT_DUTY_POINTS
+DUTY_ROLE_OBJECTS = {"к": "Курс", "дк": "Дежурный по курсу", "с": "Столовая", "гбр": "ГБР", "зуб": "ЗУБ", "путсо": "ПУТСО", "м": "Медчасть"}
+DEFAULT_DUTY_POINTS = 10.0
+ALL_PERIOD = "all"
+# Очки в леджере округляются: сумма по месяцам и пересчёт одного пользователя дают те же значения
+POINTS_PRECISION = 3
+# Сколько дней хранить снимки мест (тренд в топе)
+RANK_HISTORY_DAYS = int(os.getenv("RANK_HISTORY_DAYS", "30"))
+SCOPE_COURSE = "course"
+SCOPE_INSTITUTE = "institute"
+# Наряды пользователя в его курсе: (telegram_id, курс); план проверяет tests/test_query_plans.py
+USER_DUTIES_QUERY = "SELECT date, role FROM duty_schedule WHERE user_id = ? AND enrollment_year = ?"
+
+
+def role_weights(conn) -> dict:
+    """Код роли → очки за наряд по весам опроса (основные объекты, parent_id IS NULL).
+    Роль, совпадающая с именем объекта, тоже получает его вес."""
+    by_name = {}
+    for w in execute(conn, """
+        SELECT o.name, ow.weight FROM duty_objects o
+        JOIN object_weights ow ON ow.object_id = o.id
+        WHERE o.parent_id IS NULL
+    """).fetchall():
+        by_name[w["name"]] = float(w["weight"] or 0)
+    weights = {name: w for name, w in by_name.items() if name == name.lower()}
+    weights.update({code: by_name.get(name, DEFAULT_DUTY_POINTS) for code, name in DUTY_ROLE_OBJECTS.items()})
+    return weights
+
+
+def _refresh_course_totals(conn, ey):
+    """Пересобрать итоговые строки ('all') курса из помесячных."""
+    execute(conn, "DELETE FROM user_points WHERE enrollment_year = ? AND period_ym = ?", (ey, ALL_PERIOD))
+    execute(conn, f"""
+        INSERT INTO user_points (telegram_id, enrollment_year, period_ym, points, duty_count)
+        SELECT telegram_id, enrollment_year, ?, ROUND(CAST(SUM(points) AS NUMERIC), {POINTS_PRECISION}), SUM(duty_count)
+        FROM user_points
+        WHERE enrollment_year = ? AND period_ym <> ?
+        GROUP BY telegram_id, enrollment_year
+    """, (ALL_PERIOD, ey, ALL_PERIOD))
+
+
+def _role_weight_rows(weights: dict) -> list:
+    """Параметры CTE rw (роль, вес): роли в duty_schedule хранятся в нижнем регистре (загрузка, миграция 18)."""
+    return [v for item in weights.items() for v in item]
+
+
+def course_month_points_query(roles: int) -> str:
+    """Очки курса за месяц по строкам графика: параметры — пары (роль, вес) × roles, YYYY-MM, курс, начало месяца,
+    начало следующего; план проверяет tests/test_query_plans.py."""
+    return f"""
+        WITH rw(role, weight) AS (VALUES {", ".join(["(?, ?)"] * roles)})
+        INSERT INTO user_points (telegram_id, enrollment_year, period_ym, points, duty_count)
+        SELECT u.telegram_id, u.enrollment_year, ?,
+               ROUND(CAST(SUM(COALESCE(rw.weight, {DEFAULT_DUTY_POINTS})) AS NUMERIC), {POINTS_PRECISION}), COUNT(*)
+        FROM duty_schedule ds
+        JOIN users u ON u.telegram_id = ds.user_id AND u.enrollment_year = ds.enrollment_year
+        LEFT JOIN rw ON rw.role = ds.role
+        WHERE ds.enrollment_year = ? AND ds.date >= ? AND ds.date < ?
+        GROUP BY u.telegram_id, u.enrollment_year
+    """
+
+
+def _refresh_course_month(conn, ey, ym: str, weights: dict):
+    start, end = month_bounds(ym)
+    rw = _role_weight_rows(weights)
+    execute(conn, "DELETE FROM user_points WHERE enrollment_year = ? AND period_ym = ?", (ey, ym))
+    execute(conn, course_month_points_query(len(rw) // 2), (*rw, ym, ey, start, end))
+
+
+def _course_points(conn, ey, ym: str) -> set:
+    return {tuple(r) for r in execute(conn, """
+        SELECT telegram_id, period_ym, points, duty_count FROM user_points
+        WHERE enrollment_year = ? AND period_ym IN (?, ?)
+    """, (ey, ym, ALL_PERIOD)).fetchall()}
+
+
+def refresh_course_month_points(conn, ey, ym: str) -> set:
+    """Пересчитать очки курса за месяц YYYY-MM и итоги курса (после загрузки или правки графика).
+    Возвращает telegram_id, у которых изменились очки, число нарядов или место в топе (пусто — ничего не изменилось).
+    Коммит — на вызывающем."""
+    old = _course_points(conn, ey, ym)
+    _refresh_course_month(conn, ey, ym, role_weights(conn))
+    _refresh_course_totals(conn, ey)
+    changed = {telegram_id for telegram_id, _, _, _ in old ^ _course_points(conn, ey, ym)}
+    if changed:
+        changed |= refresh_leaderboards(conn, ym)
+        changed |= refresh_leaderboards(conn, ALL_PERIOD)
+    return changed
+
+
+def refresh_user_points(conn, telegram_id: int) -> set:
+    """Пересчитать все строки пользователя (после привязки строк графика или смены курса) и топы затронутых
+    периодов. Возвращает telegram_id, у которых изменились очки, число нарядов или место в топе
+    (пусто — ничего не изменилось). Коммит — на вызывающем."""
+    old = {tuple(r) for r in execute(conn, """
+        SELECT period_ym, enrollment_year, points, duty_count FROM user_points WHERE telegram_id = ?
+    """, (telegram_id,)).fetchall()}
+    periods = {period_ym for period_ym, _, _, _ in old ^ _recount_user_points(conn, telegram_id)}
+    if not periods and _missing_from_leaderboards(conn, telegram_id):
+        # Новый активный пользователь без нарядов: в итоговый топ — с нулём очков
+        periods = {ALL_PERIOD}
+    if not periods:
+        return set()
+    changed = {telegram_id}
+    for period_ym in sorted(periods):
+        changed |= refresh_leaderboards(conn, period_ym)
+    return changed
+
+
+def _missing_from_leaderboards(conn, telegram_id: int) -> bool:
+    """Активного пользователя нет в итоговом топе института (зарегистрирован после последней пересборки)."""
+    return execute(conn, """
+        SELECT 1 FROM users u
+        WHERE u.telegram_id = ? AND u.status = 'активен'
+          AND NOT EXISTS (SELECT 1 FROM leaderboards lb
+                          WHERE lb.scope = ? AND lb.scope_key = 0 AND lb.period_ym = ? AND lb.telegram_id = u.telegram_id)
+    """, (telegram_id, SCOPE_INSTITUTE, ALL_PERIOD)).fetchone() is not None
+
+
+def _recount_user_points(conn, telegram_id: int) -> set:
+    execute(conn, "DELETE FROM user_points WHERE telegram_id = ?", (telegram_id,))
+    user = execute(conn, "SELECT enrollment_year FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
+    if not user:
+        return set()
+    ey = user["enrollment_year"]
+    weights = role_weights(conn)
+    months = defaultdict(lambda: [0.0, 0])
+    for r in execute(conn, USER_DUTIES_QUERY, (telegram_id, ey)).fetchall():
+        month = months[str(r["date"])[:7]]
+        month[0] += weights.get(r["role"], DEFAULT_DUTY_POINTS)
+        month[1] += 1
+    if not months:
+        return set()
+    for month in months.values():
+        month[0] = round(month[0], POINTS_PRECISION)
+    months[ALL_PERIOD] = [round(sum(p for p, _ in months.values()), POINTS_PRECISION), sum(c for _, c in months.values())]
+    execute_many(conn, """
+        INSERT INTO user_points (telegram_id, enrollment_year, period_ym, points, duty_count) VALUES (?, ?, ?, ?, ?)
+    """, [(telegram_id, ey, ym, points, count) for ym, (points, count) in months.items()])
+    return {(ym, ey, points, count) for ym, (points, count) in months.items()}
+
+
+def rebuild_user_points(conn):
+    """Перестроить user_points целиком по каталогу schedule_months (новые веса опроса, заполнение при миграции).
+    Топы не трогает — после перестройки вызвать rebuild_leaderboards. Коммит — на вызывающем."""
+    weights = role_weights(conn)
+    execute(conn, "DELETE FROM user_points")
+    courses = defaultdict(list)
+    for r in execute(conn, "SELECT DISTINCT enrollment_year, ym FROM schedule_months").fetchall():
+        courses[r["enrollment_year"]].append(r["ym"])
+    for ey, months in courses.items():
+        for ym in months:
+            _refresh_course_month(conn, ey, ym, weights)
+        _refresh_course_totals(conn, ey)
+
+
+def _leaderboard_rows(conn, period_ym: str) -> set:
+    return {tuple(r) for r in execute(conn, """
+        SELECT scope, scope_key, telegram_id, rank, points FROM leaderboards WHERE period_ym = ?
+    """, (period_ym,)).fetchall()}
+
+
+def refresh_leaderboards(conn, period_ym: str) -> set:
+    """Пересобрать топы периода: по каждому курсу и по институту, все активные пользователи (без строки
+    в леджере — с нулём очков); места — по (очки DESC, telegram_id). Возвращает telegram_id, чьё место или очки
+    в топах изменились. Коммит — на вызывающем."""
+    old = _leaderboard_rows(conn, period_ym)
+    execute(conn, "DELETE FROM leaderboards WHERE period_ym = ?", (period_ym,))
+    for scope, scope_key, partition in ((SCOPE_COURSE, "u.enrollment_year", "PARTITION BY u.enrollment_year "),
+                                        (SCOPE_INSTITUTE, "0", "")):
+        execute(conn, f"""
+            INSERT INTO leaderboards (scope, scope_key, period_ym, rank, telegram_id, points)
+            SELECT ?, {scope_key}, ?,
+                   ROW_NUMBER() OVER ({partition}ORDER BY COALESCE(up.points, 0) DESC, u.telegram_id),
+                   u.telegram_id, COALESCE(up.points, 0)
+            FROM users u
+            LEFT JOIN user_points up
+              ON up.telegram_id = u.telegram_id AND up.period_ym = ? AND up.enrollment_year = u.enrollment_year
+            WHERE u.status = 'активен'
+        """, (scope, period_ym, period_ym))
+    return {row[2] for row in old ^ _leaderboard_rows(conn, period_ym)}
+
+
+def rebuild_leaderboards(conn, extra_periods=()):
+    """Пересобрать топы всех периодов леджера, итогового и extra_periods — например, текущего месяца, где очков
+    ещё нет, а топ из нулей показывается (перестройка очков, ежедневная сверка статусов)."""
+    execute(conn, "DELETE FROM leaderboards")
+    periods = {r["period_ym"] for r in execute(conn, "SELECT DISTINCT period_ym FROM user_points").fetchall()}
+    for period_ym in sorted(periods | {ALL_PERIOD, *extra_periods}):
+        refresh_leaderboards(conn, period_ym)
+
+
+def snapshot_ranks(conn, day: str, periods, keep_from: str = None) -> int:
+    """Записать места из leaderboards за периоды periods на день day (YYYY-MM-DD; повтор за день не перезаписывает).
+    keep_from — удалить снимки старше этой даты. Возвращает число записанных строк. Коммит — на вызывающем."""
+    periods = list(periods)
+    written = execute(conn, f"""
+        INSERT INTO rank_snapshots (telegram_id, scope, period_ym, snapshot_date, rank, points)
+        SELECT telegram_id, scope, period_ym, ?, rank, points FROM leaderboards
+        WHERE period_ym IN ({", ".join(["?"] * len(periods))})
+        ON CONFLICT DO NOTHING
+    """, (day, *periods)).rowcount
+    if keep_from:
+        execute(conn, "DELETE FROM rank_snapshots WHERE snapshot_date < ?", (keep_from,))
+    return max(written, 0)
@@ -0,0 +1,108 @@
+# utils/schedule_snapshot.py — кэш графика курса за месяц (read-model для /api/duties, by-date, day-detail).
+# Снимок строится одним запросом к duty_schedule и хранится в памяти процесса.
+# Актуальность — по счётчику schedule_versions (курс, месяц), который поднимается при каждой загрузке и правке графика.
+# Снимок хранит привязку строки к пользователю (user_id); telegram_id участника (только активные) определяется
+# при чтении — смена статуса пользователя версию графика не поднимает.
+
+import threading
+from collections import namedtuple
+
+from db import execute
+
+# by_date: {date: {role: [участник, ...]}} — участники в порядке group_name, fio
+# by_person: {user_id: [(date, role, fio, group_name), ...]} — в порядке date, role, fio
+MonthSnapshot = namedtuple("MonthSnapshot", "enrollment_year ym version by_date by_person")
+
+SNAPSHOT_CACHE_SIZE = 64
+# График курса за месяц: (курс, начало месяца, начало следующего); план проверяет tests/test_query_plans.py
+MONTH_SCHEDULE_QUERY = """
+    SELECT ds.date, ds.role, ds.fio, ds.group_name, ds.gender, ds.user_id
+    FROM duty_schedule ds
+    WHERE ds.enrollment_year = ? AND ds.date >= ? AND ds.date < ?
+    ORDER BY ds.date, ds.role, ds.group_name, ds.fio
+"""
+
+_snapshots = {}
+_lock = threading.Lock()
+
+
+def bump_schedule_version(conn, enrollment_year, ym: str):
+    """Поднять версию графика курса за месяц YYYY-MM. Коммит — на вызывающем."""
+    execute(conn, """
+        INSERT INTO schedule_versions (enrollment_year, ym, version) VALUES (?, ?, 1)
+        ON CONFLICT (enrollment_year, ym) DO UPDATE SET version = schedule_versions.version + 1
+    """, (enrollment_year, ym))
+
+
+def bump_course_schedule_versions(conn, enrollment_year):
+    """Поднять версии всех месяцев курса из каталога schedule_months (например, после привязки строк графика
+    к пользователю); месяц без строки версии её получает. Коммит — на вызывающем."""
+    execute(conn, """
+        INSERT INTO schedule_versions (enrollment_year, ym, version)
+        SELECT DISTINCT enrollment_year, ym, 1 FROM schedule_months WHERE enrollment_year = ?
+        ON CONFLICT (enrollment_year, ym) DO UPDATE SET version = schedule_versions.version + 1
+    """, (enrollment_year,))
+
+
+def month_bounds(ym: str):
+    """Границы месяца YYYY-MM: (первый день, первый день следующего месяца)."""
+    y, m = int(ym[:4]), int(ym[5:7])
+    return f"{ym}-01", (f"{y + 1}-01-01" if m == 12 else f"{y}-{m + 1:02d}-01")
+
+
+def _build_snapshot(conn, enrollment_year, ym: str, version: int) -> MonthSnapshot:
+    start, end = month_bounds(ym)
+    rows = execute(conn, MONTH_SCHEDULE_QUERY, (enrollment_year, start, end)).fetchall()
+    by_date = {}
+    by_person = {}
+    for r in rows:
+        # На PostgreSQL date — тип DATE; ключи и значения снимка — строки YYYY-MM-DD
+        date = str(r["date"])
+        by_date.setdefault(date, {}).setdefault(r["role"], []).append({
+            "fio": r["fio"],
+            "group": r["group_name"],
+            "course": enrollment_year,
+            "gender": r["gender"],
+            "user_id": r["user_id"],
+        })
+        if r["user_id"] is not None:
+            by_person.setdefault(r["user_id"], []).append((date, r["role"], r["fio"], r["group_name"]))
+    for duties in by_person.values():
+        duties.sort()
+    return MonthSnapshot(enrollment_year, ym, version, by_date, by_person)
+
+
+def get_month_snapshot(conn, enrollment_year, ym: str) -> MonthSnapshot:
+    """Снимок графика курса за месяц YYYY-MM. Перестраивается, только если версия в БД изменилась."""
+    row = execute(conn, "SELECT version FROM schedule_versions WHERE enrollment_year = ? AND ym = ?",
+                  (enrollment_year, ym)).fetchone()
+    version = row["version"] if row else 0
+    key = (enrollment_year, ym)
+    with _lock:
+        snap = _snapshots.get(key)
+    if snap is not None and snap.version == version:
+        return snap
+    snap = _build_snapshot(conn, enrollment_year, ym, version)
+    with _lock:
+        _snapshots.pop(key, None)
+        _snapshots[key] = snap
+        while len(_snapshots) > SNAPSHOT_CACHE_SIZE:
+            _snapshots.pop(next(iter(_snapshots)))
+    return snap
+
+
+
+def with_telegram_ids(conn, people: list) -> list:
+    """Участники из снимка в формате API: user_id заменяется на telegram_id, если пользователь сейчас активен
+    (один запрос на всех участников)."""
+    ids = list({p["user_id"] for p in people if p["user_id"] is not None})
+    active = set()
+    if ids:
+        active = {r["telegram_id"] for r in execute(conn, f"""
+            SELECT telegram_id FROM users WHERE status = 'активен' AND telegram_id IN ({",".join(["?"] * len(ids))})
+        """, tuple(ids)).fetchall()}
+    return [
+        {"fio": p["fio"], "group": p["group"], "course": p["course"], "gender": p["gender"],
+         "telegram_id": p["user_id"] if p["user_id"] in active else None}
+        for p in people
+    ]